@@ -0,0 +1,85 @@
+"""
+Бенчмарк дельта-IMPORT (v7): сколько байт уходит литералами и сколько
+стоит Delta.encode на сервере, когда у агента уже лежит старая копия.
+
+  blocks  — в копии изменено несколько участков по 100 байт
+  insert  — в новый файл вставлено 3000 байт в середине (хвост сдвинут вперёд)
+  delete  — из нового файла вырезано 3000 байт в середине (хвост сдвинут назад)
+  append  — новый файл — копия с дописанным хвостом 1%
+  random  — файлы не имеют ничего общего: ожидается отказ (None) и отправка целиком
+
+Запуск:  python bench_delta.py [МБ]
+Подпись копии считается так же, как у агента (FileTransfer._signature).
+"""
+
+import hashlib
+import math
+import os
+import sys
+import tempfile
+import time
+import zlib
+from pathlib import Path
+
+from config import Config
+from managers import Delta, Logger
+
+BLOCK_MIN = 2048
+BLOCK_MAX = 1 << 17
+
+
+def signature(path: Path) -> dict:
+    """Копия подписи агента: adler32 и blake2b каждого блока, блок ≈ √размера."""
+    size  = path.stat().st_size
+    block = min(max(math.isqrt(size) // 1024 * 1024, BLOCK_MIN), BLOCK_MAX)
+    weak, strong = [], []
+    with open(path, "rb") as f:
+        while chunk := f.read(block):
+            weak.append(zlib.adler32(chunk))
+            strong.append(hashlib.blake2b(chunk, digest_size=16).hexdigest())
+    return {"size": size, "block": block, "weak": weak, "strong": strong}
+
+
+def variants(data: bytes) -> dict:
+    """Имя → (копия у агента, новый файл на сервере)."""
+    size    = len(data)
+    changed = bytearray(data)
+    for off in (size // 10, size // 2, size * 9 // 10):
+        changed[off:off + 100] = os.urandom(100)
+    middle = size // 2
+    return {
+        "blocks": (bytes(changed), data),
+        "insert": (data, data[:middle] + os.urandom(3000) + data[middle:]),
+        "delete": (data, data[:middle] + data[middle + 3000:]),
+        "append": (data, data + os.urandom(size // 100)),
+        "random": (os.urandom(size), data),
+    }
+
+
+def main(megabytes: float):
+    data = os.urandom(int(megabytes * (1 << 20)))
+    with tempfile.TemporaryDirectory() as tmp:
+        Config.DIR_LOGS = Path(tmp)
+        old_path, new_path = Path(tmp) / "old.bin", Path(tmp) / "new.bin"
+
+        print(f"Файл: {megabytes:g} МБ")
+        for name, (old, new) in variants(data).items():
+            old_path.write_bytes(old)
+            new_path.write_bytes(new)
+            sig    = signature(old_path)
+            start  = time.perf_counter()
+            result = Delta.encode(str(new_path), sig)
+            spent  = time.perf_counter() - start
+            if result is None:
+                print(f"  {name:<7}: блок {sig['block']:>6}  {spent * 1000:>7.0f} мс  "
+                      f"отказ — уходит целиком ({len(new) / 1024:,.0f} KB)")
+                continue
+            ops, literal, _ = result
+            print(f"  {name:<7}: блок {sig['block']:>6}  {spent * 1000:>7.0f} мс  "
+                  f"литералов {literal / 1024:>9,.1f} KB из {len(new) / 1024:,.0f} KB  "
+                  f"операций {len(ops)}")
+        Logger.close()
+
+
+if __name__ == "__main__":
+    main(float(sys.argv[1]) if len(sys.argv) > 1 else 64)
@@ -0,0 +1,80 @@
+"""
+Микробенчмарк разбора сообщений клиента: чанков в секунду.
+
+  legacy — прежний ClientMsgParser: decode строки, lower().strip()
+           всей строки и перебор startswith по всем ClientMsg
+  bytes  — ClientMsgParser по заголовку: один поиск в словаре,
+           payload как memoryview, декодирование только в обработчике
+
+Запуск:  python bench_parser.py [чанков] [строк_в_чанке]
+"""
+
+import sys
+import time
+
+from config import ClientMsg, ClientMsgParser, decode_payload
+
+
+class LegacyClientMsgParser:
+    """Копия парсера до перехода на байты — для сравнения."""
+
+    _EXACT = {
+        "output:end":      ClientMsg.OUTPUT_END,
+        "filetru:end":     ClientMsg.FILETRU_END,
+        "import:complete": ClientMsg.IMPORT_COMPLETE,
+    }
+
+    @staticmethod
+    def parse(raw: str) -> tuple[ClientMsg, str]:
+        lower = raw.lower().strip()
+        if lower in LegacyClientMsgParser._EXACT:
+            return LegacyClientMsgParser._EXACT[lower], ""
+        for member in ClientMsg:
+            prefix = member.value + ":"
+            if lower.startswith(prefix):
+                return member, raw[len(prefix):]
+        raise ValueError(raw[:60])
+
+
+def make_chunk(lines: int) -> bytes:
+    text = "<<<NL>>>".join(f"drwxr-xr-x  2 root root 4096 Oct 17 01:{i % 60:02d} dir_{i}"
+                           for i in range(lines))
+    return f"OUTPUT:CHUNK:{text}\n".encode()
+
+
+def bench_legacy(line: bytes, n: int) -> float:
+    start = time.perf_counter()
+    for _ in range(n):
+        msg = line.decode("utf-8", errors="ignore").strip()
+        _, payload = LegacyClientMsgParser.parse(msg)
+        payload.replace("<<<NL>>>", "\n")
+    return n / (time.perf_counter() - start)
+
+
+def bench_bytes(line: bytes, n: int) -> float:
+    start = time.perf_counter()
+    for _ in range(n):
+        _, payload = ClientMsgParser.parse(line)
+        decode_payload(bytes(payload).replace(b"<<<NL>>>", b"\n"))
+    return n / (time.perf_counter() - start)
+
+
+def bench_header_only(line: bytes, n: int) -> float:
+    start = time.perf_counter()
+    for _ in range(n):
+        ClientMsgParser.parse(line)
+    return n / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    lines = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    chunk = make_chunk(lines)
+
+    print(f"Чанк: {lines} строк, {len(chunk) / 1024:.1f} KB, повторов: {count}")
+    legacy = bench_legacy(chunk, count)
+    new    = bench_bytes(chunk, count)
+    header = bench_header_only(chunk, count)
+    print(f"  legacy  (str, lower+strip+перебор) : {legacy:>12,.0f} чанков/с")
+    print(f"  bytes   (заголовок + decode)       : {new:>12,.0f} чанков/с  x{new / legacy:.1f}")
+    print(f"  bytes   (только классификация)     : {header:>12,.0f} чанков/с  x{header / legacy:.1f}")
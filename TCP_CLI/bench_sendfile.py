@@ -0,0 +1,95 @@
+"""
+Бенчмарк IMPORT одного большого файла: МБ/с от FILE:META до FILE:END
+на локальном «агенте» — потоке, который читает сокет и выбрасывает байты.
+
+  loop     — FileTransfer.send_file без sendfile: read → write → drain по CHUNK_SIZE
+  sendfile — FileTransfer.send_file с Config.SENDFILE: loop.sendfile, байты не идут через Python
+
+Запуск:  python bench_sendfile.py [ГБ] [повторов]
+Файл создаётся разреженным во временной папке — диск почти не занимает
+и читается из кэша, так что меряется путь отправки, а не диск.
+"""
+
+import asyncio
+import contextlib
+import io
+import json
+import socket
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from config import Config
+from managers import FileTransfer, Logger
+
+
+def stand_in_agent(sock: socket.socket, expected: int, result: dict):
+    """Читает сокет, как агент при IMPORT, но без записи на диск — до последнего байта FILE:END."""
+    block = memoryview(bytearray(1 << 20))
+    got   = 0
+    tail  = b""
+    while got < expected:
+        n = sock.recv_into(block)
+        if not n:
+            break
+        got += n
+        tail = (tail + bytes(block[max(0, n - 9):n]))[-9:]
+    result["end"]   = time.perf_counter()
+    result["tail"]  = tail
+    result["bytes"] = got
+    sock.close()
+
+
+async def send_once(path: Path, size: int, sendfile: bool) -> float:
+    Config.SENDFILE = sendfile
+    result   = {}
+    meta     = f"FILE:META:{json.dumps({'rel_path': path.name, 'size': size})}\n"
+    expected = len(meta.encode()) + size + len(b"FILE:END\n")
+    sent     = asyncio.Event()
+
+    async def on_connect(reader, writer):
+        result["start"] = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            result["ok"] = await FileTransfer.send_file(writer, str(path), path.name, size)
+        writer.close()
+        sent.set()
+
+    server = await asyncio.start_server(on_connect, "127.0.0.1", 0)
+    port   = server.sockets[0].getsockname()[1]
+    sock   = socket.create_connection(("127.0.0.1", port))
+    agent  = threading.Thread(target=stand_in_agent, args=(sock, expected, result), daemon=True)
+    agent.start()
+    await asyncio.to_thread(agent.join)
+    await sent.wait()
+    server.close()
+    await server.wait_closed()
+
+    assert result.get("ok") and result["bytes"] == expected and result["tail"] == b"FILE:END\n", \
+        "файл дошёл не целиком"
+    return size / (1 << 20) / (result["end"] - result["start"])
+
+
+async def main(gigabytes: float, repeats: int):
+    size = int(gigabytes * (1 << 30))
+    with tempfile.TemporaryDirectory() as tmp:
+        Config.DIR_LOGS = Path(tmp)
+        path = Path(tmp) / "big.bin"
+        with open(path, "wb") as f:
+            f.truncate(size)
+
+        rates = {}
+        for name in ("loop", "sendfile"):
+            rates[name] = max([await send_once(path, size, name == "sendfile") for _ in range(repeats)])
+        Logger.close()
+
+    print(f"Файл: {gigabytes:g} ГБ, лучший из {repeats}")
+    for name, rate in rates.items():
+        print(f"  {name:<9}: {rate:>9,.0f} МБ/с  x{rate / rates['loop']:.2f}")
+
+
+if __name__ == "__main__":
+    gigabytes = float(sys.argv[1]) if len(sys.argv) > 1 else 2
+    repeats   = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    asyncio.run(main(gigabytes, repeats))
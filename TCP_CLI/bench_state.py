@@ -0,0 +1,149 @@
+"""
+Бенчмарк ServerState на N одновременных клиентах: память и скорость
+пути одного вывода (init_buffer → append_chunk × K → flush_buffer → get_command).
+
+  legacy  — прежний ServerState: пять параллельных словарей,
+            буфер и команда — словари {"type", "lines", ...}
+  session — ServerState с ClientSession / ActiveCommand / OutputBuffer (__slots__),
+            команды по ID запроса, вывод — байты в OutputBuffer команды
+
+Чанк приходит так, как его отдаёт кодек, — memoryview с ID запроса агента с пулом.
+session хранит байты как есть; legacy хранил строки, поэтому декодирует каждый
+чанк (decode_payload). Скорость — лучшая из нескольких прогонов на свежем состоянии.
+
+Запуск:  python bench_state.py [клиентов] [чанков_на_вывод]
+"""
+
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from config import Config, decode_payload
+from managers import Logger, ServerState
+
+
+class LegacyServerState:
+    """Копия нужной части ServerState до перехода на сессии — для сравнения."""
+
+    def __init__(self):
+        self._clients            = {}
+        self._protocols          = {}
+        self._output_buffers     = {}
+        self._last_outputs       = {}
+        self._active_commands    = {}
+        self._scheduled_tracking = {}
+        self._windows            = {}
+
+    def add_client(self, username, writer, protocol=3):
+        self._clients[username] = writer
+        self._protocols[username] = protocol
+        self._output_buffers[username] = {"type": None, "lines": [], "chunks": 0, "total": 0}
+
+    def init_buffer(self, username, buf_type, total=0):
+        self._output_buffers[username] = {
+            "type": buf_type, "lines": [], "chunks": 0, "total": total
+        }
+
+    def append_chunk(self, username, chunk):
+        buf = self._output_buffers.get(username)
+        if buf:
+            buf["lines"].append(chunk)
+            buf["chunks"] += 1
+
+    def flush_buffer(self, username):
+        buf    = self._output_buffers.get(username, {})
+        result = "\n".join(buf.get("lines", []))
+        self._last_outputs[username] = {
+            "type":      buf.get("type"),
+            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "content":   result,
+        }
+        if buf:
+            buf["lines"] = []
+        return result
+
+    def register_command(self, username, command, cmd_type, cmd_count=1):
+        self._active_commands[username] = {
+            "start_time":         time.time(),
+            "command":            command,
+            "type":               cmd_type,
+            "total_commands":     cmd_count,
+            "received_commands":  0,
+            "accumulated_output": [],
+        }
+
+    def get_command(self, username):
+        return self._active_commands.get(username)
+
+
+def populate(state, clients: int, legacy: bool):
+    for i in range(clients):
+        cid = f"host{i}"
+        state.add_client(cid, object(), 4)
+        cmd = state.register_command(cid, "uname -a", "SIMPL", 4)
+        if legacy:
+            state.init_buffer(cid, "FILETRU", 1)
+        else:
+            state.init_buffer(cid, cmd.rid, "FILETRU", cmd, 1)
+
+
+def measure_memory(factory, clients: int, legacy: bool) -> int:
+    tracemalloc.start()
+    base  = tracemalloc.take_snapshot()
+    state = factory()
+    populate(state, clients, legacy)
+    Logger.flush()
+    used = sum(s.size_diff for s in tracemalloc.take_snapshot().compare_to(base, "filename"))
+    tracemalloc.stop()
+    return used
+
+
+def measure_messages(factory, clients: int, chunks: int, legacy: bool, repeat: int = 5) -> float:
+    return max(_run_messages(factory, clients, chunks, legacy) for _ in range(repeat))
+
+
+def _run_messages(factory, clients: int, chunks: int, legacy: bool) -> float:
+    state = factory()
+    populate(state, clients, legacy)
+    Logger.flush()
+    payload = memoryview(b"drwxr-xr-x  2 root root 4096 Oct 17 01:00 dir")
+    rids    = [] if legacy else [state.get_commands(f"host{i}")[0].rid for i in range(clients)]
+    start   = time.perf_counter()
+    for i in range(clients):
+        cid = f"host{i}"
+        if legacy:
+            state.init_buffer(cid, "FILETRU", 1)
+            for _ in range(chunks):
+                state.append_chunk(cid, decode_payload(payload))
+            state.flush_buffer(cid)
+            state.get_command(cid)["received_commands"] += 1
+        else:
+            rid  = rids[i]
+            info = state.get_command(cid, rid)
+            state.init_buffer(cid, rid, "FILETRU", info, 1)
+            for _ in range(chunks):
+                state.append_chunk(cid, rid, payload)
+            state.flush_buffer(cid, rid)
+            info.received_commands += 1
+    return clients * (chunks + 3) / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    chunks  = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+
+    with tempfile.TemporaryDirectory() as tmp:
+        Config.DIR_LOGS = Path(tmp)
+        variants = {"legacy": LegacyServerState, "session": ServerState}
+        memory   = {name: measure_memory(f, clients, name == "legacy")
+                    for name, f in variants.items()}
+        rates    = {name: measure_messages(f, clients, chunks, name == "legacy")
+                    for name, f in variants.items()}
+        Logger.close()
+
+    print(f"Клиентов: {clients}, чанков на вывод: {chunks}")
+    for name in variants:
+        print(f"  {name:<8}: {memory[name] / clients:>7,.0f} байт/клиент  "
+              f"{rates[name]:>12,.0f} операций/с  x{rates[name] / rates['legacy']:.2f}")
@@ -0,0 +1,80 @@
+"""
+Бенчмарк хранилища пользователей: входов/выходов в секунду
+через UserManager.register/logout при заранее созданной базе.
+
+  json    — JsonStore: каждый вход/выход переписывает весь users.json
+  json-wb — JsonStore с WRITE_BEHIND: файл пишется раз в интервал (здесь — в конце)
+  sqlite  — SqliteStore (WAL): обновляется одна строка
+
+Запуск:  python bench_storage.py [пользователей] [циклов_вход_выход]
+Работает во временной папке, home/ сервера не трогает.
+"""
+
+import contextlib
+import io
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from config import Config
+from managers import Logger, UserManager
+from storage import SqliteStore, flush_all
+
+
+def _use_dir(base: Path):
+    Config.BASE_DIR       = base
+    Config.DIR_HISTORY    = base / "history"
+    Config.DIR_LOGS       = base / "logs"
+    Config.DIR_JSON       = base / "json"
+    Config.FILE_USERS     = base / "users.json"
+    Config.FILE_GROUPS    = Config.DIR_JSON / "groups.json"
+    Config.FILE_SCHEDULED = Config.DIR_JSON / "scheduled_commands.json"
+    Config.FILE_TEMPLATE  = Config.DIR_JSON / "templates.json"
+    Config.FILE_DB        = Config.DIR_JSON / "server.db"
+    for d in (Config.DIR_HISTORY, Config.DIR_LOGS, Config.DIR_JSON):
+        d.mkdir(parents=True, exist_ok=True)
+
+
+def _seed(mgr: UserManager, users: int):
+    data = {
+        f"user{i}": {
+            "alias": f"user{i}", "status": "OFF", "OS": "linux",
+            "default_path": f"/home/user{i}", "users_in_group": [],
+            "last_login": None, "last_logout": None,
+        }
+        for i in range(users)
+    }
+    mgr.save_user_data(data)
+
+
+def bench(backend: str, users: int, cycles: int) -> float:
+    with tempfile.TemporaryDirectory() as tmp:
+        _use_dir(Path(tmp))
+        Config.STORAGE_BACKEND = "json" if backend == "json-wb" else backend
+        Config.WRITE_BEHIND    = backend == "json-wb"
+        mgr = UserManager()
+        _seed(mgr, users)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            for i in range(cycles):
+                name = f"user{(i * 7919) % users}"
+                mgr.register(name, "linux", f"/home/{name}")
+                mgr.logout(name)
+            flush_all()
+            elapsed = time.perf_counter() - start
+            Logger.flush()
+
+        SqliteStore.close_all()
+        return cycles / elapsed
+
+
+if __name__ == "__main__":
+    users  = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    cycles = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    print(f"Пользователей: {users}, циклов вход+выход: {cycles}")
+    results = {backend: bench(backend, users, cycles) for backend in ("json", "json-wb", "sqlite")}
+    for backend, rate in results.items():
+        print(f"  {backend:<8}: {rate:>10,.1f} циклов/с  x{rate / results['json']:.1f}")
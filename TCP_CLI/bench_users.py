@@ -0,0 +1,83 @@
+"""
+Бенчмарк разрешения имён клиентов: поисков в секунду.
+
+  legacy — прежний UserManager.validate: перебор всех пользователей
+           со сравнением info["alias"].lower()
+  index  — UserManager.validate с индексом alias.lower() → username
+
+Запуск:  python bench_users.py [пользователей] [поисков]
+Работает во временной папке, home/ сервера не трогает.
+"""
+
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from config import Config
+from managers import UserManager
+
+
+def legacy_validate(users: dict, name: str):
+    """Копия validate до появления индекса — для сравнения."""
+    if name in users:
+        return name
+    for uname, info in users.items():
+        if info["alias"].lower() == name.lower():
+            return uname
+    return None
+
+
+def _seed(mgr: UserManager, users: int):
+    mgr.save_user_data({
+        f"host{i}": {
+            "alias": f"PC_{i}", "status": "OFF", "OS": "linux",
+            "default_path": f"/home/host{i}", "users_in_group": [],
+            "last_login": None, "last_logout": None,
+        }
+        for i in range(users)
+    })
+
+
+def _names(users: int, lookups: int) -> list[str]:
+    """Смесь как в консоли: имена, алиасы в разном регистре и промахи."""
+    rnd = random.Random(1)
+    out = []
+    for _ in range(lookups):
+        i = rnd.randrange(users)
+        out.append(rnd.choice((f"host{i}", f"pc_{i}", f"PC_{i}", f"missing{i}")))
+    return out
+
+
+def bench(fn, names: list[str]) -> float:
+    start = time.perf_counter()
+    for name in names:
+        fn(name)
+    return len(names) / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    users   = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    lookups = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+
+    with tempfile.TemporaryDirectory() as tmp:
+        Config.FILE_USERS  = Path(tmp) / "users.json"
+        Config.DIR_HISTORY = Path(tmp) / "history"
+        mgr = UserManager()
+        _seed(mgr, users)
+        names = _names(users, lookups)
+        data  = mgr.get_users_data()
+
+        assert all(mgr.validate(n) == legacy_validate(data, n) for n in names[:200])
+
+        # Линейный перебор на 50k пользователей медленный — меряем на доле поисков
+        sample = names[:max(1, lookups // 100)]
+        results = {
+            "legacy": bench(lambda n: legacy_validate(data, n), sample),
+            "index":  bench(mgr.validate, names),
+        }
+
+    print(f"Пользователей: {users}, поисков: {lookups} (legacy — {len(sample)})")
+    for name, rate in results.items():
+        print(f"  {name:<7}: {rate:>14,.0f} поисков/с  x{rate / results['legacy']:.0f}")
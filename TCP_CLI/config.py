@@ -26,6 +26,9 @@ class Config:
     DIR_JSON              = BASE_DIR / "json"
     DIR_SCHEDULED_RESULTS = BASE_DIR / "files" / "scheduled_commands"
     DIR_FOR_SEND          = BASE_DIR / "send_file"
+    DIR_SPILL             = BASE_DIR / "spill"
+    DIR_BLOBS             = BASE_DIR / "blobs"
+    DIR_MANIFESTS         = BASE_DIR / "blobs" / "manifests"
 
     FILE_CODE      = BASE_DIR / "code.txt"
     FILE_USERS     = BASE_DIR / "users.json"
@@ -35,17 +38,59 @@ class Config:
     FILE_SCHEDULED = DIR_JSON / "scheduled_commands.json"
     FILE_TEMPLATE  = DIR_JSON / "templates.json"
     FILE_KEY       = DIR_JSON / "authority_key"
+    FILE_DB        = DIR_JSON / "server.db"
+
+    STORAGE_BACKEND = "json"      # "json" | "sqlite"
+    WRITE_BEHIND          = True  # JSON: изменения копятся и пишутся пачкой
+    WRITE_BEHIND_INTERVAL = 1.0   # не чаще раза в столько секунд
 
 
     HOST = "0.0.0.0"
     PORT = 9000
 
     CHUNK_SIZE          = 65536
+    SENDFILE            = True       # IMPORT: файл отдаёт ядро (loop.sendfile), без чтения в Python
+    SENDFILE_CHUNK      = 8 << 20    # байт за вызов sendfile — между вызовами прогресс и чтение клиента
+    BROADCAST_CHUNK     = 1 << 20    # IMPORT на несколько клиентов: байт из общего mmap за одну запись
+    BROADCAST_STALL     = 30         # клиент, не принявший ни байта столько секунд, отключается
+    TAR_MIN_FILES       = 64         # каталог от стольких файлов идёт одним архивом (клиентам v5)
+    TAR_COMPRESS        = 1          # уровень gzip архива 1..9, 0 — без сжатия
+    TAR_CHUNK           = 1 << 20    # байт архива в одной порции TAR:<n>
+    WALK_BATCH          = 1000       # файлов в одной порции обхода каталога (scandir в потоке)
+    DISK_WORKERS        = 4          # EXPORT: потоков записи принятых файлов на диск, на весь сервер
+    DISK_BUFFER         = 1 << 20    # байт из сети копится в буфере, пока пул пишет предыдущий
+    FSYNC               = "never"    # "never" | "file" — fsync каждого файла | "write" — каждой записи
+    RESUME_BLOCK        = 4 << 20    # блок контрольной суммы (v6); файлы от этого размера докачиваются
+    DELTA_MIN_SIZE      = 1 << 20    # IMPORT (v7): файл от стольких байт шлётся дельтой к копии агента
+    DELTA_MAX_RATIO     = 0.5        # литералов больше этой доли файла — дельта не нужна, шлётся целиком
+    DELTA_ROLL_BUDGET   = 2 << 20    # байт побайтового (скользящего) поиска на файл, дальше — по блокам
+    DELTA_TIMEOUT       = 120        # ждать подписи копий от агента, сек
     COMMAND_TIMEOUT     = 120
     WARNING_TIMEOUT     = 90
     STATE_SAVE_INTERVAL = 30
     READ_TIMEOUT        = 300
+    FRAME_MAX           = 64 << 20   # v4+: кадр клиента длиннее — соединение рвётся, а не буферизуется
     TIMEZONE_OFFSET     = +1
+    PROTOCOL_VERSION    = 8
+
+    FANOUT_LIMIT        = 64     # одновременных отправок при all / group:
+    FANOUT_SEND_TIMEOUT = 10     # таймаут отправки одному клиенту, сек
+    FANOUT_FILE_TIMEOUT = 600    # таймаут IMPORT одному клиенту, сек
+    SIMPL_WINDOW        = 4      # неподтверждённых FILETRU на клиента по умолчанию
+    AGENT_WORKERS_MAX   = 8      # одновременных команд на агенте — не больше, сколько бы ни предложил
+    OUTPUT_SPILL_BYTES  = 1 << 20   # вывод клиента в памяти до стольких байт, дальше — в DIR_SPILL
+    OUTPUT_SPILL_STEP   = 16 << 10  # бюджет выдаётся буферу порциями: запись сверяет только свою
+    OUTPUT_PRINT_LIMIT  = 64 << 10  # в консоль печатается не больше, полностью — save / trash
+
+    LOG_QUEUE_SIZE      = 10000  # записей в очереди логгера
+    LOG_BATCH_SIZE      = 500    # записей за одну запись на диск
+    LOG_FLUSH_INTERVAL  = 1.0    # сброс файла лога не реже, сек
+    LOG_FLUSH_BYTES     = 65536  # ... или после стольких байт
+    LOG_DROP_LEVELS     = ("DEBUG",)  # при переполнении отбрасываются сразу
+    LOG_BLOCK_TIMEOUT   = 0.5    # остальные ждут места в очереди, сек
+
+    HISTORY_RETENTION_DAYS   = 365        # события старше удаляются при компакции
+    HISTORY_COMPACT_INTERVAL = 24 * 3600  # как часто компактировать журналы, сек
 
 
 # ═══════════════════════════════════════════════════════════════════════════
@@ -80,19 +125,26 @@ class ServerCmd(StrEnum):
     TEMPLATE_RM   = "template_rm"
     TEMPLATE_DEL  = "template_del"
     TEMPLATE_LIST = "template_list"
+    TEMPLATE_MODE = "template_mode"
+    HISTORY       = "history"
+    VERSIONS      = "versions"
 
 
 class ClientMsg(StrEnum):
     """Протокольные сообщения, приходящие от клиента"""
-    EXPORT_START    = "export:start"
-    IMPORT_COMPLETE = "import:complete"
-    IMPORT_ERROR    = "import:error"
-    OUTPUT_START    = "output:start"
-    OUTPUT_CHUNK    = "output:chunk"
-    OUTPUT_END      = "output:end"
-    FILETRU_START   = "filetru:start"
-    FILETRU_CHUNK   = "filetru:chunk"
-    FILETRU_END     = "filetru:end"
+    EXPORT_START     = "export:start"
+    EXPORT_ERROR     = "export:error"
+    EXPORT_MANIFEST  = "export:manifest"
+    IMPORT_COMPLETE  = "import:complete"
+    IMPORT_ERROR     = "import:error"
+    IMPORT_RESUME    = "import:resume"
+    IMPORT_SIGNATURE = "import:signature"
+    OUTPUT_START     = "output:start"
+    OUTPUT_CHUNK     = "output:chunk"
+    OUTPUT_END       = "output:end"
+    FILETRU_START    = "filetru:start"
+    FILETRU_CHUNK    = "filetru:chunk"
+    FILETRU_END      = "filetru:end"
 
 
 # ═══════════════════════════════════════════════════════════════════════════
@@ -114,28 +166,64 @@ class ServerCmdParser:
         return cmd, parts[1:]
 
 
-class ClientMsgParser:
-    """Определяет тип сообщения от клиента и выделяет payload."""
+class UnknownMessage(ValueError):
+    """Сообщение клиента не распознано"""
 
-    _EXACT: Dict[str, ClientMsg] = {
-        "output:end":       ClientMsg.OUTPUT_END,
-        "filetru:end":      ClientMsg.FILETRU_END,
-        "import:complete":  ClientMsg.IMPORT_COMPLETE,
-    }
 
-    @staticmethod
-    def parse(raw: str) -> tuple[ClientMsg, str]:
-        lower = raw.lower().strip()
-
-        if lower in ClientMsgParser._EXACT:
-            return ClientMsgParser._EXACT[lower], ""
+class ClientMsgParser:
+    """
+    Определяет тип сообщения от клиента по заголовку "тип:подтип"
+    одним поиском в словаре. Работает с байтами: payload отдаётся
+    как memoryview без копирования и декодируется только обработчиком.
+    """
+
+    _HEADERS: Dict[bytes, ClientMsg] = {
+        variant: member
+        for member in ClientMsg
+        for variant in (member.value.encode(), member.value.upper().encode())
+    }
 
-        for member in ClientMsg:
-            prefix = member.value + ":"
-            if lower.startswith(prefix):
-                return member, raw[len(prefix):]
+    _WHITESPACE = b" \t\r\n"
 
-        raise ValueError(f"Неизвестное сообщение: {raw[:60]}")
+    @staticmethod
+    def parse(raw: bytes) -> tuple[ClientMsg, memoryview]:
+        end = len(raw)
+        while end and raw[end - 1] in ClientMsgParser._WHITESPACE:
+            end -= 1
+
+        sep = raw.find(b":", 0, end)
+        sep = raw.find(b":", sep + 1, end) if sep >= 0 else -1
+        head = raw[:sep] if sep >= 0 else raw[:end]
+
+        member = ClientMsgParser._HEADERS.get(head)
+        if member is None:
+            member = ClientMsgParser._HEADERS.get(head.lower())
+            if member is None:
+                preview = bytes(raw[:60]).decode("utf-8", errors="replace")
+                raise UnknownMessage(f"Неизвестное сообщение: {preview}")
+
+        return member, memoryview(raw)[sep + 1:end] if sep >= 0 else memoryview(b"")
+
+
+def decode_payload(payload: bytes | memoryview) -> str:
+    """Декодирует payload сообщения клиента, когда обработчику нужен текст."""
+    return str(payload, "utf-8", "replace")
+
+
+def split_request_id(payload: bytes | memoryview) -> tuple[Optional[int], memoryview]:
+    """
+    "@7:остаток" → (7, остаток). Агенты с пулом (WORKERS) помечают так
+    каждый START / CHUNK / END; без метки — (None, payload как есть).
+    """
+    view = memoryview(payload)
+    if view[:1] != b"@":
+        return None, view
+    head = bytes(view[1:21])
+    sep  = head.find(b":")
+    rid  = head[:sep] if sep >= 0 else head
+    if not rid.isdigit():
+        return None, view
+    return int(rid), view[len(rid) + 2:]
 
 
 # ═══════════════════════════════════════════════════════════════════════════
@@ -149,7 +237,8 @@ def get_local_time() -> datetime:
 def ensure_dirs():
     for d in [Config.DIR_SAVE, Config.DIR_TRASH, Config.DIR_HISTORY,
               Config.DIR_FILES, Config.DIR_LOGS, Config.DIR_JSON,
-              Config.DIR_SCHEDULED_RESULTS, Config.DIR_FOR_SEND]:
+              Config.DIR_SCHEDULED_RESULTS, Config.DIR_FOR_SEND, Config.DIR_SPILL,
+              Config.DIR_BLOBS, Config.DIR_MANIFESTS]:
         os.makedirs(d, exist_ok=True)
 
 
@@ -157,7 +246,7 @@ def print_help():
     print("\n" + "=" * 80)
     print("ДОСТУПНЫЕ КОМАНДЫ:")
     rows = [
-        ("CMD <client|all|group:> <команда>",           "Выполнить команду"),
+        ("CMD <client|all|group:> [timeout=N] <cmd>",   "Выполнить команду (лимит N сек)"),
         ("export <client|all|group:> <path> [dest]",    "Получить файлы с клиента"),
         ("import <client|all|group:> <path> [dest]",    "Отправить файлы клиенту"),
         ("save <client|all> <filename>",                "Сохранить последний вывод"),
@@ -179,11 +268,14 @@ def print_help():
         ("template_del  <n>",                           "Удалить шаблон"),
         ("template_add  <n> <command>",                 "Добавить команду в шаблон"),
         ("template_rm   <n> <indexes>",                 "Удалить команду из шаблона"),
+        ("template_mode <n> <окно|batch> [timeout=N]",  "Режим отправки и лимит времени шаблона"),
         ("", ""),
         ("list",                                        "Список пользователей"),
+        ("history <user> [с] [по]",                     "Сессии пользователя за период"),
+        ("versions [путь]",                             "Версии файлов EXPORT: у кого уникальные"),
         ("rename <user> <alias>",                       "Переименовать пользователя"),
         ("status",                                      "Активные команды"),
-        ("cancel <client>",                             "Отменить команду"),
+        ("cancel <client> [id]",                        "Отменить команду (все или по ID)"),
         ("kick <client|all>",                           "Отключить клиента/всех"),
         ("help",                                        "Эта справка"),
         ("EXIT",                                        "Остановить сервер"),
@@ -194,7 +286,7 @@ def print_help():
 
 s=ServerCmd
 CMD_HINTS = {
-    s.CMD:           "cmd <user> <comd1, comd2 ...>",
+    s.CMD:           "cmd <user> [timeout=N] <comd1, comd2 ...>",
     s.SIMPL:         "simpl <user> [template_name]",
     s.EXPORT:        "export <user> <path_cli> [path_serv]",
     s.IMPORT:        "import <user> <path_serv> [path_cli]",
@@ -202,7 +294,7 @@ CMD_HINTS = {
     s.LIST:          "list",
     s.RENAME:        "rename <user> <alias>",
     s.STATUS:        "status",
-    s.CANCEL:        "cancel <user>",
+    s.CANCEL:        "cancel <user> [id]",
     s.KICK:          "kick <user|all>",
     s.GROUP_NEW:     "group_new <name> [user1 user2 ...]",
     s.GROUP_LIST:    "group_list",
@@ -218,5 +310,8 @@ CMD_HINTS = {
     s.TEMPLATE_RM:   "template_rm <name> <indexes>",
     s.TEMPLATE_DEL:  "template_del <index>",
     s.TEMPLATE_LIST: "template_list ",
+    s.TEMPLATE_MODE: "template_mode <name> <window|batch> [timeout=N]",
+    s.HISTORY:       "history <user> [YYYY-MM-DD[_HH:MM:SS]] [YYYY-MM-DD[_HH:MM:SS]]",
+    s.VERSIONS:      "versions [часть пути]",
 
 }
@@ -12,11 +12,15 @@ import json
 from pathlib import Path
 from typing import Dict, Optional, Callable
 
-from config import Config, ServerCmd, ClientMsg, print_help, CMD_HINTS
+from config import (
+    Config, ServerCmd, ClientMsg, print_help, CMD_HINTS, decode_payload, split_request_id,
+)
 from managers import (
     Logger, ServerState, UserManager, GroupManager,
-    ScheduledManager, FileTransfer, BanManager, CommandMonitor,
+    ScheduledManager, FileTransfer, SharedSource, FanOut, BanManager, CommandMonitor,
+    SimplSender, SpillBuffer, ActiveCommand, OutputBuffer, ChecksumError, BlobStore,
 )
+from protocol import Codec
 
 
 # ═══════════════════════════════════════════════════════════════════════════
@@ -52,6 +56,8 @@ class CommandHandler:
         self._ban_mgr   = ban_mgr
         self._monitor   = monitor
         self._template  = template
+        self._fanout    = FanOut()
+        self._tasks: set = set()   # досылка шаблонов SIMPL
 
     # ── helpers ──────────────────────────────────────────────────────────
 
@@ -83,17 +89,49 @@ class CommandHandler:
     def _sub(self, text: str, cid: str) -> str:
         return self._sched_mgr.sub_path(text, cid)
 
-    async def _drain(self, cid: str):
-        writer = self._state.get_writer(cid)
-        if writer:
-            await writer.drain()
+    async def _request(self, cid: str, head: str, body: str, command: str, cmd_type: str,
+                       timeout: Optional[float] = None) -> ActiveCommand:
+        """Регистрирует команду и отправляет её с ID запроса; не ушла — регистрация снимается."""
+        info = self._state.register_command(cid, command, cmd_type, 1, timeout)
+        try:
+            await self._state.send(cid, self._state.request(cid, head, info.rid, body))
+        except BaseException:
+            self._state.unregister_command(cid, info.rid)
+            raise
+        return info
+
+    @staticmethod
+    def _report(label: str, results: Dict[str, str]):
+        if len(results) == 1:
+            cid, status = next(iter(results.items()))
+            print(f" {label} → {cid}" if status == FanOut.OK else f" {label} → {cid}: {status}")
+        else:
+            print(f" {label}: {FanOut.summary(results)}")
 
     async def _send_simpl(self, cid: str, commands: list, templ_name : str):
-        self._state.register_command(cid, f"simpl ({len(commands)} команд) - шаблон {templ_name}", "FILETRU", len(commands))
-        for cmd in commands:
-            self._state.get_writer(cid).write(f"FILETRU:{self._sub(cmd, cid)}\n".encode())
-            await self._drain(cid)
-            await asyncio.sleep(0.2)
+        """
+        Под FanOut — только регистрация и первое окно; остальное досылает
+        задача по подтверждениям. Не ушло или задача упала — команда снимается.
+        """
+        opts = self._template.get_options(templ_name)
+        info = self._state.register_command(cid, f"simpl ({len(commands)} команд) - шаблон {templ_name}",
+                                            "FILETRU", len(commands), opts["timeout"])
+        try:
+            rest = await SimplSender.start(self._state, cid, info.rid, [self._sub(cmd, cid) for cmd in commands],
+                                           opts["window"], opts["batch"])
+        except BaseException:
+            self._state.unregister_command(cid, info.rid)
+            raise
+        if rest:
+            self._tasks.add(rest)
+            rest.add_done_callback(lambda task: self._simpl_done(cid, info.rid, task))
+
+    def _simpl_done(self, cid: str, rid: int, task: asyncio.Task):
+        self._tasks.discard(task)
+        if task.cancelled() or task.exception():
+            if not task.cancelled():
+                Logger.log("ERROR", f"SIMPL #{rid}: {task.exception()}", cid, show_console=False)
+            self._state.unregister_command(cid, rid)
 
     def _read_code_file(self) -> list:
         try:
@@ -213,6 +251,13 @@ class CommandHandler:
     # ── основные команды ──────────────────────────────────────────────────
 
     async def cmd(self, args: list):
+        timeout = None
+        if len(args) > 1 and args[1].lower().startswith("timeout="):
+            value = args[1].split("=", 1)[1]
+            if not value.isdigit() or int(value) <= 0:
+                print(f"Формат: {CMD_HINTS.get(ServerCmd.CMD,'Формат не найден!')}")
+                return
+            timeout, args = int(value), [args[0]] + args[2:]
         if len(args) < 2:
             print(f"Формат: {CMD_HINTS.get(ServerCmd.CMD,'Формат не найден!')}")
             return
@@ -222,12 +267,11 @@ class CommandHandler:
             return
         user = self._require_connected(target)
         if user:
-            for cid in user:
+            async def send(cid: str):
                 c = self._sub(command, cid)
-                self._state.register_command(cid, c, "CMD", 1)
-                self._state.get_writer(cid).write(f"CMD:{c}\n".encode())
-                await self._drain(cid)
-            print(f" CMD → {target}")
+                await self._request(cid, "CMD:", c, c, "CMD", timeout)
+
+            self._report("CMD", await self._fanout.run(user, send))
 
     async def simpl(self, args: list):
         if len(args) < 1:
@@ -249,11 +293,11 @@ class CommandHandler:
             if not commands:
                 return
 
+        templ_name = args[1] if len(args) > 1 else "default"
         user = self._require_connected(args[0])
         if user:
-            for cid in user:
-                await self._send_simpl(cid, commands,args[1] if args[1] else "default")
-                print(f" {len(commands)} команд → {cid}")
+            results = await self._fanout.run(user, lambda cid: self._send_simpl(cid, commands, templ_name))
+            self._report(f"{len(commands)} команд", results)
 
     async def export(self, args: list):
         if len(args) < 2:
@@ -261,13 +305,14 @@ class CommandHandler:
             return
         user = self._require_connected(args[0])
         if user:
-            for cid in user:
+            dst = args[2] if len(args) > 2 else "received"
+
+            async def send(cid: str):
                 src = self._sub(args[1], cid)
-                dst = args[2] if len(args) > 2 else "received"
-                self._state.register_command(cid, f"export {src}", "EXPORT", 1)
-                self._state.get_writer(cid).write(f"EXPORT;{src};{dst}\n".encode())
-                await self._drain(cid)
-                print(f" Запрос экспорта → {cid}")
+                body = await FileTransfer.export_body(self._state, cid, src, dst)
+                await self._request(cid, "EXPORT;", body, f"export {src}", "EXPORT")
+
+            self._report("Запрос экспорта", await self._fanout.run(user, send))
 
     async def import_(self, args: list):
         if len(args) < 2:
@@ -276,14 +321,37 @@ class CommandHandler:
         target = args[0]
         src    = self._sched_mgr.sub_serv_path(args[1])
         dst    = args[2] if len(args) > 2 else "received"
-        sent   = 0
-        for cid in self._targets(target):
-            d = self._sub(dst, cid)
-            self._state.register_command(cid, f"import {src}", "IMPORT", 1)
-            await FileTransfer.send_to_client(cid, src, d, self._state)
-            self._state.unregister_command(cid)
-            sent += 1
-        print(f" Отправлено {sent} клиентам")
+
+        targets = self._targets(target)
+        if not targets:
+            print(" Пользователи не подключены")
+            return
+        # Нескольким клиентам — файлы читаются один раз на всех; обход дерева — в потоке
+        shared = await asyncio.to_thread(SharedSource, src, len(targets)) if len(targets) > 1 else None
+        if shared:
+            print(f" Рассылка {len(shared.files)} файлов ({shared.total / 1024 / 1024:.2f} MB) "
+                  f"→ {len(targets)} клиентов")
+
+        async def send(cid: str):
+            # Снимается по IMPORT:COMPLETE / IMPORT:ERROR с тем же ID
+            info = self._state.register_command(cid, f"import {src}", "IMPORT", 1)
+            try:
+                if not await FileTransfer.send_to_client(cid, src, self._sub(dst, cid),
+                                                         self._state, info.rid, shared):
+                    raise RuntimeError(f"IMPORT {src} не отправлен")
+            except asyncio.CancelledError:
+                # Поток оборван на середине файла — клиент не сможет его разобрать
+                self._state.unregister_command(cid, info.rid)
+                writer = self._state.get_writer(cid)
+                if writer:
+                    writer.close()
+                raise
+            except BaseException:
+                self._state.unregister_command(cid, info.rid)
+                raise
+
+        results = await self._fanout.run(targets, send, timeout=Config.FANOUT_FILE_TIMEOUT)
+        self._report("IMPORT", results)
 
     async def save(self, args: list):
         if len(args) < 2:
@@ -297,20 +365,21 @@ class CommandHandler:
         for cid in targets:
             real = self._resolve(cid) or cid
             out  = self._state.get_last_output(real)
-            if not out or not out.get("content"):
+            if out is None or not len(out):
                 print(f" Нет данных от {real}")
                 continue
-            cmd_info    = self._state.get_command(real)
-            command_str = cmd_info["command"] if cmd_info else "—"
+            command_str = out.command.command if out.command else "—"
             fname       = f"{filename}.txt" if target != "all" else f"{real}_save.txt"
             try:
                 mode = "a" if target == "all" else "w"
                 with open(Config.DIR_SAVE / fname, mode, encoding="utf-8") as f:
                     f.write(
                         f"Пользователь: {real}\nВремя: {now}\n"
-                        f"Тип: {out['type']}\nКоманда: {command_str}\n"
-                        f"{'=' * 50}\n{out['content']}\n"
+                        f"Тип: {out.type}\nКоманда: {command_str}\n"
+                        f"{'=' * 50}\n"
                     )
+                    SpillBuffer.dump(out, f)
+                    f.write("\n")
                 saved.append(real)
                 Logger.log("SAVE", f"→ {fname}", real)
             except Exception as e:
@@ -336,6 +405,72 @@ class CommandHandler:
         online = sum(1 for u in users.values() if u["status"] == "ON")
         print(f"{'=' * 134}\nВсего: {len(users)} | Онлайн: {online}\n")
 
+    def history(self, args: list):
+        if len(args) < 1:
+            print(f"Формат: {CMD_HINTS.get(ServerCmd.HISTORY,'Формат не найден!')}")
+            return
+        found = self._user_mgr.validate(args[0])
+        if not found:
+            print(f" '{args[0]}' не найден")
+            return
+        try:
+            since = self._history_bound(args[1], "00:00:00") if len(args) > 1 else None
+            until = self._history_bound(args[2], "23:59:59") if len(args) > 2 else None
+        except ValueError:
+            print(f"Формат: {CMD_HINTS.get(ServerCmd.HISTORY,'Формат не найден!')}")
+            return
+        sessions = self._user_mgr.get_sessions(found, since, until)
+        if not sessions:
+            print(" Нет сессий за период")
+            return
+        print(f"\n{'=' * 64}")
+        print(f"{'№':<6} {'Вход':<20} {'Выход':<20} {'Длительность':<14}")
+        print(f"{'=' * 64}")
+        for i, sess in enumerate(sessions, 1):
+            login, logout = sess["login"], sess["logout"]
+            spent = "—"
+            if logout:
+                secs  = int(time.mktime(time.strptime(logout, "%Y-%m-%d %H:%M:%S"))
+                            - time.mktime(time.strptime(login, "%Y-%m-%d %H:%M:%S")))
+                spent = f"{secs // 3600}:{secs % 3600 // 60:02}:{secs % 60:02}"
+            print(f"{i:<6} {login:<20} {logout or '—':<20} {spent:<14}")
+        print(f"{'=' * 64}\nВсего сессий: {len(sessions)}\n")
+
+    async def versions(self, args: list):
+        """Версии файлов из манифестов EXPORT (v8): у каких клиентов содержимое не как у всех."""
+        pattern = args[0] if args else ""
+        report  = await asyncio.to_thread(BlobStore.report, pattern)
+        ratio   = report["logical"] / report["stored"] if report["stored"] else 0
+        print(f"\n Хранилище: {report['blobs']} блобов, {report['stored'] / 1024 / 1024:.2f} MB; "
+              f"у {report['clients']} клиентов — {report['logical'] / 1024 / 1024:.2f} MB (x{ratio:.1f})")
+        if not report["files"]:
+            print(f" Нет файлов{f' с «{pattern}» в пути' if pattern else ''}\n")
+            return
+        shared = [(path, versions) for path, versions in sorted(report["files"].items())
+                  if sum(len(cids) for cids in versions.values()) > 1]
+        varied = [(path, versions) for path, versions in shared if len(versions) > 1]
+        if not varied:
+            print(f" Различий нет: {len(shared)} файлов одинаковы у всех клиентов\n")
+            return
+        print(f"{'=' * 80}")
+        print(f"{'Файл':<56} {'Версий':>8} {'Клиентов':>10}")
+        print(f"{'=' * 80}")
+        for path, versions in varied:
+            print(f"{path:<56} {len(versions):>8} {sum(len(c) for c in versions.values()):>10}")
+            for sha, cids in sorted(versions.items(), key=lambda v: -len(v[1])):
+                holders = f"уникальная: {cids[0]}" if len(cids) == 1 else f"{len(cids)} клиентов"
+                print(f"    {sha[:12]}  {holders}")
+        print(f"{'=' * 80}\nРазличаются: {len(varied)} из {len(shared)} общих файлов\n")
+
+    @staticmethod
+    def _history_bound(value: str, default_time: str) -> str:
+        """'YYYY-MM-DD' или 'YYYY-MM-DD_HH:MM:SS' → 'YYYY-MM-DD HH:MM:SS'"""
+        value = value.replace("_", " ")
+        if len(value) == 10:
+            value = f"{value} {default_time}"
+        time.strptime(value, "%Y-%m-%d %H:%M:%S")
+        return value
+
     def rename(self, args: list):
         if len(args) < 2:
             print(f"Формат: {CMD_HINTS.get(ServerCmd.RENAME,'Формат не найден!')}")
@@ -345,14 +480,11 @@ class CommandHandler:
         if not found:
             print(f" '{target}' не найден")
             return
-        users = self._user_mgr.get_users_data()
-        for uname, info in users.items():
-            if info["alias"] == new_alias and uname != found:
-                print(f" Alias '{new_alias}' уже занят")
-                return
-        old = users[found]["alias"]
-        users[found]["alias"] = new_alias
-        self._user_mgr.save_user_data(users)
+        try:
+            old = self._user_mgr.rename(found, new_alias)
+        except ValueError as e:
+            print(f" {e}")
+            return
         print(f" {found}: '{old}' → '{new_alias}'")
 
     def status(self, args: list):
@@ -361,25 +493,38 @@ class CommandHandler:
             print(" Нет активных команд")
             return
         print(f"\n{'=' * 80}\nАКТИВНЫЕ КОМАНДЫ\n{'=' * 80}")
-        for cid, info in cmds.items():
-            elapsed = time.time() - info["start_time"]
-            print(f"  {cid}: {info['type']} ({elapsed:.1f}s) — {info['command']}")
+        for cid, infos in cmds.items():
+            workers = self._state.get_workers(cid)
+            pool    = f" [пул {workers}]" if workers else ""
+            for info in infos:
+                elapsed = time.time() - info.start_time
+                print(f"  {cid}{pool} #{info.rid}: {info.type} ({elapsed:.1f}s) — {info.command}")
         print(f"{'=' * 80}\n")
 
     async def cancel(self, args: list):
-        if len(args) < 1:
+        if len(args) < 1 or (len(args) > 1 and not args[1].lstrip("#").isdigit()):
             print(f"Формат: {CMD_HINTS.get(ServerCmd.CANCEL,'Формат не найден!')}")
             return
-        target = args[0]
-        if self._state.has_command(target):
-            writer = self._state.get_writer(target)
-            if writer:
-                writer.write(b"CMD:CANCEL_MANUAL\n")
-                await self._drain(target)
-            self._state.unregister_command(target)
-            print(f" Отменено для {target}")
-        else:
+        target = self._resolve(args[0]) or args[0]
+        if not self._state.has_command(target):
             print(f" У {target} нет активных команд")
+            return
+        rid = int(args[1].lstrip("#")) if len(args) > 1 else None
+        if rid is not None and not self._state.get_command(target, rid):
+            print(f" У {target} нет команды #{rid}")
+            return
+        if rid is not None and not self._state.get_workers(target):
+            # Агент без пула не знает ID — отмена снимет всё, что он выполняет
+            print(f" {target}: агент без пула, отменяются все команды")
+            rid = None
+        if self._state.is_connected(target):
+            try:
+                await self._state.send(target, self._state.request(target, "CMD:", rid, "CANCEL_MANUAL")
+                                       if rid is not None else b"CMD:CANCEL_MANUAL\n")
+            except Exception as e:
+                print(f" Ошибка: {e}")
+        self._state.unregister_command(target, rid)
+        print(f" Отменено для {target}" + (f" #{rid}" if rid is not None else ""))
 
     async def kick(self, args: list):
         if len(args) < 1:
@@ -645,6 +790,31 @@ class CommandHandler:
         except Exception as e:
             print (f"Ошибка: {e}")
 
+    def template_mode(self, args: list) -> str:
+        """args[templ_name window|batch [timeout=N]]"""
+        if len(args) < 2:
+            print (f"Формат: {CMD_HINTS.get(ServerCmd.TEMPLATE_MODE,'Формат не найден!')}")
+            return
+        templ_name = args[0]
+        for mode in (a.lower() for a in args[1:]):
+            value = mode.split("=", 1)[1] if mode.startswith("timeout=") else None
+            try:
+                if mode == "batch":
+                    self._template.set_options(templ_name, batch=True)
+                    print (f"Шаблон '{templ_name}': пакетная отправка")
+                elif mode.isdigit() and int(mode) > 0:
+                    self._template.set_options(templ_name, window=int(mode), batch=False)
+                    print (f"Шаблон '{templ_name}': окно {mode} команд")
+                elif value and value.isdigit() and int(value) > 0:
+                    self._template.set_options(templ_name, timeout=int(value))
+                    print (f"Шаблон '{templ_name}': лимит {value}s")
+                else:
+                    print (f"Формат: {CMD_HINTS.get(ServerCmd.TEMPLATE_MODE,'Формат не найден!')}")
+                    return
+            except Exception as e:
+                print (f"Ошибка: {e}")
+                return
+
     def template_list(self, args: list) -> str:
         info = self._template.list_all_templates()
         if not info:
@@ -671,6 +841,8 @@ class ServerDispatcher:
             c.IMPORT:     h.import_,
             c.SAVE:       h.save,
             c.LIST:       s(h.list_users),
+            c.HISTORY:    s(h.history),
+            c.VERSIONS:   h.versions,
             c.RENAME:     s(h.rename),
             c.STATUS:     s(h.status),
             c.CANCEL:     h.cancel,
@@ -689,7 +861,8 @@ class ServerDispatcher:
             c.TEMPLATE_ADD: s (h.template_add),
             c.TEMPLATE_RM: s (h.template_rm),
             c.TEMPLATE_DEL: s (h.template_del),
-            c.TEMPLATE_LIST: s (h.template_list)
+            c.TEMPLATE_LIST: s (h.template_list),
+            c.TEMPLATE_MODE: s (h.template_mode),
         }
 
     async def dispatch(self, cmd: ServerCmd, args: list):
@@ -707,6 +880,9 @@ class ServerDispatcher:
 class ProtocolHandler:
     """Вся логика обработки входящих сообщений от конкретного клиента."""
 
+    # Чей вывод (клиент, ключ буфера) печатался последним — для повтора заголовка
+    _console_owner: Optional[tuple[str, int]] = None
+
     def __init__(self, client_id: str, state: ServerState,
                  user_mgr: UserManager, sched_mgr: ScheduledManager,
                  monitor: CommandMonitor):
@@ -718,130 +894,278 @@ class ProtocolHandler:
 
     # ── внутренние helpers ───────────────────────────────────────────────
 
-    def _writer(self) -> Optional[asyncio.StreamWriter]:
-        return self._state.get_writer(self._cid)
-
-    def _finish_command(self, combined: str):
+    def _request(self, payload: memoryview) -> tuple[int, memoryview]:
+        """
+        (ключ буфера, payload без метки). Агент с пулом помечает ответы
+        ID запроса; у агента без пула выводы идут по одному — ключ 0.
+        """
+        if self._state.get_workers(self._cid):
+            rid, rest = split_request_id(payload)
+            if rid is not None:
+                return rid, rest
+        return 0, payload
+
+    def _command_for(self, key: int, cmd_type: str) -> Optional[ActiveCommand]:
+        """Команда ответа: по ID запроса, а без ID — самая ранняя этого типа."""
+        if key:
+            return self._state.get_command(self._cid, key)
+        return self._state.oldest_command(self._cid, cmd_type)
+
+    def _open(self, payload: memoryview, buf_type: str, cmd_type: str):
+        """:START — буфер вывода и команда, которой он принадлежит."""
+        key, rest = self._request(payload)
+        cmd = self._command_for(key, cmd_type)
+        self._state.init_buffer(self._cid, key, buf_type, cmd, self._total(rest))
+
+    def _chunk(self, payload: memoryview, label: str):
+        key, rest = self._request(payload)
+        self._live(key, label, rest)
+        self._state.append_chunk(self._cid, key, rest)
+
+    def _close(self, payload: memoryview) -> tuple[Optional[ActiveCommand], Optional[SpillBuffer]]:
+        """:END — (команда, вывод). Команды нет, если её уже сняли (таймаут, cancel)."""
+        key, _ = self._request(payload)
+        buf    = self._state.get_buffer(self._cid, key)
+        if buf is None:
+            return None, None
+        output = self._state.flush_buffer(self._cid, key)
+        self._end_live(key, buf, output)
+        cmd = buf.command
+        if cmd is None or self._state.get_command(self._cid, cmd.rid) is not cmd:
+            return None, output
+        return cmd, output
+
+    def _finish_command(self, cmd: ActiveCommand, combined: SpillBuffer):
         """Сохраняет вывод, помечает отложенную команду и снимает регистрацию."""
-        cmd_info = self._state.get_command(self._cid)
-        if not cmd_info:
-            return
-        self._monitor.save_output(self._cid, cmd_info["command"], combined, cmd_info["type"])
-        if self._state.has_scheduled(self._cid):
-            idx = self._state.pop_scheduled(self._cid)
-            self._sched.mark_done(idx, self._cid, combined)
-        self._state.unregister_command(self._cid)
-        self._state.clear_buffer(self._cid)
+        self._monitor.save_output(self._cid, cmd.command, combined, cmd.type)
+        if cmd.scheduled is not None:
+            self._sched.mark_done(cmd.scheduled, self._cid, combined)
+        self._state.unregister_command(self._cid, cmd.rid)
 
-    def _accumulate(self, chunk: str) -> Optional[str]:
+    def _accumulate(self, cmd: ActiveCommand, output: SpillBuffer,
+                    separator: str = "") -> Optional[SpillBuffer]:
         """
-        Накапливает вывод в cmd_info.
-        Возвращает объединённый результат когда все чанки получены,
-        иначе None (для SIMPL — очищает lines для следующей итерации).
+        Накапливает вывод в cmd.
+        Возвращает объединённый результат когда все выводы получены, иначе None.
+        Единственный вывод не копируется — возвращается как есть.
         """
-        cmd_info = self._state.get_command(self._cid)
-        if not cmd_info:
-            return None
-        cmd_info["accumulated_output"].append(chunk)
-        cmd_info["received_commands"] += 1
-        if cmd_info["received_commands"] >= cmd_info["total_commands"]:
-            return "\n\n".join(cmd_info["accumulated_output"])
-        buf = self._state.get_buffer(self._cid)
-        if buf:
-            buf["lines"] = []
+        cmd.received_commands += 1
+        if cmd.total_commands == 1 and not separator:
+            return output
+        acc = cmd.accumulated_output
+        if acc is None:
+            acc = cmd.accumulated_output = self._state.spill_buffer(self._cid)
+        else:
+            acc.write("\n\n")
+        acc.write_from(output)
+        if separator:
+            acc.write(f"\n\n{separator}")
+        if cmd.received_commands >= cmd.total_commands:
+            return acc
         return None
 
-    def _print_output(self, label: str, text: str, comd="команда не указана'"):
-        print(f"\n{'=' * 80}\n[{label} от {self._cid} -> {comd}]\n{'=' * 80}\n{text}\n{'=' * 80}\n")
+    @staticmethod
+    def _total(payload: memoryview) -> int:
+        text = decode_payload(payload).strip()
+        return int(text) if text.isdigit() else 0
+
+    def _label(self, buf: OutputBuffer) -> str:
+        return f"{self._cid} #{buf.command.rid}" if buf.command else self._cid
+
+    def _live(self, key: int, label: str, payload: memoryview):
+        """
+        Печатает чанк сразу по приходу — вывод виден, пока команда ещё идёт.
+        Не больше OUTPUT_PRINT_LIMIT на вывод; если между чанками печатал
+        другой вывод (клиент или запрос), заголовок повторяется.
+        """
+        buf = self._state.get_buffer(self._cid, key)
+        if buf is None or buf.printed > Config.OUTPUT_PRINT_LIMIT:
+            return
+        owner = (self._cid, key)
+        if buf.printed == 0:
+            command = buf.command.command if buf.command else "—"
+            print(f"\n{'=' * 80}\n[{label} от {self._label(buf)} -> {command}]\n{'=' * 80}")
+        elif ProtocolHandler._console_owner != owner:
+            print(f"── {self._label(buf)} ──")
+        ProtocolHandler._console_owner = owner
+        room = Config.OUTPUT_PRINT_LIMIT - buf.printed
+        print(decode_payload(payload[:room]))
+        buf.printed += len(payload)
+        if buf.printed > Config.OUTPUT_PRINT_LIMIT:
+            buf.printed = Config.OUTPUT_PRINT_LIMIT + 1
+            print(f"... показано {Config.OUTPUT_PRINT_LIMIT // 1024} КБ, "
+                  f"полностью — save {self._cid} <файл>")
+
+    def _end_live(self, key: int, buf: OutputBuffer, output: SpillBuffer):
+        if ProtocolHandler._console_owner == (self._cid, key):
+            ProtocolHandler._console_owner = None
+        print(f"{'=' * 24} {self._label(buf)}: конец вывода, {len(output)} байт {'=' * 24}\n")
 
     # ── OUTPUT ───────────────────────────────────────────────────────────
 
-    async def on_output_start(self, payload: str):
-        self._state.init_buffer(self._cid, "OUTPUT", int(payload) if payload.isdigit() else 0)
+    async def on_output_start(self, payload: memoryview):
+        self._open(payload, "OUTPUT", "CMD")
 
-    def on_output_chunk(self, payload: str):
-        self._state.append_chunk(self._cid, payload.replace("<<<NL>>>", "\n"))
+    def on_output_chunk(self, payload: memoryview):
+        self._chunk(payload, "OUTPUT")
 
-    def on_output_end(self, _: str = ""):
-        output   = self._state.flush_buffer(self._cid)
-        cmd_info = self._state.get_command(self._cid)
-        self._print_output("OUTPUT", output,cmd_info['command'])
-        combined = self._accumulate(output)
-        if combined is not None:
-            self._finish_command(combined)
+    def on_output_end(self, payload: memoryview):
+        cmd, output = self._close(payload)
+        if cmd:
+            combined = self._accumulate(cmd, output)
+            if combined is not None:
+                self._finish_command(cmd, combined)
 
     # ── FILETRU ──────────────────────────────────────────────────────────
 
-    async def on_filetru_start(self, payload: str):
-        self._state.init_buffer(self._cid, "FILETRU", int(payload) if payload.isdigit() else 0)
-
-    def on_filetru_chunk(self, payload: str):
-        self._state.append_chunk(self._cid, payload.replace("<<<NL>>>", "\n"))
+    async def on_filetru_start(self, payload: memoryview):
+        self._open(payload, "FILETRU", "FILETRU")
 
-    def on_filetru_end(self, _: str = ""):
-        output   = self._state.flush_buffer(self._cid)
-        cmd_info = self._state.get_command(self._cid)
-        if cmd_info:
-            cmd_info["accumulated_output"].append(output)
-            cmd_info["accumulated_output"].append("-"*40)
+    def on_filetru_chunk(self, payload: memoryview):
+        self._chunk(payload, "FILETRU")
 
-            cmd_info["received_commands"] += 1
+    def on_filetru_end(self, payload: memoryview):
+        cmd, output = self._close(payload)
+        if cmd:
+            self._state.ack(self._cid, cmd.rid)
+            combined = self._accumulate(cmd, output, "-" * 40)
             Logger.log("DEBUG",
-                       f"FILETRU: {cmd_info['received_commands']}/{cmd_info['total_commands']}",
+                       f"FILETRU #{cmd.rid}: {cmd.received_commands}/{cmd.total_commands}, "
+                       f"{len(cmd.accumulated_output or output)} байт",
                        self._cid)
-
-            Logger.log("DEBUG",f"FILETRU:{cmd_info['accumulated_output']} >{cmd_info['received_commands']}")
-            if cmd_info["received_commands"] >= cmd_info["total_commands"]:
-                combined = "\n\n".join(cmd_info["accumulated_output"])
-                self._print_output("FILETRU", combined, cmd_info['command'])
-                self._finish_command(combined)
-        self._state.clear_buffer(self._cid)
+            if combined is not None:
+                print(f" [{self._cid} #{cmd.rid}] {cmd.command}: выполнено "
+                      f"{cmd.received_commands}/{cmd.total_commands}")
+                self._finish_command(cmd, combined)
 
     # ── EXPORT ───────────────────────────────────────────────────────────
 
-    async def on_export_start(self, payload: str, reader: asyncio.StreamReader):
+    async def on_export_start(self, payload: memoryview, codec: Codec):
         try:
-            meta     = json.loads(payload)
+            key, rest = self._request(payload)
+            meta     = json.loads(decode_payload(rest))
             count    = meta["count"]
             dest_dir = meta.get("dest_dir", "received")
             save_dir = Path(Config.DIR_FILES) / self._cid / dest_dir
-            writer   = self._writer()
-
-            print(f" Получение {count} файлов от {self._cid} → {save_dir}")
 
-            for _ in range(count):
-                meta_line = await asyncio.wait_for(reader.readline(), timeout=30)
-                meta_str  = meta_line.decode("utf-8", errors="?").strip()
-                if not meta_str.startswith("FILE:META:"):
-                    break
-                file_meta = json.loads(meta_str[10:])
-                save_path = save_dir / file_meta["rel_path"]
-                if not await FileTransfer.receive_file(reader, save_path, file_meta["size"]):
-                    if writer:
-                        writer.write(b"EXPORT:ABORT\n")
-                        await writer.drain()
-                    break
-
-            confirm = await asyncio.wait_for(reader.readline(), timeout=10)
-            if confirm.decode("utf-8", errors="ignore").strip() == "EXPORT:COMPLETE":
+            if count < 0:
+                print(f" Получение архива от {self._cid} → {save_dir}")
+            else:
+                print(f" Получение {count} файлов от {self._cid} → {save_dir}")
+
+            # v8: манифест пришёл раньше (on_export_manifest), агент шлёт только запрошенное
+            manifest, received = None, []
+            if meta.get("dedup"):
+                cmd = self._command_for(key, "EXPORT")
+                if not cmd or not cmd.manifest:
+                    raise ValueError("EXPORT без манифеста")
+                manifest, received = cmd.manifest
+
+            corrupt = []
+            if meta.get("mode") == "tar":
+                count = await FileTransfer.receive_archive(codec, save_dir, meta.get("compress", 0))
+            else:
+                for _ in range(count):
+                    meta_str  = await asyncio.wait_for(codec.read_line(), timeout=30)
+                    if not meta_str.startswith("FILE:META:"):
+                        break
+                    file_meta = json.loads(meta_str[10:])
+                    save_path = save_dir / file_meta["rel_path"]
+                    try:
+                        if not await FileTransfer.receive_file(codec, save_path, file_meta["size"], file_meta):
+                            await self._state.send(self._cid, b"EXPORT:ABORT\n")
+                            break
+                    except ChecksumError as e:
+                        Logger.log("ERROR", str(e), self._cid)
+                        corrupt.append(file_meta["rel_path"])
+
+            confirm = await asyncio.wait_for(codec.read_line(), timeout=10)
+            if confirm == "EXPORT:COMPLETE":
+                if manifest is not None:
+                    stored, linked, bad = await asyncio.to_thread(
+                        BlobStore.commit, self._cid, dest_dir, save_dir, manifest, received)
+                    corrupt = sorted(set(corrupt) | set(bad))
+                    count   = len(manifest)
+                    print(f"  хранилище: новых {stored / 1024 / 1024:.2f} MB, "
+                          f"по ссылкам {linked / 1024 / 1024:.2f} MB")
                 Logger.log("EXPORT", "✓ Завершён", self._cid)
-                if self._state.has_scheduled(self._cid):
-                    idx = self._state.pop_scheduled(self._cid)
-                    self._sched.mark_done(idx, self._cid, f"EXPORT: {count} файлов [OK]")
-                self._state.unregister_command(self._cid)
+                cmd = self._command_for(key, "EXPORT")
+                if cmd:
+                    if cmd.scheduled is not None:
+                        result = f"повреждены: {', '.join(corrupt)}" if corrupt else "[OK]"
+                        self._sched.mark_done(cmd.scheduled, self._cid, f"EXPORT: {count} файлов {result}")
+                    self._state.unregister_command(self._cid, cmd.rid)
 
         except Exception as e:
             Logger.log("ERROR", f"Ошибка EXPORT: {e}", self._cid)
 
+    async def on_export_manifest(self, payload: memoryview):
+        """v8: sha256 файлов до передачи — в ответ EXPORT:NEED, что прислать."""
+        key, rest = self._request(payload)
+        cmd = self._command_for(key, "EXPORT")
+        try:
+            manifest = json.loads(decode_payload(rest))
+            BlobStore.check(manifest)
+            if not cmd:
+                raise ValueError("нет команды EXPORT для манифеста")
+            need  = await asyncio.to_thread(BlobStore.missing, manifest)
+            reply = {"files": need, "mode": "tar" if len(need) >= Config.TAR_MIN_FILES else "files"}
+            cmd.manifest = (manifest, need)
+            print(f" {self._cid}: новых файлов {len(need)} из {len(manifest)}, остальные — из хранилища")
+        except ValueError as e:
+            Logger.log("ERROR", f"Манифест EXPORT: {e}", self._cid)
+            reply = {"error": str(e)}
+        # Не из цикла чтения: пока этому клиенту идёт IMPORT, его запись занята,
+        # а IMPORT:RESUME, которого ждёт IMPORT, читает как раз этот цикл
+        self._monitor.notify(self._cid, self._state.request(self._cid, "EXPORT:NEED:", key, json.dumps(reply)))
+
+    def on_export_error(self, payload: memoryview):
+        key, rest = self._request(payload)
+        Logger.log("ERROR", f"Экспорт: {decode_payload(rest)}", self._cid)
+        cmd = self._command_for(key, "EXPORT")
+        if cmd:
+            if cmd.scheduled is not None:
+                self._sched.mark_done(cmd.scheduled, self._cid, f"EXPORT: {decode_payload(rest)}")
+            self._state.unregister_command(self._cid, cmd.rid)
+
     # ── IMPORT ───────────────────────────────────────────────────────────
 
-    def on_import_complete(self, _: str = ""):
-        Logger.log("IMPORT", "✓ Завершён", self._cid)
-        self._state.unregister_command(self._cid)
+    def _import_done(self, key: int, result: str):
+        cmd = self._command_for(key, "IMPORT")
+        if cmd:
+            if cmd.scheduled is not None:
+                self._sched.mark_done(cmd.scheduled, self._cid, f"IMPORT: {result}")
+            self._state.unregister_command(self._cid, cmd.rid)
 
-    def on_import_error(self, payload: str):
-        Logger.log("ERROR", f"Импорт: {payload}", self._cid)
-        self._state.unregister_command(self._cid)
+    def on_import_complete(self, payload: memoryview):
+        key, _ = self._request(payload)
+        Logger.log("IMPORT", "✓ Завершён", self._cid)
+        self._import_done(key, "[OK]")
+
+    def on_import_error(self, payload: memoryview):
+        key, rest = self._request(payload)
+        Logger.log("ERROR", f"Импорт: {decode_payload(rest)}", self._cid)
+        self._import_done(key, decode_payload(rest))
+
+    def on_import_resume(self, payload: memoryview):
+        """v6: уже принятые агентом блоки — send_to_client ждёт их перед файлами."""
+        key, rest = self._request(payload)
+        cmd = self._command_for(key, "IMPORT")
+        if cmd and cmd.resume and not cmd.resume.done():
+            try:
+                cmd.resume.set_result(json.loads(decode_payload(rest)))
+            except ValueError:
+                cmd.resume.set_result({})
+
+    def on_import_signature(self, payload: memoryview):
+        """v7: подписи копий агента — по ним send_to_client считает дельту."""
+        key, rest = self._request(payload)
+        cmd = self._command_for(key, "IMPORT")
+        if cmd and cmd.signatures and not cmd.signatures.done():
+            try:
+                cmd.signatures.set_result(json.loads(decode_payload(rest)))
+            except ValueError:
+                cmd.signatures.set_result({})
 
 
 # ═══════════════════════════════════════════════════════════════════════════
@@ -851,32 +1175,35 @@ class ProtocolHandler:
 class ProtocolDispatcher:
     """
     Маршрутизирует ClientMsg → метод ProtocolHandler.
-    Единая точка входа: dispatch(msg_type, payload, reader).
+    Единая точка входа: dispatch(msg_type, payload, codec).
     """
 
     def __init__(self, handler: ProtocolHandler):
         h = handler
 
         self._async_handlers: Dict[ClientMsg, Callable] = {
-            ClientMsg.OUTPUT_START:  h.on_output_start,
-            ClientMsg.FILETRU_START: h.on_filetru_start,
+            ClientMsg.OUTPUT_START:    h.on_output_start,
+            ClientMsg.FILETRU_START:   h.on_filetru_start,
+            ClientMsg.EXPORT_MANIFEST: h.on_export_manifest,
         }
 
         self._sync_handlers: Dict[ClientMsg, Callable] = {
-            ClientMsg.OUTPUT_CHUNK:    h.on_output_chunk,
-            ClientMsg.OUTPUT_END:      h.on_output_end,
-            ClientMsg.FILETRU_CHUNK:   h.on_filetru_chunk,
-            ClientMsg.FILETRU_END:     h.on_filetru_end,
-            ClientMsg.IMPORT_COMPLETE: h.on_import_complete,
-            ClientMsg.IMPORT_ERROR:    h.on_import_error,
+            ClientMsg.OUTPUT_CHUNK:     h.on_output_chunk,
+            ClientMsg.OUTPUT_END:       h.on_output_end,
+            ClientMsg.FILETRU_CHUNK:    h.on_filetru_chunk,
+            ClientMsg.FILETRU_END:      h.on_filetru_end,
+            ClientMsg.IMPORT_COMPLETE:  h.on_import_complete,
+            ClientMsg.IMPORT_ERROR:     h.on_import_error,
+            ClientMsg.IMPORT_RESUME:    h.on_import_resume,
+            ClientMsg.IMPORT_SIGNATURE: h.on_import_signature,
+            ClientMsg.EXPORT_ERROR:     h.on_export_error,
         }
 
         self._handler = h
 
-    async def dispatch(self, msg_type: ClientMsg, payload: str,
-                       reader: asyncio.StreamReader):
+    async def dispatch(self, msg_type: ClientMsg, payload: memoryview, codec: Codec):
         if msg_type == ClientMsg.EXPORT_START:
-            await self._handler.on_export_start(payload, reader)
+            await self._handler.on_export_start(payload, codec)
 
         elif msg_type in self._async_handlers:
             await self._async_handlers[msg_type](payload)
@@ -1,8 +1,11 @@
 """
 Менеджеры состояния, данных и вспомогательных сервисов:
-  Logger, ServerState, UserManager, GroupManager,
-  ScheduledManager, FileTransfer, BanManager, CommandMonitor
+  Logger, ServerState, SpillBuffer, UserManager, GroupManager,
+  ScheduledManager, TemplateManager, SimplSender, FileTransfer, SharedSource,
+  ArchivePipe, DiskWriter, ReceivedFile, TransferJournal, Delta, BlobStore,
+  FanOut, BanManager, CommandMonitor
 """
+import codecs
 import hashlib
 import hmac
 import random
@@ -11,12 +14,24 @@ import time
 import os
 import re
 import json
+import mmap
+import queue
+import itertools
 import socket
+import atexit
+import shutil
+import tarfile
+import tempfile
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, Optional, Any
+from typing import Dict, Optional, Any, Callable, Awaitable, AsyncIterator, Iterator, TextIO
 
 
 from config import Config, ServerCmd, get_local_time
+from protocol import Codec
+from storage import open_store
 
 
 # ═══════════════════════════════════════════════════════════════════════════
@@ -24,6 +39,22 @@ from config import Config, ServerCmd, get_local_time
 # ═══════════════════════════════════════════════════════════════════════════
 
 class Logger:
+    """
+    log() не трогает диск: запись уходит в ограниченную очередь,
+    фоновый поток держит файл дня открытым и пишет пачками,
+    сбрасывая буфер раз в LOG_FLUSH_INTERVAL или по LOG_FLUSH_BYTES.
+    При переполнении DEBUG отбрасывается, остальные уровни ждут
+    LOG_BLOCK_TIMEOUT и только потом теряются (с учётом в счётчике).
+    После close() поток не перезапускается: запоздавшие записи
+    (отключения клиентов при остановке) пишутся в файл напрямую.
+    """
+
+    _queue:   "queue.Queue"               = queue.Queue(maxsize=Config.LOG_QUEUE_SIZE)
+    _thread:  Optional[threading.Thread]  = None
+    _lock                                 = threading.Lock()   # _thread, _closed, _dropped
+    _dropped: int                         = 0
+    _closed:  bool                        = False
+    _atexit:  bool                        = False
 
     @staticmethod
     def log(level: str, message: str, client_id: Optional[str] = None,
@@ -38,25 +69,162 @@ class Logger:
         entry += f" {message}\n"
         if show_console:
             print(entry.strip())
-        log_file = Config.DIR_LOGS / f"{local_time.strftime('%Y-%m-%d')}.log"
+        Logger._enqueue(level, (local_time.strftime('%Y-%m-%d'), entry))
+
+    @staticmethod
+    def flush(timeout: float = 5.0):
+        """Дожидается, пока всё поставленное в очередь окажется на диске."""
+        if Logger._thread is None or not Logger._thread.is_alive():
+            return
+        done = threading.Event()
+        try:
+            Logger._queue.put(done, timeout=timeout)
+        except queue.Full:
+            return
+        done.wait(timeout)
+
+    @staticmethod
+    def close(timeout: float = 5.0):
+        """Сбрасывает очередь и останавливает поток-писатель (из _cleanup)."""
+        with Logger._lock:
+            Logger._closed = True
+        thread = Logger._thread
+        if thread is None or not thread.is_alive():
+            return
+        try:
+            Logger._queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        thread.join(timeout)
+
+    # ── фоновый писатель ─────────────────────────────────────────────────
+
+    @staticmethod
+    def _enqueue(level: str, record: tuple):
+        with Logger._lock:
+            if Logger._closed:
+                Logger._write_direct(record)
+                return
+            if Logger._thread is None or not Logger._thread.is_alive():
+                Logger._start()
+            try:
+                Logger._queue.put_nowait(record)
+                return
+            except queue.Full:
+                if level in Config.LOG_DROP_LEVELS:
+                    Logger._dropped += 1
+                    return
+        # Место ждём без _lock: она нужна и писателю, который очередь разгружает
         try:
-            with open(log_file, "a", encoding="utf-8") as f:
+            Logger._queue.put(record, timeout=Config.LOG_BLOCK_TIMEOUT)
+        except queue.Full:
+            with Logger._lock:
+                Logger._dropped += 1
+
+    @staticmethod
+    def _start():
+        """Под Logger._lock."""
+        Logger._thread = threading.Thread(target=Logger._writer_loop,
+                                          name="log-writer", daemon=True)
+        Logger._thread.start()
+        if not Logger._atexit:
+            atexit.register(Logger.close)
+            Logger._atexit = True
+
+    @staticmethod
+    def _write_direct(record: tuple):
+        """После close(): без очереди, файл дня открывается на одну запись."""
+        day, entry = record
+        try:
+            with open(Config.DIR_LOGS / f"{day}.log", "a", encoding="utf-8") as f:
                 f.write(entry)
         except Exception:
             pass
 
+    @staticmethod
+    def _writer_loop():
+        day, f   = None, None
+        pending  = 0
+        deadline = time.monotonic() + Config.LOG_FLUSH_INTERVAL
+        running  = True
+
+        while running:
+            timeout = max(0.0, deadline - time.monotonic())
+            try:
+                batch = [Logger._queue.get(timeout=timeout)]
+            except queue.Empty:
+                batch = []
+            while batch and len(batch) < Config.LOG_BATCH_SIZE:
+                try:
+                    batch.append(Logger._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            waiters = []
+            for item in batch:
+                if item is None:
+                    running = False
+                    continue
+                if isinstance(item, threading.Event):
+                    waiters.append(item)
+                    continue
+                rec_day, entry = item
+                if rec_day != day:
+                    if f:
+                        f.close()
+                    day, f = rec_day, Logger._open(rec_day)
+                if f:
+                    try:
+                        f.write(entry)
+                        pending += len(entry)
+                    except Exception:
+                        pass
+
+            dropped = 0
+            if f:
+                with Logger._lock:
+                    dropped, Logger._dropped = Logger._dropped, 0
+            if dropped:
+                f.write(f"[{get_local_time():%Y-%m-%d %H:%M:%S}] [WARNING] "
+                        f"Очередь лога переполнена, потеряно записей: {dropped}\n")
+
+            now = time.monotonic()
+            if f and (waiters or not running or pending >= Config.LOG_FLUSH_BYTES or now >= deadline):
+                try:
+                    f.flush()
+                except Exception:
+                    pass
+                pending = 0
+            if now >= deadline:
+                deadline = now + Config.LOG_FLUSH_INTERVAL
+            for done in waiters:
+                done.set()
+
+        if f:
+            f.close()
+
+    @staticmethod
+    def _open(day: str):
+        try:
+            return open(Config.DIR_LOGS / f"{day}.log", "a", encoding="utf-8",
+                        buffering=Config.LOG_FLUSH_BYTES)
+        except Exception:
+            return None
+
     @staticmethod
     def crash(exc: Exception, tb: str, state: "ServerState"):
+        Logger.flush()
         ts   = get_local_time().strftime("%Y-%m-%d %H:%M:%S")
         cmds = state.get_all_commands()
         lines = [
             f"\n{'=' * 80}", f"КРИТИЧЕСКАЯ ОШИБКА: {ts}",
             f"{type(exc).__name__}: {exc}", f"{'=' * 80}", tb,
-            f"Клиентов: {len(state.get_all_clients())}  Команд: {len(cmds)}",
+            f"Клиентов: {len(state.get_all_clients())}  Команд: {sum(map(len, cmds.values()))}",
         ]
-        for cid, info in cmds.items():
-            elapsed = time.time() - info["start_time"]
-            lines.append(f"  {cid}: {info['type']} ({elapsed:.1f}s) — {info['command']}")
+        for cid, infos in cmds.items():
+            for info in infos:
+                elapsed = time.time() - info.start_time
+                lines.append(f"  {cid} #{info.rid}: {info.type} ({elapsed:.1f}s) — {info.command}")
         lines.append(f"{'=' * 80}\n")
         text = "\n".join(lines)
         try:
@@ -71,129 +239,570 @@ class Logger:
 # СОСТОЯНИЕ СЕРВЕРА
 # ═══════════════════════════════════════════════════════════════════════════
 
+class AckWindow:
+    """
+    Окно неподтверждённых команд SIMPL одного клиента.
+    acquire() занимает слот (ждёт, пока все заняты), каждый filetru:end
+    освобождает один. close() будит отправителя — acquire() вернёт False.
+    Отправитель у окна всегда один.
+    """
+
+    def __init__(self, size: int):
+        self._sem    = asyncio.Semaphore(max(1, size))
+        self._closed = False
+
+    async def acquire(self) -> bool:
+        if self._closed:
+            return False
+        await self._sem.acquire()
+        return not self._closed
+
+    def release(self):
+        if not self._closed:
+            self._sem.release()
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._sem.release()
+
+
+class SpillBuffer:
+    """
+    Вывод команды: bytearray в памяти, пока выводы клиента вместе
+    укладываются в Config.OUTPUT_SPILL_BYTES. Бюджет один на ClientSession:
+    параллельные выводы и накопленный SIMPL делят его, а буфер берёт его
+    порциями OUTPUT_SPILL_STEP — запись сверяет только свою квоту. Кому
+    порции не хватило, тот переезжает во временный файл в Config.DIR_SPILL
+    (файл создаётся только тогда). close() возвращает квоту и удаляет
+    файл. Читается кусками, целиком в строку не собирается.
+    bytearray появляется первой записью: пустой буфер почти ничего не стоит.
+    """
+
+    __slots__ = ("_mem", "_file", "_size", "_quota", "_owner")
+
+    def __init__(self, owner: "ClientSession"):
+        self._mem: Optional[bytearray] = None
+        self._file  = None
+        self._size  = 0      # байт в файле
+        self._quota = 0      # выданная буферу часть бюджета клиента
+        self._owner = owner
+
+    def __len__(self) -> int:
+        return self._size if self._mem is None else len(self._mem)
+
+    def write(self, data: str | bytes, sep: bytes = b""):
+        """sep — разделитель перед data (перевод строки между чанками)."""
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        mem = self._mem
+        if mem is None:
+            if self._file is not None:
+                self._file.write(sep)
+                self._file.write(data)
+                self._size += len(sep) + len(data)
+                return
+            mem = self._mem = bytearray()
+        mem += sep
+        mem += data
+        if len(mem) > self._quota:
+            self._grow()
+
+    def _grow(self):
+        owner = self._owner
+        step  = len(self._mem) - self._quota
+        if step < Config.OUTPUT_SPILL_STEP:
+            step = Config.OUTPUT_SPILL_STEP
+        if owner.output_ram + step <= Config.OUTPUT_SPILL_BYTES:
+            owner.output_ram += step
+            self._quota      += step
+            return
+        self._file = tempfile.TemporaryFile(dir=Config.DIR_SPILL)
+        self._file.write(self._mem)
+        self._size = len(self._mem)
+        self._mem  = None
+        owner.output_ram -= self._quota
+        self._quota = 0
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._owner.output_ram -= self._quota
+        self._quota = 0
+        self._mem   = None
+        self._size  = 0
+
+    def write_from(self, other: "SpillBuffer"):
+        for block in other._blocks():
+            self.write(block)
+
+    def _blocks(self) -> Iterator[bytes]:
+        """Запись идёт в конец файла без seek — чтение возвращает позицию на место."""
+        total = len(self)
+        pos   = 0
+        while pos < total:
+            size = min(Config.CHUNK_SIZE, total - pos)
+            if self._file is None:
+                block = bytes(self._mem[pos:pos + size])
+            else:
+                self._file.seek(pos)
+                block = self._file.read(size)
+                self._file.seek(0, os.SEEK_END)
+            if not block:
+                break
+            pos += len(block)
+            yield block
+
+    def chunks(self) -> Iterator[str]:
+        decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        for block in self._blocks():
+            yield decoder.decode(block)
+        yield decoder.decode(b"", final=True)
+
+    def preview(self, limit: int) -> str:
+        head = bytearray()
+        for block in self._blocks():
+            head += block
+            if len(head) >= limit:
+                break
+        return head[:limit].decode("utf-8", errors="replace")
+
+    def getvalue(self) -> str:
+        return "".join(self.chunks())
+
+    @staticmethod
+    def dump(output: "str | SpillBuffer", f: TextIO):
+        """Пишет вывод в текстовый файл: строку — как есть, буфер — кусками."""
+        if isinstance(output, SpillBuffer):
+            for chunk in output.chunks():
+                f.write(chunk)
+        else:
+            f.write(output)
+
+
+class ActiveCommand:
+    """
+    Выполняемая на клиенте команда (CMD / SIMPL / EXPORT / IMPORT).
+    rid — ID запроса: агент с пулом возвращает его в каждом ответе.
+    """
+
+    __slots__ = ("rid", "start_time", "command", "type", "total_commands",
+                 "received_commands", "accumulated_output", "timeout", "timers",
+                 "scheduled", "window", "resume", "signatures", "manifest", "output")
+
+    def __init__(self, rid: int, command: str, cmd_type: str, total_commands: int = 1,
+                 timeout: Optional[float] = None, scheduled: Optional[int] = None):
+        self.rid                = rid
+        self.start_time         = time.time()
+        self.command            = command
+        self.type               = cmd_type
+        self.total_commands     = total_commands
+        self.received_commands  = 0
+        self.accumulated_output: Optional[SpillBuffer] = None
+        self.timeout            = timeout or Config.COMMAND_TIMEOUT
+        self.timers: tuple[asyncio.TimerHandle, ...] = ()
+        self.scheduled          = scheduled      # индекс отложенной команды
+        self.window: Optional[AckWindow] = None  # окно подтверждений SIMPL
+        self.resume: Optional[asyncio.Future] = None      # IMPORT v6: ждёт IMPORT:RESUME агента
+        self.signatures: Optional[asyncio.Future] = None  # IMPORT v7: ждёт IMPORT:SIGNATURE
+        self.manifest: Optional[tuple[dict, list]] = None  # EXPORT v8: манифест и запрошенные файлы
+        self.output: Optional["OutputBuffer"] = None       # текущий вывод (ответ с ID запроса)
+
+    def close(self):
+        for handle in self.timers:
+            handle.cancel()
+        self.timers = ()
+        if self.window:
+            self.window.close()
+            self.window = None
+
+
+class OutputBuffer(SpillBuffer):
+    """
+    Текущий OUTPUT / FILETRU до :END: сами чанки (SpillBuffer) и чей это вывод.
+    На :END буфер целиком становится последним выводом клиента.
+    """
+
+    __slots__ = ("type", "command", "total", "printed")
+
+    def __init__(self, owner: "ClientSession", buf_type: Optional[str] = None,
+                 command: Optional[ActiveCommand] = None, total: int = 0):
+        self._mem    = None      # поля SpillBuffer — без вызова его __init__: буфер на каждый вывод
+        self._file   = None
+        self._size   = 0
+        self._quota  = 0
+        self._owner  = owner
+        self.type    = buf_type
+        self.command = command   # чей это вывод — определяется на :START
+        self.total   = total
+        self.printed = 0         # байт уже показано в консоли
+
+    def append(self, chunk: bytes | memoryview):
+        """Чанк вывода; между чанками — перевод строки."""
+        mem = self._mem
+        if mem is not None:
+            mem += b"\n"
+            mem += chunk
+        elif self._file is None:
+            mem = self._mem = bytearray(chunk)
+        else:
+            self.write(chunk, b"\n")
+            return
+        if len(mem) > self._quota:
+            self._grow()
+
+
+class ClientSession:
+    """
+    Всё, что сервер знает об одном клиенте. Переживает отключение,
+    пока есть незавершённые команды или последний вывод (для save).
+    workers — размер пула агента из handshake; 0 — агент без пула,
+    команды без ID, ответы по одному и сопоставляются по порядку.
+    Команды — по ID запроса; вывод команды лежит в ней самой (output).
+    buffers появляется по требованию: вывод агента без пула (ключ 0)
+    и вывод, чью команду уже сняли.
+    lock — очередь на запись в сокет: строка команды не должна попасть
+    внутрь байтов файла IMPORT. Создаётся первой записью.
+    output_ram — сколько бюджета выводов в памяти роздано буферам (SpillBuffer).
+    """
+
+    __slots__ = ("writer", "protocol", "workers", "buffers", "last_output", "commands", "lock",
+                 "output_ram")
+
+    def __init__(self):
+        self.writer:      Optional[asyncio.StreamWriter] = None
+        self.protocol     = 3
+        self.workers      = 0
+        self.buffers:     Optional[Dict[int, OutputBuffer]] = None
+        self.last_output: Optional[OutputBuffer]            = None
+        self.commands:    Dict[int, ActiveCommand]          = {}
+        self.lock:        Optional[asyncio.Lock]            = None
+        self.output_ram   = 0
+
+
 class ServerState:
 
     def __init__(self):
-        self._clients:            Dict[str, asyncio.StreamWriter] = {}
-        self._output_buffers:     Dict[str, Dict[str, Any]]       = {}
-        self._last_outputs:       Dict[str, Dict[str, Any]]       = {}
-        self._active_commands:    Dict[str, Dict[str, Any]]       = {}
-        self._scheduled_tracking: Dict[str, list]                 = {}
+        self._sessions: Dict[str, ClientSession] = {}
+        self._rids  = itertools.count(1)
+        self._dirty = False
+        # Вызываются таймерами команды: предупреждение и истечение лимита
+        self._on_warning: Optional[Callable[[str, ActiveCommand], None]] = None
+        self._on_timeout: Optional[Callable[[str, ActiveCommand], None]] = None
+
+    def _session(self, username: str) -> ClientSession:
+        session = self._sessions.get(username)
+        if session is None:
+            session = self._sessions[username] = ClientSession()
+        return session
+
+    def get_session(self, username: str) -> Optional[ClientSession]:
+        return self._sessions.get(username)
+
+    def _release(self, username: str, session: ClientSession):
+        if session.writer is None and not session.commands and session.last_output is None:
+            del self._sessions[username]
 
     # ── clients ──────────────────────────────────────────────────────────
 
-    def add_client(self, username: str, writer: asyncio.StreamWriter):
-        self._clients[username] = writer
-        self._output_buffers[username] = {"type": None, "lines": [], "chunks": 0, "total": 0}
+    def add_client(self, username: str, writer: asyncio.StreamWriter,
+                   protocol: int = 3, workers: int = 0):
+        session = self._session(username)
+        session.writer   = writer
+        session.protocol = protocol
+        session.workers  = workers
+        self._drop_buffers(session)
 
     def remove_client(self, username: str):
-        self._clients.pop(username, None)
-        self._output_buffers.pop(username, None)
-        self._scheduled_tracking.pop(username, None)
+        session = self._sessions.get(username)
+        if session is None:
+            return
+        for cmd in session.commands.values():
+            if cmd.window:
+                cmd.window.close()
+                cmd.window = None
+        session.writer  = None
+        self._drop_buffers(session)
+        self._release(username, session)
 
     def get_writer(self, username: str) -> Optional[asyncio.StreamWriter]:
-        return self._clients.get(username)
+        session = self._sessions.get(username)
+        return session.writer if session else None
+
+    def get_protocol(self, username: str) -> int:
+        session = self._sessions.get(username)
+        return session.protocol if session else 3
+
+    def get_workers(self, username: str) -> int:
+        session = self._sessions.get(username)
+        return session.workers if session else 0
 
     def get_all_clients(self) -> list:
-        return list(self._clients.keys())
+        return [u for u, session in self._sessions.items() if session.writer is not None]
 
     def is_connected(self, username: str) -> bool:
-        return username in self._clients
+        session = self._sessions.get(username)
+        return session is not None and session.writer is not None
+
+    def request(self, username: str, head: str, rid: int, body: str) -> bytes:
+        """
+        Строка команды клиенту; head — с разделителем ("CMD:", "EXPORT;").
+        Агенту с пулом — с ID запроса: CMD:@7:ls, EXPORT;@8:src;dst.
+        """
+        if self.get_workers(username):
+            return f"{head}@{rid}:{body}\n".encode()
+        return f"{head}{body}\n".encode()
+
+    async def send(self, username: str, data: bytes):
+        """Запись клиенту в очередь с остальными (см. exclusive)."""
+        session = self._sessions.get(username)
+        if session is None or session.writer is None:
+            raise ConnectionError(f"{username} не подключен")
+        async with self._lock(session):
+            session.writer.write(data)
+            await session.writer.drain()
+
+    def exclusive(self, username: str) -> asyncio.Lock:
+        """Держать, пока уходит многочастное сообщение (IMPORT) — send() подождёт."""
+        return self._lock(self._session(username))
+
+    @staticmethod
+    def _lock(session: ClientSession) -> asyncio.Lock:
+        if session.lock is None:
+            session.lock = asyncio.Lock()
+        return session.lock
 
     # ── output buffers ───────────────────────────────────────────────────
 
-    def init_buffer(self, username: str, buf_type: str, total: int = 0):
-        self._output_buffers[username] = {
-            "type": buf_type, "lines": [], "chunks": 0, "total": total
-        }
+    @staticmethod
+    def _discard(buf: Optional[OutputBuffer]):
+        if buf is not None:
+            buf.close()
 
-    def append_chunk(self, username: str, chunk: str):
-        buf = self._output_buffers.get(username)
-        if buf:
-            buf["lines"].append(chunk)
-            buf["chunks"] += 1
-
-    def get_buffer(self, username: str) -> Optional[Dict]:
-        return self._output_buffers.get(username)
-
-    def flush_buffer(self, username: str) -> str:
-        buf    = self._output_buffers.get(username, {})
-        result = "\n".join(buf.get("lines", []))
-        self._last_outputs[username] = {
-            "type":      buf.get("type"),
-            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
-            "content":   result,
-        }
-        if buf:
-            buf["lines"] = []
-        return result
+    @staticmethod
+    def _drop_buffers(session: ClientSession):
+        for cmd in session.commands.values():
+            ServerState._discard(cmd.output)
+            cmd.output = None
+        for buf in (session.buffers or {}).values():
+            ServerState._discard(buf)
+        session.buffers = None
 
-    def clear_buffer(self, username: str):
-        buf = self._output_buffers.get(username)
-        if buf:
-            buf.update({"type": None, "lines": [], "chunks": 0})
+    @staticmethod
+    def _buffer(session: ClientSession, key: int) -> Optional[OutputBuffer]:
+        if key:
+            cmd = session.commands.get(key)
+            if cmd is not None and cmd.output is not None:
+                return cmd.output
+        return session.buffers.get(key) if session.buffers else None
 
-    def get_last_output(self, username: str) -> Optional[Dict]:
-        return self._last_outputs.get(username)
+    @staticmethod
+    def _take(session: ClientSession, key: int) -> Optional[OutputBuffer]:
+        if key:
+            cmd = session.commands.get(key)
+            if cmd is not None and cmd.output is not None:
+                buf, cmd.output = cmd.output, None
+                return buf
+        if not session.buffers:
+            return None
+        buf = session.buffers.pop(key, None)
+        if not session.buffers:
+            session.buffers = None
+        return buf
+
+    def init_buffer(self, username: str, key: int, buf_type: str,
+                    command: Optional[ActiveCommand] = None, total: int = 0):
+        session = self._sessions.get(username) or self._session(username)
+        buf     = OutputBuffer(session, buf_type, command, total)
+        if key and command is not None and command.rid == key:
+            old, command.output = command.output, buf
+        else:
+            if session.buffers is None:
+                session.buffers = {}
+            old = session.buffers.get(key)
+            session.buffers[key] = buf
+        if old is not None:
+            old.close()
+
+    def spill_buffer(self, username: str) -> SpillBuffer:
+        """Пустой буфер вывода в бюджете клиента (накопленный SIMPL)."""
+        return SpillBuffer(self._session(username))
+
+    def append_chunk(self, username: str, key: int, chunk: bytes | memoryview):
+        session = self._sessions.get(username)
+        if session is None:
+            return
+        # Самый частый путь — без вызова _buffer
+        cmd = session.commands.get(key) if key else None
+        buf = cmd.output if cmd is not None else None
+        if buf is None and session.buffers:
+            buf = session.buffers.get(key)
+        if buf is not None:
+            buf.append(chunk)
+
+    def get_buffer(self, username: str, key: int) -> Optional[OutputBuffer]:
+        session = self._sessions.get(username)
+        return self._buffer(session, key) if session else None
+
+    def flush_buffer(self, username: str, key: int) -> SpillBuffer:
+        """Забирает накопленный вывод; он же становится последним выводом клиента."""
+        session = self._sessions.get(username) or self._session(username)
+        cmd     = session.commands.get(key) if key else None
+        buf     = cmd.output if cmd is not None else None
+        if buf is not None:
+            cmd.output = None
+        else:
+            buf = self._take(session, key)
+            if buf is None:
+                buf = OutputBuffer(session)
+        if session.last_output is not None:
+            session.last_output.close()
+        session.last_output = buf
+        return buf
+
+    def clear_buffer(self, username: str, key: int):
+        session = self._sessions.get(username)
+        if session:
+            self._discard(self._take(session, key))
+
+    def get_last_output(self, username: str) -> Optional[OutputBuffer]:
+        session = self._sessions.get(username)
+        return session.last_output if session else None
 
     # ── active commands ──────────────────────────────────────────────────
 
-    def register_command(self, username: str, command: str,
-                         cmd_type: str, cmd_count: int = 1):
-        self._active_commands[username] = {
-            "start_time":         time.time(),
-            "command":            command,
-            "type":               cmd_type,
-            "total_commands":     cmd_count,
-            "received_commands":  0,
-            "accumulated_output": [],
-        }
-        Logger.log("CMD_START", f"{cmd_type}: {command}", username, show_console=False)
-
-    def unregister_command(self, username: str):
-        info = self._active_commands.pop(username, None)
-        if info:
-            elapsed = time.time() - info["start_time"]
-            Logger.log("CMD_END", f"{info['type']} завершена за {elapsed:.1f}s",
+    def register_command(self, username: str, command: str, cmd_type: str,
+                         cmd_count: int = 1, timeout: Optional[float] = None,
+                         scheduled: Optional[int] = None) -> ActiveCommand:
+        """Новая команда клиента со своим ID; уже идущие команды не трогает."""
+        session = self._session(username)
+        cmd     = ActiveCommand(next(self._rids), command, cmd_type, cmd_count, timeout, scheduled)
+        session.commands[cmd.rid] = cmd
+        self._arm(username, cmd)
+        Logger.log("CMD_START", f"#{cmd.rid} {cmd_type}: {command}", username, show_console=False)
+        return cmd
+
+    def set_timeout_handlers(self, on_warning: Callable[[str, ActiveCommand], None],
+                             on_timeout: Callable[[str, ActiveCommand], None]):
+        self._on_warning = on_warning
+        self._on_timeout = on_timeout
+
+    def _arm(self, username: str, cmd: ActiveCommand):
+        """Ставит таймеры команды в очередь цикла событий: без опроса, точно в срок."""
+        if self._on_timeout is None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        now      = loop.time()
+        deadline = now + cmd.timeout
+        warn_at  = deadline - (Config.COMMAND_TIMEOUT - Config.WARNING_TIMEOUT)
+        timers   = [loop.call_at(deadline, self._on_timeout, username, cmd)]
+        if self._on_warning and warn_at > now:
+            timers.append(loop.call_at(warn_at, self._on_warning, username, cmd))
+        cmd.timers = tuple(timers)
+
+    def unregister_command(self, username: str, rid: Optional[int] = None):
+        """Снимает команду rid (None — все команды клиента) вместе с её буфером."""
+        session = self._sessions.get(username)
+        if session is None:
+            return
+        for key in (list(session.commands) if rid is None else [rid]):
+            info = session.commands.pop(key, None)
+            if info is None:
+                continue
+            info.close()
+            if info.accumulated_output is not None:
+                info.accumulated_output.close()
+            self._discard(info.output)
+            info.output = None
+            if session.buffers:
+                for bkey in [k for k, buf in session.buffers.items() if buf.command is info]:
+                    session.buffers.pop(bkey).close()
+                session.buffers = session.buffers or None
+            elapsed = time.time() - info.start_time
+            Logger.log("CMD_END", f"#{info.rid} {info.type} завершена за {elapsed:.1f}s",
                        username, show_console=False)
+        self._release(username, session)
+
+    def get_command(self, username: str, rid: int) -> Optional[ActiveCommand]:
+        session = self._sessions.get(username)
+        return session.commands.get(rid) if session else None
+
+    def oldest_command(self, username: str, cmd_type: str) -> Optional[ActiveCommand]:
+        """Самая ранняя команда типа — ей принадлежит ответ без ID."""
+        session = self._sessions.get(username)
+        if session:
+            for cmd in session.commands.values():
+                if cmd.type == cmd_type:
+                    return cmd
+        return None
 
-    def get_command(self, username: str) -> Optional[Dict]:
-        return self._active_commands.get(username)
+    def get_commands(self, username: str) -> list[ActiveCommand]:
+        session = self._sessions.get(username)
+        return list(session.commands.values()) if session else []
 
-    def get_all_commands(self) -> Dict:
-        return dict(self._active_commands)
+    def get_all_commands(self) -> Dict[str, list[ActiveCommand]]:
+        return {u: list(session.commands.values())
+                for u, session in self._sessions.items() if session.commands}
 
     def has_command(self, username: str) -> bool:
-        return username in self._active_commands
+        session = self._sessions.get(username)
+        return session is not None and bool(session.commands)
 
-    # ── scheduled tracking ───────────────────────────────────────────────
+    # ── окно подтверждений SIMPL ─────────────────────────────────────────
 
-    def push_scheduled(self, username: str, idx: int):
-        self._scheduled_tracking.setdefault(username, []).append(idx)
-
-    def pop_scheduled(self, username: str) -> Optional[int]:
-        q = self._scheduled_tracking.get(username)
-        return q.pop(0) if q else None
+    def open_window(self, username: str, rid: int, size: int) -> AckWindow:
+        """Окно команды rid; если команду уже сняли — сразу закрытое."""
+        window = AckWindow(size)
+        cmd    = self.get_command(username, rid)
+        if cmd is None:
+            window.close()
+        else:
+            if cmd.window:
+                cmd.window.close()
+            cmd.window = window
+        return window
 
-    def has_scheduled(self, username: str) -> bool:
-        return bool(self._scheduled_tracking.get(username))
+    def ack(self, username: str, rid: int):
+        cmd = self.get_command(username, rid)
+        if cmd and cmd.window:
+            cmd.window.release()
 
     # ── persistence ──────────────────────────────────────────────────────
 
+    def touch(self):
+        """Состояние изменилось: при WRITE_BEHIND запишет flush(), иначе сразу."""
+        if Config.WRITE_BEHIND:
+            self._dirty = True
+        else:
+            self.save()
+
+    def flush(self):
+        if self._dirty:
+            self.save()
+
     def save(self):
+        self._dirty = False
         try:
             data = {
                 "timestamp":        time.time(),
                 "datetime":          get_local_time().strftime("%Y-%m-%d %H:%M:%S"),
                 "connected_clients": self.get_all_clients(),
                 "active_commands": {
-                    cid: {
-                        "command":    info.get("command", "?"),
-                        "type":       info["type"],
-                        "start_time": info["start_time"],
-                        "elapsed":    time.time() - info["start_time"],
-                    }
-                    for cid, info in self._active_commands.items()
+                    cid: [
+                        {
+                            "id":         info.rid,
+                            "command":    info.command,
+                            "type":       info.type,
+                            "start_time": info.start_time,
+                            "elapsed":    time.time() - info.start_time,
+                        }
+                        for info in cmds
+                    ]
+                    for cid, cmds in self.get_all_commands().items()
                 },
             }
             with open(Config.FILE_STATE, "w", encoding="utf-8") as f:
@@ -213,6 +822,187 @@ class ServerState:
             return None
 
 
+# ═══════════════════════════════════════════════════════════════════════════
+# ИСТОРИЯ СЕССИЙ
+# ═══════════════════════════════════════════════════════════════════════════
+
+class SessionJournal:
+    """
+    Журнал входов/выходов: history/<user>.jsonl, строка на событие
+    {"ts": "YYYY-mm-dd HH:MM:SS", "event": "login"|"logout"}.
+    Строки только дописываются и идут по времени, поэтому выборка за
+    период находит начало бинарным поиском по смещению, не читая файл
+    целиком. Открытые сессии держатся в памяти, старое срезает compact().
+    """
+
+    LOGIN  = "login"
+    LOGOUT = "logout"
+    TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+    _BLOCK = 256
+
+    def __init__(self, directory: Optional[Path] = None):
+        self._dir = directory or Config.DIR_HISTORY
+        # username → время входа открытой сессии (None — открытой нет)
+        self._open: Dict[str, Optional[str]] = {}
+
+    def _path(self, username: str) -> Path:
+        return self._dir / f"{username}.jsonl"
+
+    # ── запись ───────────────────────────────────────────────────────────
+
+    def record(self, username: str, event: str, ts: Optional[str] = None):
+        ts     = ts or time.strftime(self.TIME_FORMAT)
+        opened = self._opened(username)
+        if event == self.LOGOUT and opened is None:
+            return
+        line = json.dumps({"ts": ts, "event": event}, separators=(",", ":"))
+        with open(self._path(username), "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+        self._open[username] = ts if event == self.LOGIN else None
+
+    def open_sessions(self) -> Dict[str, str]:
+        """Открытые сессии пользователей, затронутых с момента запуска."""
+        return {u: ts for u, ts in self._open.items() if ts}
+
+    def _opened(self, username: str) -> Optional[str]:
+        if username not in self._open:
+            self._import_legacy(username)
+            last = None
+            try:
+                with open(self._path(username), "rb") as f:
+                    _, last = self._event_before(f, f.seek(0, os.SEEK_END))
+            except FileNotFoundError:
+                pass
+            self._open[username] = last["ts"] if last and last["event"] == self.LOGIN else None
+        return self._open[username]
+
+    def _import_legacy(self, username: str):
+        """Однократно переносит старый history/<user>.json в журнал."""
+        old, path = self._dir / f"{username}.json", self._path(username)
+        if path.exists() or not old.exists():
+            return
+        try:
+            sessions = json.loads(old.read_text("utf-8")).get("sessions", [])
+        except Exception:
+            return
+        tmp = path.with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            for s in sessions:
+                for event in (self.LOGIN, self.LOGOUT):
+                    if s.get(event):
+                        f.write(json.dumps({"ts": s[event], "event": event},
+                                           separators=(",", ":")) + "\n")
+        tmp.replace(path)
+
+    # ── чтение ───────────────────────────────────────────────────────────
+
+    def sessions(self, username: str, since: Optional[str] = None,
+                 until: Optional[str] = None) -> list[Dict[str, Optional[str]]]:
+        """Сессии, пересекающие [since, until]: [{"login": ts, "logout": ts|None}]"""
+        self._opened(username)
+        try:
+            f = open(self._path(username), "rb")
+        except FileNotFoundError:
+            return []
+        result = []
+        with f:
+            offset = self._seek(f, since) if since else 0
+            _, prev = self._event_before(f, offset)
+            current = prev["ts"] if prev and prev["event"] == self.LOGIN else None
+            f.seek(offset)
+            for line in f:
+                ev = self._parse(line)
+                if ev is None:
+                    continue
+                if until and ev["ts"] > until:
+                    if current and ev["event"] == self.LOGOUT:
+                        result.append({"login": current, "logout": ev["ts"]})
+                        current = None
+                    break
+                if ev["event"] == self.LOGIN:
+                    if current:
+                        result.append({"login": current, "logout": None})
+                    current = ev["ts"]
+                elif current:
+                    result.append({"login": current, "logout": ev["ts"]})
+                    current = None
+        if current:
+            result.append({"login": current, "logout": None})
+        return result
+
+    def _seek(self, f, since: str) -> int:
+        """Смещение первой строки с ts >= since (бинарный поиск по байтам)."""
+        lo, hi = 0, f.seek(0, os.SEEK_END)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            f.seek(mid)
+            if mid:
+                f.readline()
+            line = f.readline()
+            ev   = self._parse(line)
+            if not line or (ev is not None and ev["ts"] >= since):
+                hi = mid
+            else:
+                lo = mid + 1
+        f.seek(lo)
+        if lo:
+            f.readline()
+        return f.tell()
+
+    def _event_before(self, f, offset: int) -> tuple[int, Optional[Dict]]:
+        """Строка, заканчивающаяся в offset: (её начало, событие)."""
+        start = offset
+        while start > 0:
+            start = max(0, start - self._BLOCK)
+            f.seek(start)
+            chunk = f.read(offset - start)
+            nl = chunk.rfind(b"\n", 0, len(chunk) - 1)
+            if nl >= 0:
+                return start + nl + 1, self._parse(chunk[nl + 1:])
+        if offset == 0:
+            return 0, None
+        f.seek(0)
+        return 0, self._parse(f.read(offset))
+
+    @staticmethod
+    def _parse(line: bytes) -> Optional[Dict]:
+        try:
+            ev = json.loads(line)
+            return ev if "ts" in ev and "event" in ev else None
+        except (ValueError, TypeError):
+            return None
+
+    # ── компакция ────────────────────────────────────────────────────────
+
+    def compact(self, username: str, before: str) -> int:
+        """Удаляет события раньше before, кроме входа ещё открытой на тот момент сессии."""
+        path = self._path(username)
+        with open(path, "rb") as f:
+            offset = self._seek(f, before)
+            start, prev = self._event_before(f, offset)
+            keep = start if prev and prev["event"] == self.LOGIN else offset
+            if keep == 0:
+                return 0
+            tmp = path.with_suffix(".tmp")
+            with open(tmp, "wb") as out:
+                f.seek(keep)
+                while chunk := f.read(Config.CHUNK_SIZE):
+                    out.write(chunk)
+        tmp.replace(path)
+        return keep
+
+    def compact_all(self, days: int = Config.HISTORY_RETENTION_DAYS) -> int:
+        """Компакция всех журналов. Возвращает число освобождённых байт."""
+        before = time.strftime(self.TIME_FORMAT, time.localtime(time.time() - days * 86400))
+        freed  = 0
+        for path in self._dir.glob("*.jsonl"):
+            try:
+                freed += self.compact(path.stem, before)
+            except Exception as e:
+                Logger.log("ERROR", f"Компакция истории {path.stem}: {e}", show_console=False)
+        return freed
+
+
 # ═══════════════════════════════════════════════════════════════════════════
 # ПОЛЬЗОВАТЕЛИ
 # ═══════════════════════════════════════════════════════════════════════════
@@ -229,24 +1019,38 @@ class UserManager:
 
     def __init__(self):
         self._cache: Optional[Dict] = None
+        self._store   = open_store("users")
+        self._journal = SessionJournal()
+        self._aliases:   Dict[str, str] = {}   # alias.lower() → username
+        self._alias_seq: Dict[str, int] = {}   # база алиаса → следующий суффикс
 
     def _load(self) -> Dict:
         if self._cache is None:
             try:
-                with open(Config.FILE_USERS, "r", encoding="utf-8") as f:
-                    self._cache = json.load(f)
+                self._cache = {"users": self._store.load()}
             except Exception:
                 self._cache = {"users": {}}
+            self._reindex()
         return self._cache
 
-    def _save(self) -> bool:
+    def _reindex(self):
+        """Перестраивает индекс алиасов по кэшу. Первый встреченный алиас выигрывает."""
+        self._aliases = {}
+        for uname, info in self._cache["users"].items():
+            self._aliases.setdefault(info["alias"].lower(), uname)
+
+    def _save(self, username: Optional[str] = None) -> bool:
+        """Без аргумента — все пользователи, иначе одна запись (удаление, если её нет)."""
         if self._cache is None:
             return False
+        users = self._cache["users"]
         try:
-            tmp = Config.FILE_USERS.with_suffix(".tmp")
-            with open(tmp, "w", encoding="utf-8") as f:
-                json.dump(self._cache, f, ensure_ascii=False, indent=2)
-            tmp.replace(Config.FILE_USERS)
+            if username is None:
+                self._store.replace(users)
+            elif username in users:
+                self._store.put(username, users[username])
+            else:
+                self._store.delete(username)
             return True
         except Exception as e:
             Logger.log("ERROR", f"Ошибка сохранения пользователей: {e}")
@@ -266,10 +1070,11 @@ class UserManager:
     def _make_alias(self, username: str, users: Dict) -> str:
         base  = self._transliterate(username)[:10]
         alias = base
-        n = 2
-        while alias in users:
+        n = self._alias_seq.get(base, 2)
+        while alias in users or alias.lower() in self._aliases:
             alias = f"{base}_{n}"
             n += 1
+        self._alias_seq[base] = n
         return alias
 
     def _validate_name(self, name: str) -> str:
@@ -290,13 +1095,13 @@ class UserManager:
         users    = self._load()["users"]
         now      = time.strftime("%Y-%m-%d %H:%M:%S")
 
-        for existing, info in users.items():
-            if info.get("default_path") == home_path and existing == username:
-                info.update({"status": "ON", "last_login": now})
-                self._save()
-                self._log_session(existing, "login")
-                Logger.log("INFO", f"Вход: {existing} ({info['alias']})")
-                return info["alias"]
+        info = users.get(username)
+        if info and info.get("default_path") == home_path:
+            info.update({"status": "ON", "last_login": now})
+            self._save(username)
+            self._log_session(username, "login")
+            Logger.log("INFO", f"Вход: {username} ({info['alias']})")
+            return info["alias"]
 
         alias = self._make_alias(username, users)
         users[alias] = {
@@ -304,7 +1109,8 @@ class UserManager:
             "default_path": home_path, "users_in_group": [],
             "last_login": now, "last_logout": None,
         }
-        self._save()
+        self._aliases.setdefault(alias.lower(), alias)
+        self._save(alias)
         self._log_session(alias, "login")
         Logger.log("INFO", f"Новый пользователь: {alias}")
         return alias
@@ -317,7 +1123,7 @@ class UserManager:
                 "status": "OFF",
                 "last_logout": time.strftime("%Y-%m-%d %H:%M:%S"),
             })
-            self._save()
+            self._save(username)
             self._log_session(username, "logout")
             Logger.log("INFO", f"Выход: {username}")
 
@@ -326,10 +1132,21 @@ class UserManager:
         users = self._load().get("users", {})
         if name in users:
             return name
-        for uname, info in users.items():
-            if info["alias"].lower() == name.lower():
-                return uname
-        return None
+        return self._aliases.get(name.lower())
+
+    def rename(self, username: str, alias: str) -> str:
+        """Меняет алиас клиента, возвращает старый. ValueError — алиас занят."""
+        info  = self._load()["users"][username]
+        owner = self._aliases.get(alias.lower())
+        if owner is not None and owner != username:
+            raise ValueError(f"Alias '{alias}' уже занят")
+        old = info["alias"]
+        if self._aliases.get(old.lower()) == username:
+            del self._aliases[old.lower()]
+        info["alias"] = alias
+        self._aliases[alias.lower()] = username
+        self._save(username)
+        return old
 
     # Алиас для обратной совместимости (использовался в resolve_and_check)
     def validate_users(self, name: str) -> Optional[str]:
@@ -355,31 +1172,25 @@ class UserManager:
                 raise ValueError(f"'{uname}': отсутствуют обязательные поля")
             if info["status"] not in ("ON", "OFF"):
                 raise ValueError(f"'{uname}': некорректный статус")
-        self._cache["users"] = user_data
+        self._load()["users"] = user_data
+        self._reindex()
         return self._save()
 
+    def get_sessions(self, username: str, since: Optional[str] = None,
+                     until: Optional[str] = None) -> list:
+        """Сессии клиента за период (границы — "YYYY-mm-dd HH:MM:SS")"""
+        return self._journal.sessions(username, since, until)
+
+    def compact_history(self) -> int:
+        """Срезает историю старше Config.HISTORY_RETENTION_DAYS"""
+        return self._journal.compact_all()
+
     def _log_session(self, username: str, action: str):
-        """Записывает время и дату входа/выхода клиента в ./history/.."""
-        alias        = self._load()["users"].get(username, {}).get("alias", username)
-        history_file = Config.DIR_HISTORY / f"{username}.json"
+        """Дописывает вход/выход клиента в журнал ./history/<user>.jsonl"""
         try:
-            history = json.loads(history_file.read_text("utf-8")) if history_file.exists() else \
-                      {"username": username, "alias": alias, "sessions": []}
-        except Exception:
-            history = {"username": username, "alias": alias, "sessions": []}
-
-        now = time.strftime("%Y-%m-%d %H:%M:%S")
-        if action == "login":
-            history["sessions"].append({"login": now, "logout": None})
-        elif action == "logout":
-            for s in reversed(history["sessions"]):
-                if s["logout"] is None:
-                    s["logout"] = now
-                    break
-        try:
-            history_file.write_text(json.dumps(history, ensure_ascii=False, indent=2), "utf-8")
+            self._journal.record(username, action)
         except Exception as e:
-            Logger.log("ERROR", f"История {alias}: {e}", show_console=False)
+            Logger.log("ERROR", f"История {username}: {e}", show_console=False)
 
 
 # ═══════════════════════════════════════════════════════════════════════════
@@ -392,24 +1203,24 @@ class GroupManager:
         self._cache:    Optional[Dict] = None
         self._user_mgr: UserManager    = user_mgr
         self._state = state
+        self._store = open_store("groups")
 
     def _load(self) -> Dict:
         if self._cache is None:
             try:
-                with open(Config.FILE_GROUPS, "r", encoding="utf-8") as f:
-                    self._cache = json.load(f)
+                self._cache = self._store.load()
             except Exception:
                 self._cache = {}
         return self._cache
 
-    def _save(self) -> bool:
+    def _save(self, group_name: str) -> bool:
         if self._cache is None:
             return False
         try:
-            tmp = Config.FILE_GROUPS.with_suffix(".tmp")
-            with open(tmp, "w", encoding="utf-8") as f:
-                json.dump(self._cache, f, ensure_ascii=False, indent=2)
-            tmp.replace(Config.FILE_GROUPS)
+            if group_name in self._cache:
+                self._store.put(group_name, self._cache[group_name])
+            else:
+                self._store.delete(group_name)
             return True
         except Exception as e:
             Logger.log("ERROR", f"Ошибка сохранения групп: {e}")
@@ -446,7 +1257,7 @@ class GroupManager:
         groups[group_name] = members
         self._cache = groups
         self._sync_users(group_name, members, add=True)
-        return self._save()
+        return self._save(group_name)
 
     def delete(self, group_name: str) -> bool:
         """Удаляет группу"""
@@ -456,7 +1267,7 @@ class GroupManager:
         self._sync_users(group_name, groups[group_name], add=False)
         del groups[group_name]
         self._cache = groups
-        return self._save()
+        return self._save(group_name)
 
     def add_users(self, group_name: str, users: list) -> list:
         """Добавляет пользователей в группу"""
@@ -469,7 +1280,7 @@ class GroupManager:
             else:
                 self._load()[group_name].append(user)
         self._sync_users(group_name, [u for u in users if u not in skipped], add=True)
-        self._save()
+        self._save(group_name)
         return skipped
 
     def remove_users(self, group_name: str, users: list) -> list:
@@ -484,7 +1295,7 @@ class GroupManager:
             else:
                 skipped.append(user)
         self._sync_users(group_name, [u for u in users if u not in skipped], add=False)
-        self._save()
+        self._save(group_name)
         return skipped
 
     def get_online_user(self, group_name: str) -> list:
@@ -510,25 +1321,25 @@ class ScheduledManager:
         self._cache:     Optional[Dict] = None
         self._user_mgr:  UserManager    = user_mgr
         self._group_mgr: GroupManager   = group_mgr
+        self._store = open_store("scheduled")
 
     def _load(self) -> Dict:
         if self._cache is None:
             try:
-                with open(Config.FILE_SCHEDULED, "r", encoding="utf-8") as f:
-                    self._cache = json.load(f)
-                self._cache.setdefault("completed", [])
+                self._cache = self._store.load()
             except Exception:
-                self._cache = {"commands": [], "completed": []}
+                self._cache = {}
+            self._cache.setdefault("commands", [])
+            self._cache.setdefault("completed", [])
         return self._cache
 
-    def _save(self) -> bool:
+    def _save(self, *sections: str) -> bool:
+        """Сохраняет разделы "commands" / "completed" (по умолчанию — активные)."""
         if self._cache is None:
             return False
         try:
-            tmp = Config.FILE_SCHEDULED.with_suffix(".tmp")
-            with open(tmp, "w", encoding="utf-8") as f:
-                json.dump(self._cache, f, ensure_ascii=False, indent=2)
-            tmp.replace(Config.FILE_SCHEDULED)
+            for section in sections or ("commands",):
+                self._store.put(section, self._cache[section])
             return True
         except Exception as e:
             Logger.log("ERROR", f"Ошибка сохранения отложенных команд: {e}")
@@ -589,7 +1400,7 @@ class ScheduledManager:
         cmds.pop(index)
         return self._save()
 
-    def mark_done(self, cmd_index: int, username: str, output: str) -> bool:
+    def mark_done(self, cmd_index: int, username: str, output: "str | SpillBuffer") -> bool:
         """Помечает отложеную команду выполненой"""
         cmds = self._load().get("commands", [])
         if cmd_index >= len(cmds):
@@ -603,9 +1414,10 @@ class ScheduledManager:
             cmd["completed_at"] = time.strftime("%Y-%m-%d %H:%M:%S")
             self._load()["completed"].append(cmd)
             cmds.pop(cmd_index)
+            return self._save("commands", "completed")
         return self._save()
 
-    def _write_output(self, target: str, username: str, output: str):
+    def _write_output(self, target: str, username: str, output: "str | SpillBuffer"):
         """Сохраняет вывод отложеной команды"""
         if target == "ALL":
             fname = "ALL.txt"
@@ -615,7 +1427,9 @@ class ScheduledManager:
             fname = f"{target}.txt"
         try:
             with open(Config.DIR_SCHEDULED_RESULTS / fname, "a", encoding="utf-8") as f:
-                f.write(f"{username}\n{output}\n\n\n")
+                f.write(f"{username}\n")
+                SpillBuffer.dump(output, f)
+                f.write("\n\n\n")
         except Exception as e:
             Logger.log("ERROR", f"Ошибка записи вывода: {e}")
 
@@ -644,24 +1458,24 @@ class TemplateManager:
 
     def __init__(self):
         self._cache = None
+        self._store = open_store("templates")
 
     def _load(self) -> Dict:
         if self._cache is None:
             try:
-                with open(Config.FILE_TEMPLATE, "r", encoding="utf-8") as f:
-                    self._cache = json.load(f)
+                self._cache = self._store.load()
             except Exception:
                 self._cache = {}
         return self._cache
 
-    def _save(self) -> bool:
+    def _save(self, name: str) -> bool:
         if self._cache is None:
             return False
         try:
-            tmp = Config.FILE_TEMPLATE.with_suffix(".tmp")
-            with open(tmp, "w", encoding="utf-8") as f:
-                json.dump(self._cache, f, ensure_ascii=False, indent=2)
-            tmp.replace(Config.FILE_TEMPLATE)
+            if name in self._cache:
+                self._store.put(name, self._cache[name])
+            else:
+                self._store.delete(name)
             return True
         except Exception as e:
             Logger.log("ERROR", f"Ошибка сохранения шаблонных команд: {e}")
@@ -671,7 +1485,33 @@ class TemplateManager:
         return list(self._load().keys())
 
     def get_comd_template_name(self,name)->list:
-            return self._load().get(name,[])
+        """Команды шаблона. Шаблон — список команд или {"commands": [...], "window", "batch"}"""
+        entry = self._load().get(name, [])
+        return entry["commands"] if isinstance(entry, dict) else entry
+
+    def get_options(self, name: str) -> Dict:
+        """Режим отправки шаблона: окно подтверждений, пакетная отправка, лимит времени"""
+        options = {"window": Config.SIMPL_WINDOW, "batch": False, "timeout": Config.COMMAND_TIMEOUT}
+        entry   = self._load().get(name)
+        if isinstance(entry, dict):
+            options.update({k: entry[k] for k in options if k in entry})
+        return options
+
+    def set_options(self, name: str, window: Optional[int] = None,
+                    batch: Optional[bool] = None, timeout: Optional[int] = None) -> bool:
+        data = self._load()
+        if name not in data:
+            raise KeyError(f"Шаблон '{name}' не найден")
+        entry = data[name]
+        if not isinstance(entry, dict):
+            entry = data[name] = {"commands": entry}
+        if window is not None:
+            entry["window"] = window
+        if batch is not None:
+            entry["batch"] = batch
+        if timeout is not None:
+            entry["timeout"] = timeout
+        return self._save(name)
 
     def check_template_name(self,name) -> bool:
         return name in self.get_all_template_name()
@@ -682,7 +1522,7 @@ class TemplateManager:
         if not isinstance(commands,list):
             raise TypeError("Команды должны быть типом list")
         self._load()[name]=commands
-        return self._save()
+        return self._save(name)
 
     def add_comd(self, name: str, commands: list) -> list:
         if name not in self.get_all_template_name():
@@ -699,7 +1539,7 @@ class TemplateManager:
             else:
                 command.append(c)
 
-        self._save()
+        self._save(name)
         return skipped
 
     def rm_comd(self, name: str, indices: list) -> str:
@@ -710,9 +1550,9 @@ class TemplateManager:
             indexes = [int (i) for i in indices]
         except ValueError:
             return "Индексы должны быть числами"
-        commands = data[name]
-        data[name] = [cmd for i, cmd in enumerate (commands) if i not in set (indexes)]
-        self._save ()
+        commands = self.get_comd_template_name(name)
+        commands[:] = [cmd for i, cmd in enumerate (commands) if i not in set (indexes)]
+        self._save (name)
 
         return len (indexes)
 
@@ -721,18 +1561,72 @@ class TemplateManager:
         if name not in data:
             raise KeyError(f"Шаблон '{name}' не найден")
         del data[name]
-        return self._save()
+        return self._save(name)
 
     def list_all_templates(self) -> str:
         data = self._load()
         if not data:
             return "Нет шаблонов"
         lines = [f"Шаблонов: {len(data)}"]
-        for name, comd in data.items():
-            lines.append(f"  {name} -> {', '.join(comd)}")
+        for name in data:
+            opts = self.get_options(name)
+            mode = "пакет" if opts["batch"] else f"окно {opts['window']}"
+            mode = f"{mode}, {opts['timeout']}s"
+            lines.append(f"  {name} [{mode}] -> {', '.join(self.get_comd_template_name(name))}")
         return "\n".join(lines)
 
 
+# ═══════════════════════════════════════════════════════════════════════════
+# ОТПРАВКА SIMPL
+# ═══════════════════════════════════════════════════════════════════════════
+
+class SimplSender:
+    """
+    Отправка команд SIMPL/шаблона одному клиенту.
+    Конвейер: не больше window команд без ответа, каждый filetru:end
+    открывает следующий слот (ServerState.ack).
+    Пакет: весь шаблон одним сообщением FILEBATCH — только клиентам v4.
+    Все команды шаблона идут под одним ID запроса rid.
+    """
+
+    @staticmethod
+    async def send(state: ServerState, client_id: str, rid: int, commands: list,
+                   window: int = Config.SIMPL_WINDOW, batch: bool = False):
+        """Весь шаблон — до последней команды (ждёт подтверждений)."""
+        rest = await SimplSender.start(state, client_id, rid, commands, window, batch)
+        if rest:
+            await rest
+
+    @staticmethod
+    async def start(state: ServerState, client_id: str, rid: int, commands: list,
+                    window: int = Config.SIMPL_WINDOW, batch: bool = False) -> Optional[asyncio.Task]:
+        """
+        Первое окно уходит сразу — ошибка отправки поднимается отсюда.
+        Остальное досылает возвращённая задача по мере подтверждений (None — досылать нечего).
+        """
+        if batch and state.get_protocol(client_id) >= 4:
+            await state.send(client_id, state.request(client_id, "FILEBATCH:", rid,
+                                                      json.dumps(commands, ensure_ascii=False)))
+            return None
+
+        acks  = state.open_window(client_id, rid, window)
+        first = min(max(1, window), len(commands))
+        for cmd in commands[:first]:
+            await acks.acquire()
+            await state.send(client_id, state.request(client_id, "FILETRU:", rid, cmd))
+        if first == len(commands):
+            return None
+        return asyncio.create_task(SimplSender._rest(state, client_id, rid, acks, commands[first:]))
+
+    @staticmethod
+    async def _rest(state: ServerState, client_id: str, rid: int, acks: AckWindow, commands: list):
+        for cmd in commands:
+            if not await acks.acquire():
+                Logger.log("WARNING", "SIMPL прерван: команда снята", client_id, show_console=False)
+                return
+            await state.send(client_id, state.request(client_id, "FILETRU:", rid, cmd))
+
+
     
 # class KeySigner:
 #     def __init__(self):
@@ -830,80 +1724,1247 @@ class FileTransfer:
 
     @staticmethod
     def list_files(path: Path) -> list:
-        if not path.exists():
-            return []
+        """Весь список сразу — только вне цикла событий (SharedSource строится в потоке)"""
+        return [fi for batch in FileTransfer.scan(path) for fi in batch]
+
+    @staticmethod
+    def scan(path: Path) -> Iterator[list]:
+        """
+        Обход каталога через os.scandir порциями по WALK_BATCH файлов.
+        Тип берётся из DirEntry без stat, размер — из DirEntry.stat():
+        один системный вызов на файл вместо двух у rglob + is_file + stat.
+        Как и rglob, в символические ссылки на каталоги не заходит.
+        """
         if path.is_file():
-            return [{"path": str(path), "rel_path": path.name, "size": path.stat().st_size}]
-        return [
-            {"path": str(f), "rel_path": str(f.relative_to(path)), "size": f.stat().st_size}
-            for f in path.rglob("*") if f.is_file()
-        ]
+            yield [{"path": str(path), "rel_path": path.name, "size": path.stat().st_size}]
+            return
+        if not path.is_dir():
+            return
+        batch = []
+        stack = [(str(path), "")]
+        while stack:
+            top, prefix = stack.pop()
+            try:
+                entries = os.scandir(top)
+            except OSError as e:
+                Logger.log("WARNING", f"Каталог пропущен: {e}", show_console=False)
+                continue
+            with entries:
+                for entry in entries:
+                    rel = os.path.join(prefix, entry.name)
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append((entry.path, rel))
+                        elif entry.is_file():
+                            batch.append({"path": entry.path, "rel_path": rel, "size": entry.stat().st_size})
+                    except OSError:
+                        continue
+                    if len(batch) >= Config.WALK_BATCH:
+                        yield batch
+                        batch = []
+        if batch:
+            yield batch
+
+    @staticmethod
+    async def walk(path: Path) -> AsyncIterator[list]:
+        """
+        scan() в рабочем потоке: цикл событий не стоит, пока обходится
+        большое дерево, а следующая порция читается, пока обрабатывается эта.
+        """
+        batches = FileTransfer.scan(path)
+        pending = asyncio.ensure_future(asyncio.to_thread(next, batches, None))
+        try:
+            while (batch := await asyncio.shield(pending)) is not None:
+                pending = asyncio.ensure_future(asyncio.to_thread(next, batches, None))
+                yield batch
+        finally:
+            # Генератор закрывается после шага в потоке — не посреди него
+            pending.add_done_callback(lambda f: f.cancelled() or f.exception() or batches.close())
 
     @staticmethod
-    async def send_file(writer: asyncio.StreamWriter, file_path: str,
-                        rel_path: str, size: int) -> bool:
+    async def send_file(writer: asyncio.StreamWriter, file_path: str, rel_path: str, size: int,
+                        tid: Optional[str] = None, offset: int = 0, sha=None) -> bool:
+        """
+        С tid (v6) META несёт tid и offset — данные идут с него (докачка),
+        FILE:END — sha256 всего файла. sha — хеш уже сверенного начала;
+        остаток досчитывается в потоке параллельно отправке: через sendfile
+        байты в Python не попадают.
+        """
+        meta   = {"rel_path": rel_path, "size": size}
+        digest = None
+        if tid:
+            meta.update(tid=tid, offset=offset)
+            digest = asyncio.ensure_future(asyncio.to_thread(
+                TransferJournal.digest, file_path, sha or hashlib.sha256(), offset))
         try:
-            writer.write(f"FILE:META:{json.dumps({'rel_path': rel_path, 'size': size})}\n".encode())
+            writer.write(f"FILE:META:{json.dumps(meta)}\n".encode())
             await writer.drain()
-            sent = 0
             with open(file_path, "rb") as f:
+                sent = await FileTransfer._sendfile(writer, f, rel_path, size, offset) if Config.SENDFILE else offset
+                # Без sendfile (TLS, не обычный файл) — чтение в Python с того же места
+                f.seek(sent)
                 while chunk := f.read(Config.CHUNK_SIZE):
                     writer.write(chunk)
                     await writer.drain()
                     sent += len(chunk)
                     print(f"\r  {rel_path}: {sent * 100 // size if size else 100}% ", end="", flush=True)
-            print(f"\r  {rel_path} ({size / 1024:.1f} KB)")
-            writer.write(b"FILE:END\n")
+            print(f"\r  {rel_path} ({size / 1024:.1f} KB)" + (f", с {offset / 1024 / 1024:.0f} MB" if offset else ""))
+            writer.write(f"FILE:END:{await digest}\n".encode() if digest else b"FILE:END\n")
             await writer.drain()
             return True
         except Exception as e:
             Logger.log("ERROR", f"Ошибка отправки {rel_path}: {e}")
             return False
+        finally:
+            if digest:
+                digest.cancel()
+
+    @staticmethod
+    async def _sendfile(writer: asyncio.StreamWriter, f, rel_path: str, size: int, offset: int = 0) -> int:
+        """
+        Отдаёт файл ядру кусками по SENDFILE_CHUNK начиная с offset. Возвращает,
+        докуда дошло; offset — транспорт sendfile не поддерживает, отправит обычный цикл.
+        """
+        loop = asyncio.get_running_loop()
+        sent = offset
+        while sent < size:
+            try:
+                n = await loop.sendfile(writer.transport, f, sent,
+                                        min(Config.SENDFILE_CHUNK, size - sent), fallback=False)
+            except asyncio.SendfileNotAvailableError:
+                break
+            if not n:
+                break
+            sent += n
+            print(f"\r  {rel_path}: {sent * 100 // size}% ", end="", flush=True)
+        return sent
+
+    @staticmethod
+    async def send_shared(writer: asyncio.StreamWriter, shared: "SharedSource", index: int) -> bool:
+        """
+        Файл из общего источника: те же страницы mmap, что и у остальных клиентов.
+        Каждый клиент идёт своим темпом; кто не принял ни байта за
+        BROADCAST_STALL — отключается, остальных он не задерживает.
+        """
+        fi = shared.files[index]
+        try:
+            view = shared.view(index)
+            writer.write(f"FILE:META:{json.dumps({'rel_path': fi['rel_path'], 'size': len(view)})}\n".encode())
+            for offset in range(0, len(view), Config.BROADCAST_CHUNK):
+                writer.write(view[offset:offset + Config.BROADCAST_CHUNK])
+                await asyncio.wait_for(writer.drain(), Config.BROADCAST_STALL)
+            writer.write(b"FILE:END\n")
+            await asyncio.wait_for(writer.drain(), Config.BROADCAST_STALL)
+            return True
+        except asyncio.TimeoutError:
+            # Файл оборван на середине — клиент не сможет разобрать поток дальше
+            Logger.log("WARNING", f"IMPORT: не принимает {Config.BROADCAST_STALL}s, отключён",
+                       show_console=False)
+            writer.close()
+            return False
+        except Exception as e:
+            Logger.log("ERROR", f"Ошибка отправки {fi['rel_path']}: {e}")
+            return False
+
+    # ── архивный режим (v5) ──────────────────────────────────────────────
+
+    @staticmethod
+    def use_archive(path: Path, files: list, protocol: int) -> bool:
+        """Каталог с множеством файлов — одним потоком tar, если клиент его понимает."""
+        return protocol >= 5 and path.is_dir() and len(files) >= Config.TAR_MIN_FILES
+
+    @staticmethod
+    async def send_archive(writer: asyncio.StreamWriter, files: list,
+                           more: Optional[AsyncIterator[list]] = None) -> bool:
+        """
+        IMPORT архивом: tarfile пакует в потоке, порции TAR:<n> уходят по мере готовности.
+        more — продолжение обхода: его порции попадают в архив, пока он уже идёт.
+        """
+        pipe  = ArchivePipe(asyncio.get_running_loop(), Config.TAR_COMPRESS)
+        todo  = queue.Queue()
+        todo.put(files)
+        feed  = asyncio.ensure_future(FileTransfer._feed(todo, more))
+        pack  = asyncio.ensure_future(asyncio.to_thread(
+            FileTransfer._pack, itertools.chain.from_iterable(iter(todo.get, None)), pipe))
+        sent  = 0
+        try:
+            while (chunk := await pipe.get()) is not None:
+                writer.write(f"TAR:{len(chunk)}\n".encode())
+                writer.write(chunk)
+                await writer.drain()
+                sent += len(chunk)
+                print(f"\r  архив: {sent / 1024 / 1024:.1f} MB ", end="", flush=True)
+            count = await pack
+            writer.write(b"TAR:0\n")
+            await writer.drain()
+            print(f"\r  архив: {count} файлов, {sent / 1024 / 1024:.2f} MB")
+            return True
+        except Exception as e:
+            Logger.log("ERROR", f"Ошибка отправки архива: {e}")
+            if not writer.is_closing():
+                writer.write(b"TAR:ABORT\n")
+            return False
+        finally:
+            feed.cancel()
+            todo.put(None)
+            pipe.abort()
+            # Обход и упаковщик дожидаются здесь: вызывающий после нас закрывает
+            # more, а исключение потока иначе осталось бы никем не полученным
+            await asyncio.gather(feed, pack, return_exceptions=True)
+
+    @staticmethod
+    async def _feed(todo: queue.Queue, more: Optional[AsyncIterator[list]]):
+        """
+        Порции обхода → очередь упаковщика; None в конце отпускает его в любом случае.
+        Начав обход, _feed им и владеет: закрывает его сам, в своей задаче.
+        """
+        try:
+            if more:
+                async for batch in more:
+                    todo.put(batch)
+        finally:
+            todo.put(None)
+            if more:
+                await more.aclose()
 
     @staticmethod
-    async def receive_file(reader: asyncio.StreamReader, dest: Path, size: int) -> bool:
+    async def receive_archive(codec: Codec, dest: Path, compress: int) -> int:
+        """
+        EXPORT архивом: порции TAR:<n> распаковываются в потоке на лету.
+        Если распаковка упала, поток всё равно дочитывается до TAR:0 —
+        иначе остаток архива приняли бы за сообщения клиента.
+        Возвращает число файлов.
+        """
+        pipe   = ArchivePipe(asyncio.get_running_loop(), compress)
+        unpack = asyncio.ensure_future(asyncio.to_thread(FileTransfer._unpack, pipe, dest))
+        received = 0
         try:
-            dest.parent.mkdir(parents=True, exist_ok=True)
-            received = 0
-            with open(dest, "wb") as f:
-                while received < size:
-                    chunk = await reader.read(min(Config.CHUNK_SIZE, size - received))
+            while True:
+                head = await asyncio.wait_for(codec.read_line(), timeout=30)
+                if head == "TAR:ABORT":
+                    raise ConnectionAbortedError("Клиент оборвал архив")
+                if not head.startswith("TAR:") or not head[4:].isdigit():
+                    raise ValueError(f"Ожидалась порция TAR, получено: {head[:60]}")
+                size = int(head[4:])
+                if not size:
+                    break
+                data = bytearray()
+                while len(data) < size:
+                    chunk = await codec.read_data(size - len(data))
                     if not chunk:
                         raise ConnectionError("Разрыв соединения")
-                    f.write(chunk)
-                    received += len(chunk)
-                    print(f"\r  {dest.name}: {received * 100 // size if size else 100}% ", end="", flush=True)
-            print(f"\r  {dest.name} ({size / 1024:.1f} KB)")
-            end = await reader.readline()
-            if not end.decode("utf-8", errors="ignore").strip().startswith("FILE:END"):
+                    data += chunk
+                received += size
+                print(f"\r  архив: {received / 1024 / 1024:.1f} MB ", end="", flush=True)
+                if not unpack.done():
+                    await pipe.put(bytes(data))
+            await pipe.put(None)
+            count = await unpack
+            print(f"\r  архив: {count} файлов, {received / 1024 / 1024:.2f} MB")
+            return count
+        finally:
+            pipe.abort()
+
+    @staticmethod
+    def _pack(files: Iterator[dict], pipe: "ArchivePipe") -> int:
+        count = 0
+        try:
+            with tarfile.open(fileobj=pipe, mode="w|") as tar:
+                for fi in files:
+                    with open(fi["path"], "rb") as f:
+                        tar.addfile(FileTransfer.tar_info(fi["rel_path"], os.fstat(f.fileno())), f)
+                    count += 1
+            return count
+        finally:
+            pipe.finish()
+
+    @staticmethod
+    def tar_info(rel_path: str, st: os.stat_result) -> tarfile.TarInfo:
+        """
+        Заголовок без владельца и дробного mtime: tar.add ищет имена
+        пользователя/группы и пишет PAX-заголовок на каждый файл —
+        на десятках тысяч мелких файлов это дольше самих данных.
+        """
+        info       = tarfile.TarInfo(Path(rel_path).as_posix())
+        info.size  = st.st_size
+        info.mtime = int(st.st_mtime)
+        info.mode  = st.st_mode & 0o777
+        return info
+
+    @staticmethod
+    def _unpack(pipe: "ArchivePipe", dest: Path) -> int:
+        """Только обычные файлы, внутри dest — как и в пофайловом режиме."""
+        count = 0
+        made  = set()
+        try:
+            with tarfile.open(fileobj=pipe, mode="r|") as tar:
+                for member in tar:
+                    if not member.isfile():
+                        continue
+                    rel = Path(member.name)
+                    if rel.is_absolute() or ".." in rel.parts:
+                        raise ValueError(f"Недопустимый путь в архиве: {member.name}")
+                    path = dest / rel
+                    if path.parent not in made:
+                        path.parent.mkdir(parents=True, exist_ok=True)
+                        made.add(path.parent)
+                    BlobStore.detach(path)
+                    with open(path, "wb") as f:
+                        shutil.copyfileobj(tar.extractfile(member), f)
+                        if Config.FSYNC != "never":
+                            DiskWriter.fsync(f)
+                    count += 1
+            # Хвост записи tar после конца архива
+            while pipe.read(Config.TAR_CHUNK):
+                pass
+            return count
+        except BaseException:
+            pipe.abort_threadsafe()
+            raise
+
+    @staticmethod
+    async def receive_file(codec: Codec, dest: Path, size: int,
+                           file_meta: Optional[dict] = None) -> bool:
+        """
+        Сеть читается в цикле событий, на диск пишет DiskWriter в пуле потоков.
+        file_meta с tid (v6) — докачка с offset и сверка sha256 из FILE:END.
+        False — поток оборван; ChecksumError — файл дошёл, но не совпал
+        (поток цел, следующие файлы принимать можно).
+        """
+        file_meta = file_meta or {}
+        offset    = file_meta.get("offset", 0)
+        disk      = DiskWriter(ReceivedFile(dest, size, file_meta.get("tid"),
+                                            file_meta.get("rel_path", dest.name), offset))
+        try:
+            await disk.open()
+            received = offset
+            while received < size:
+                chunk = await codec.read_data(min(Config.CHUNK_SIZE, size - received))
+                if not chunk:
+                    raise ConnectionError("Разрыв соединения")
+                received += len(chunk)
+                if await disk.write(chunk):
+                    print(f"\r  {dest.name}: {received * 100 // size}% ", end="", flush=True)
+            end = await codec.read_line()
+            if not end.startswith("FILE:END"):
                 Logger.log("WARNING", "Неожиданный маркер", show_console=False)
+            if not await disk.close(end[9:] or None):
+                raise ChecksumError(f"{dest.name}: контрольная сумма не совпала, файл удалён")
+            print(f"\r  {dest.name} ({size / 1024:.1f} KB)" + (f", с {offset / 1024 / 1024:.0f} MB" if offset else ""))
             return True
+        except ChecksumError:
+            raise
         except Exception as e:
             Logger.log("ERROR", f"Ошибка получения: {e}")
             return False
+        finally:
+            await disk.abort()
 
     @staticmethod
     async def send_to_client(client_id: str, source: str, dest: str,
-                             state: "ServerState") -> bool:
-        writer = state.get_writer(client_id)
-        if not writer:
-            return False
-        path  = Path(source)
-        files = FileTransfer.list_files(path)
-        if not files:
-            print(f" Нет файлов: {source}")
-            return False
-        meta = {"count": len(files), "dest_dir": dest, "source": path.name}
-        writer.write(f"IMPORT:START:{json.dumps(meta)}\n".encode())
-        await writer.drain()
-        total = sum(f["size"] for f in files)
-        print(f" Отправка {len(files)} файлов ({total / 1024 / 1024:.2f} MB)")
-        for fi in files:
-            if not await FileTransfer.send_file(writer, fi["path"], fi["rel_path"], fi["size"]):
+                             state: "ServerState", rid: int,
+                             shared: Optional["SharedSource"] = None) -> bool:
+        """
+        IMPORT целиком под exclusive(): команды другим запросам этого
+        клиента ждут конца файлов, а не попадают в их байты.
+        С shared — рассылка: файлы берутся из общего SharedSource.
+        Без него каталог обходится в потоке (walk): архив начинает уходить
+        с первой порцией, count в meta тогда -1 — клиент считает файлы сам.
+        """
+        path = Path(source)
+        walk = None if shared else FileTransfer.walk(path)
+        try:
+            if shared:
+                files = shared.files
+            else:
+                # Первых порций хватает, чтобы выбрать режим; для пофайлового нужен весь список
+                files = []
+                async for batch in walk:
+                    files += batch
+                    if len(files) >= Config.TAR_MIN_FILES:
+                        break
+            if not files:
+                print(f" Нет файлов: {source}")
                 return False
+            archive = not shared and FileTransfer.use_archive(path, files, state.get_protocol(client_id))
+            if archive:
+                meta = {"count": -1, "dest_dir": dest, "source": path.name,
+                        "mode": "tar", "compress": Config.TAR_COMPRESS}
+            else:
+                if not shared:
+                    async for batch in walk:
+                        files += batch
+                meta = {"count": len(files), "dest_dir": dest, "source": path.name}
+                if not shared and state.get_protocol(client_id) >= 6:
+                    meta["resume"] = True
+            sigs = {}
+            if not archive and not shared and state.get_protocol(client_id) >= 7:
+                delta = [fi["rel_path"] for fi in files if fi["size"] >= Config.DELTA_MIN_SIZE]
+                if delta:
+                    sigs = await FileTransfer._signatures(client_id, state, rid, dest, len(files), delta)
+            return await FileTransfer._send_import(client_id, state, rid, meta, files,
+                                                   walk if archive else None, shared, sigs)
+        finally:
+            # Обход, отданный архиву, закрывает _feed; здесь — только тот, что никем не занят
+            if walk and not walk.ag_running:
+                await walk.aclose()
+
+    @staticmethod
+    async def _signatures(client_id: str, state: "ServerState", rid: int,
+                          dest: str, count: int, delta: list) -> dict:
+        """
+        v7: подписи копий агента — до IMPORT:START и без exclusive(): агент
+        считает их в отдельном потоке, а соединение тем временем свободно
+        для других команд и CANCEL. Не дождались — файлы идут целиком.
+        """
+        cmd = state.get_command(client_id, rid)
+        if not cmd:
+            return {}
+        cmd.signatures = asyncio.get_running_loop().create_future()
+        body = json.dumps({"dest_dir": dest, "count": count, "files": delta})
+        await state.send(client_id, state.request(client_id, "IMPORT:SIGN:", rid, body))
+        return await FileTransfer._reply(client_id, cmd.signatures, Config.DELTA_TIMEOUT, {})
+
+    @staticmethod
+    async def _send_import(client_id: str, state: "ServerState", rid: int, meta: dict,
+                           files: list, more: Optional[AsyncIterator[list]],
+                           shared: Optional["SharedSource"], sigs: Optional[dict] = None) -> bool:
+        sent = 0
+        try:
+            async with state.exclusive(client_id):
+                writer = state.get_writer(client_id)
+                if not writer:
+                    return False
+                cmd  = state.get_command(client_id, rid)
+                loop = asyncio.get_running_loop()
+                if meta.get("resume") and cmd:
+                    cmd.resume = loop.create_future()
+                writer.write(state.request(client_id, "IMPORT:START:", rid, json.dumps(meta)))
+                await writer.drain()
+                if shared:
+                    for sent in range(len(files)):
+                        if not await FileTransfer.send_shared(writer, shared, sent):
+                            return False
+                        shared.release(sent)
+                    sent = len(files)
+                    return True
+                if meta.get("mode") == "tar":
+                    print(f" Отправка архивом: {meta['source']}")
+                    if not await FileTransfer.send_archive(writer, files, more):
+                        return False
+                else:
+                    total = sum(f["size"] for f in files)
+                    print(f" Отправка {len(files)} файлов ({total / 1024 / 1024:.2f} MB)")
+                    # v6: агент сначала сообщает, что у него уже принято; IMPORT:START
+                    # уже ушёл — без ответа файлы всё равно идут, с нуля
+                    table = (await FileTransfer._reply(client_id, cmd.resume, 30, {})
+                             if cmd and cmd.resume else None)
+                    sigs  = sigs or {}
+                    for fi in files:
+                        if fi["rel_path"] in sigs and not (table or {}).get(fi["rel_path"]):
+                            delta = await asyncio.to_thread(Delta.encode, fi["path"], sigs[fi["rel_path"]])
+                            if delta:
+                                if not await FileTransfer.send_delta(writer, fi, sigs[fi["rel_path"]]["block"], delta):
+                                    return False
+                                continue
+                        if not await FileTransfer._send_verified(writer, fi, table):
+                            return False
+        finally:
+            if shared:
+                shared.leave(sent)
         print(" Ожидание подтверждения...")
         return True
 
+    @staticmethod
+    async def _reply(client_id: str, future: asyncio.Future, timeout: float, default: Any) -> Any:
+        """Ответ агента на IMPORT:START (RESUME / SIGNATURE); не дождались — default."""
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            Logger.log("WARNING", f"Агент не ответил за {timeout:.0f}s — передача без докачки/дельты", client_id)
+            return default
+
+    @staticmethod
+    async def _send_verified(writer: asyncio.StreamWriter, fi: dict, table: Optional[dict]) -> bool:
+        """table — журналы приёмника (v6): файл с sha256 и, если есть что, с докачкой; None — как раньше."""
+        if table is None:
+            return await FileTransfer.send_file(writer, fi["path"], fi["rel_path"], fi["size"])
+        tid    = TransferJournal.tid(fi["path"], fi["rel_path"])
+        entry  = table.get(fi["rel_path"])
+        offset = 0
+        sha    = None
+        if entry and entry.get("tid") == tid:
+            offset, sha = await asyncio.to_thread(TransferJournal.resume_offset, fi["path"], entry)
+        return await FileTransfer.send_file(writer, fi["path"], fi["rel_path"], fi["size"], tid, offset, sha)
+
+    @staticmethod
+    async def send_delta(writer: asyncio.StreamWriter, fi: dict, block: int,
+                         delta: tuple[list, int, str]) -> bool:
+        """Файл дельтой к копии агента: DELTA:COPY / DELTA:DATA, конец — FILE:END:<sha256>."""
+        ops, literal, digest = delta
+        rel_path = fi["rel_path"]
+        try:
+            meta = {"rel_path": rel_path, "size": fi["size"], "delta": block}
+            writer.write(f"FILE:META:{json.dumps(meta)}\n".encode())
+            with open(fi["path"], "rb") as f:
+                for op, start, end in ops:
+                    if op == "copy":
+                        writer.write(f"DELTA:COPY:{start}:{end - start}\n".encode())
+                        continue
+                    f.seek(start)
+                    while start < end:
+                        chunk = f.read(min(Config.CHUNK_SIZE, end - start))
+                        writer.write(f"DELTA:DATA:{len(chunk)}\n".encode())
+                        writer.write(chunk)
+                        await writer.drain()
+                        start += len(chunk)
+            writer.write(f"FILE:END:{digest}\n".encode())
+            await writer.drain()
+            print(f"\r  {rel_path} ({fi['size'] / 1024:.1f} KB), дельта: {literal / 1024:.1f} KB новых данных")
+            return True
+        except Exception as e:
+            Logger.log("ERROR", f"Ошибка отправки {rel_path}: {e}")
+            return False
+
+    @staticmethod
+    async def export_body(state: "ServerState", client_id: str, src: str, dst: str) -> str:
+        """Тело запроса EXPORT; агенту v6 — с журналами докачки из папки приёма."""
+        if state.get_protocol(client_id) < 6:
+            return f"{src};{dst}"
+        save_dir = Path(Config.DIR_FILES) / client_id / dst
+        table    = await asyncio.to_thread(TransferJournal.table, save_dir)
+        return f"{src};{dst};{json.dumps(table)}"
+
+
+class ArchivePipe:
+    """
+    Мост между tarfile в рабочем потоке и соединением в asyncio.
+    Очередь на несколько порций TAR_CHUNK: быстрая сторона ждёт медленную,
+    в памяти держится не больше depth порций. Сжатие gzip — тоже в потоке.
+    abort() отпускает поток, если соединение или распаковка оборвались.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, compress: int = 0, depth: int = 4):
+        self._loop    = loop
+        self._queue: asyncio.Queue = asyncio.Queue(depth)
+        self._buf     = bytearray()
+        self._eof     = False
+        self._aborted = False
+        self._zip     = zlib.compressobj(compress, wbits=31) if compress else None
+        self._unzip   = zlib.decompressobj(wbits=31) if compress else None
+
+    # ── сторона потока ───────────────────────────────────────────────────
+
+    def write(self, data: bytes) -> int:
+        self._buf += self._zip.compress(data) if self._zip else data
+        if len(self._buf) >= Config.TAR_CHUNK:
+            self._call(self._queue.put(bytes(self._buf)))
+            self._buf.clear()
+        return len(data)
+
+    def finish(self):
+        """Конец записи: остаток буфера и None — признак конца для get()."""
+        if self._aborted:
+            return
+        if self._zip:
+            self._buf += self._zip.flush()
+        if self._buf:
+            self._call(self._queue.put(bytes(self._buf)))
+            self._buf.clear()
+        self._call(self._queue.put(None))
+
+    def read(self, size: int = -1) -> bytes:
+        while not self._buf and not self._eof:
+            chunk = self._call(self._queue.get())
+            if chunk is None:
+                self._eof = True
+                if self._unzip:
+                    self._buf += self._unzip.flush()
+            else:
+                self._buf += self._unzip.decompress(chunk) if self._unzip else chunk
+        size = len(self._buf) if size < 0 else size
+        data = bytes(self._buf[:size])
+        del self._buf[:size]
+        return data
+
+    def abort_threadsafe(self):
+        self._loop.call_soon_threadsafe(self.abort)
+
+    def _call(self, coro):
+        if self._aborted:
+            coro.close()
+            raise ConnectionAbortedError("Передача архива прервана")
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    # ── сторона asyncio ──────────────────────────────────────────────────
+
+    async def get(self) -> Optional[bytes]:
+        return await self._queue.get()
+
+    async def put(self, data: Optional[bytes]):
+        if not self._aborted:
+            await self._queue.put(data)
+
+    def abort(self):
+        """Освобождает поток, ждущий очередь: она опустошается, конец — None."""
+        self._aborted = True
+        while not self._queue.empty():
+            self._queue.get_nowait()
+        self._queue.put_nowait(None)
+
+
+class DiskWriter:
+    """
+    Запись принятого файла вне цикла событий — в общем пуле из DISK_WORKERS потоков.
+    Двойной буфер: пока пул пишет один, из сети наполняется другой.
+    В полёте не больше одной записи на файл — порядок байт сохраняется,
+    а памяти на файл уходит не больше 2 × DISK_BUFFER.
+    """
+
+    _pool: Optional[ThreadPoolExecutor] = None
+
+    def __init__(self, file: "ReceivedFile"):
+        self._file    = file
+        self._opened  = False
+        self._buf     = bytearray()
+        self._spare   = bytearray()
+        self._pending: Optional[asyncio.Future] = None
+
+    @classmethod
+    def _run(cls, fn: Callable, *args) -> asyncio.Future:
+        if cls._pool is None:
+            cls._pool = ThreadPoolExecutor(Config.DISK_WORKERS, thread_name_prefix="disk")
+        return asyncio.get_running_loop().run_in_executor(cls._pool, fn, *args)
+
+    async def open(self):
+        await self._run(self._file.open)
+        self._opened = True
+
+    async def write(self, data: bytes) -> bool:
+        """Копит данные; True — буфер ушёл на запись."""
+        self._buf += data
+        if len(self._buf) < Config.DISK_BUFFER:
+            return False
+        await self._flush()
+        return True
+
+    async def close(self, digest: Optional[str] = None) -> bool:
+        """Остаток буфера, fsync по политике FSYNC, сверка sha256 — ошибки диска наружу."""
+        await self._flush()
+        await self._wait()
+        self._opened = False
+        return await self._run(self._file.close, digest)
+
+    async def abort(self):
+        """После ошибки или отмены: дождаться записи в полёте и закрыть файл."""
+        try:
+            await self._wait()
+        except Exception:
+            pass
+        if self._opened:
+            self._opened = False
+            await self._run(self._file.abort)
+
+    async def _flush(self):
+        # Предыдущая запись закончена — её буфер свободен и становится текущим
+        await self._wait()
+        self._spare.clear()
+        self._buf, self._spare = self._spare, self._buf
+        if self._spare:
+            self._pending = self._run(self._file.write, self._spare)
+
+    async def _wait(self):
+        if self._pending:
+            pending, self._pending = self._pending, None
+            await pending
+
+    @staticmethod
+    def fsync(f):
+        f.flush()
+        os.fsync(f.fileno())
+
+
+class ChecksumError(ValueError):
+    """Файл принят целиком, но sha256 не совпал с присланным отправителем"""
+
+
+class ReceivedFile:
+    """
+    Принимаемый файл (вызывается из потока): запись, sha256 всего файла и,
+    если это файл v6 от RESUME_BLOCK байт, журнал докачки — см. TransferJournal.
+    """
+
+    def __init__(self, path: Path, size: int, tid: Optional[str] = None,
+                 rel_path: str = "", offset: int = 0):
+        self.path     = path
+        self.size     = size
+        self.tid      = tid if tid and size >= Config.RESUME_BLOCK else None
+        self.rel_path = rel_path
+        self.offset   = offset if self.tid else 0
+        self.sha      = hashlib.sha256()
+        self._block   = hashlib.sha256()
+        self._fill    = 0
+        self._f       = None
+        self._journal = None
+
+    @property
+    def target(self) -> Path:
+        return TransferJournal.part(self.path) if self.tid else self.path
+
+    def open(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        if not self.tid:
+            BlobStore.detach(self.path)
+            self._f = open(self.path, "wb")
+            return
+        kept = self.offset // Config.RESUME_BLOCK
+        if self.offset:
+            # offset — граница блока, сверенная обеими сторонами; начало
+            # перечитывается только ради sha256 всего файла
+            self._f = open(self.target, "r+b")
+            self._f.truncate(self.offset)
+            while chunk := self._f.read(Config.DISK_BUFFER):
+                self.sha.update(chunk)
+        else:
+            self._f = open(self.target, "wb")
+        self._journal = TransferJournal.start(self.path, self.tid, self.rel_path, self.size, kept)
+
+    def write(self, data: bytes | memoryview):
+        self._f.write(data)
+        self.sha.update(data)
+        if self._journal:
+            self._track(memoryview(data))
+        if Config.FSYNC == "write":
+            DiskWriter.fsync(self._f)
+
+    def close(self, digest: Optional[str] = None) -> bool:
+        """digest — sha256 отправителя; не совпал — файл и журнал удаляются."""
+        try:
+            if Config.FSYNC != "never":
+                DiskWriter.fsync(self._f)
+        finally:
+            self._f.close()
+            if self._journal:
+                self._journal.close()
+        if digest and digest != self.sha.hexdigest():
+            self.target.unlink(missing_ok=True)
+            TransferJournal.remove(self.path)
+            return False
+        if self.tid:
+            os.replace(self.target, self.path)
+            TransferJournal.remove(self.path)
+        return True
+
+    def abort(self):
+        """Обрыв: .part и журнал остаются для докачки."""
+        self._f.close()
+        if self._journal:
+            self._journal.close()
+
+    def _track(self, view: memoryview):
+        """Блоки по RESUME_BLOCK: закрытый блок дописывается в журнал, когда его байты в файле."""
+        while view:
+            n = min(len(view), Config.RESUME_BLOCK - self._fill)
+            self._block.update(view[:n])
+            self._fill += n
+            view = view[n:]
+            if self._fill == Config.RESUME_BLOCK:
+                self._f.flush()
+                self._journal.write(self._block.hexdigest() + "\n")
+                self._journal.flush()
+                self._block = hashlib.sha256()
+                self._fill  = 0
+
+
+class TransferJournal:
+    """
+    Журнал докачки (v6): рядом с "<имя>.part" лежит "<имя>.part.sum" —
+    строка заголовка {"tid", "rel_path", "size", "block"} и по строке sha256
+    на каждый принятый блок. Журнал только дописывается, оборванная
+    последняя строка просто не считается.
+
+    Перед повторной передачей приёмник собирает table(): блоки, которые
+    совпадают с данными .part на диске. Отправитель сверяет их со своим
+    файлом (resume_offset) и шлёт с первого расхождения. tid — имя, размер
+    и mtime источника: файл изменился — докачки нет, передача с нуля.
+    """
+
+    @staticmethod
+    def part(path: Path) -> Path:
+        return path.with_name(path.name + ".part")
+
+    @staticmethod
+    def sums(path: Path) -> Path:
+        return path.with_name(path.name + ".part.sum")
+
+    @staticmethod
+    def tid(file_path: str, rel_path: str) -> str:
+        st = os.stat(file_path)
+        return hashlib.sha1(f"{rel_path}\0{st.st_size}\0{st.st_mtime_ns}".encode()).hexdigest()[:16]
+
+    @staticmethod
+    def start(path: Path, tid: str, rel_path: str, size: int, kept: int) -> TextIO:
+        """Журнал под новую передачу: заголовок и первые kept блоков старого."""
+        old  = TransferJournal._read(TransferJournal.sums(path))
+        head = {"tid": tid, "rel_path": rel_path, "size": size, "block": Config.RESUME_BLOCK}
+        blocks = old[1][:kept] if old and old[0].get("tid") == tid else []
+        f = open(TransferJournal.sums(path), "w", encoding="utf-8")
+        f.write(json.dumps(head) + "\n" + "".join(b + "\n" for b in blocks))
+        f.flush()
+        return f
+
+    @staticmethod
+    def remove(path: Path):
+        TransferJournal.sums(path).unlink(missing_ok=True)
+
+    @staticmethod
+    def table(dest: Path) -> Dict[str, dict]:
+        """
+        Принятые блоки всех журналов в dest (или у самого dest — файл одиночного
+        IMPORT), сверенные с .part: {rel_path: {"tid", "block", "blocks"}}.
+        """
+        journals = list(dest.rglob("*.part.sum")) if dest.is_dir() else []
+        single   = TransferJournal.sums(dest)
+        if single.exists():
+            journals.append(single)
+        table = {}
+        for sums in journals:
+            journal = TransferJournal._read(sums)
+            if not journal or journal[0].get("block") != Config.RESUME_BLOCK:
+                continue
+            head, blocks = journal
+            good = TransferJournal._verify(sums.with_suffix(""), blocks, Config.RESUME_BLOCK)
+            if good:
+                table[head["rel_path"]] = {"tid": head["tid"], "block": head["block"],
+                                           "blocks": blocks[:good]}
+        return table
+
+    @staticmethod
+    def resume_offset(file_path: str, entry: dict) -> tuple[int, Any]:
+        """
+        Сторона отправителя: блоки приёмника сверяются с нашим файлом до первого
+        расхождения. Возвращает смещение и sha256 совпавшего начала.
+        """
+        block  = entry.get("block", Config.RESUME_BLOCK)
+        sha    = hashlib.sha256()
+        offset = 0
+        with open(file_path, "rb") as f:
+            for digest in entry.get("blocks", []):
+                data = f.read(block)
+                if len(data) < block or hashlib.sha256(data).hexdigest() != digest:
+                    break
+                sha.update(data)
+                offset += block
+        return offset, sha
+
+    @staticmethod
+    def digest(file_path: str, sha, offset: int) -> str:
+        """sha256 всего файла: sha уже содержит первые offset байт."""
+        with open(file_path, "rb") as f:
+            f.seek(offset)
+            while chunk := f.read(Config.DISK_BUFFER):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    @staticmethod
+    def _read(sums: Path) -> Optional[tuple[dict, list]]:
+        try:
+            lines = sums.read_text("utf-8").split("\n")
+            head  = json.loads(lines[0])
+        except (OSError, ValueError):
+            return None
+        # Последняя строка без \n — блок, не дописанный до обрыва
+        return head, [l for l in lines[1:-1] if len(l) == 64]
+
+    @staticmethod
+    def _verify(part: Path, blocks: list, block: int) -> int:
+        """Сколько блоков журнала подтверждают данные .part на диске."""
+        good = 0
+        try:
+            with open(part, "rb") as f:
+                for digest in blocks:
+                    data = f.read(block)
+                    if len(data) < block or hashlib.sha256(data).hexdigest() != digest:
+                        break
+                    good += 1
+        except OSError:
+            return 0
+        return good
+
+
+class Delta:
+    """
+    Дельта-IMPORT (v7), как в rsync. Агент подписывает свою копию: adler32
+    (слабая сумма, её можно сдвигать на байт) и blake2b (сильная) каждого
+    блока. encode() ищет блоки копии в новом файле на любом смещении:
+    найденные уходят как DELTA:COPY, остальное — литералами DELTA:DATA.
+
+    Сначала проверяется следующий по порядку блок копии на том же месте —
+    неизменённые участки идут со скоростью хеширования. Побайтовый сдвиг
+    (на Python) включается только на расхождении и ограничен
+    DELTA_ROLL_BUDGET байт на файл; дальше блоки ищутся только по границам.
+    """
+
+    MOD = 65521   # модуль adler32
+
+    @staticmethod
+    def strong(data) -> str:
+        return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+    @staticmethod
+    def encode(file_path: str, sig: dict) -> Optional[tuple[list, int, str]]:
+        """
+        (операции, байт литералами, sha256 файла) или None — литералов больше
+        DELTA_MAX_RATIO, дешевле отправить целиком. Вызывается в потоке.
+        Операции: ("copy", начало, конец) — номера блоков копии,
+        ("data", начало, конец) — смещения в файле; конец не включается.
+        """
+        size = os.path.getsize(file_path)
+        if not size:
+            return None
+        with open(file_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            ops, literal = Delta._match(mm, sig)
+            if literal > size * Config.DELTA_MAX_RATIO:
+                return None
+            return ops, literal, hashlib.sha256(mm).hexdigest()
+
+    @staticmethod
+    def _match(mm: mmap.mmap, sig: dict) -> tuple[list, int]:
+        block  = sig["block"]
+        weak   = sig["weak"]
+        strong = sig["strong"]
+        full   = sig["size"] // block            # целых блоков в копии
+        table: Dict[int, list] = {}
+        for i in range(full):
+            table.setdefault(weak[i], []).append(i)
+
+        n       = len(mm)
+        ops     = []
+        literal = 0
+        start   = 0       # начало ещё не отправленного литерала
+        pos     = 0
+        expect  = 0       # следующий по порядку блок копии
+        budget  = Config.DELTA_ROLL_BUDGET
+        rolling = False
+        a = b   = 0
+
+        def copy(index: int):
+            nonlocal literal, start
+            if start < pos:
+                ops.append(("data", start, pos))
+                literal += pos - start
+            if ops and ops[-1][0] == "copy" and ops[-1][2] == index:
+                ops[-1] = ("copy", ops[-1][1], index + 1)
+            else:
+                ops.append(("copy", index, index + 1))
+
+        while pos + block <= n:
+            if not rolling and expect < full and Delta.strong(mm[pos:pos + block]) == strong[expect]:
+                copy(expect)
+                expect += 1
+                pos    += block
+                start   = pos
+                continue
+            if not rolling:
+                w = zlib.adler32(mm[pos:pos + block])
+                a, b = w & 0xFFFF, w >> 16
+            found = None
+            for index in table.get((b << 16) | a, ()):
+                if Delta.strong(mm[pos:pos + block]) == strong[index]:
+                    found = index
+                    break
+            if found is not None:
+                copy(found)
+                expect  = found + 1
+                pos    += block
+                start   = pos
+                rolling = False
+            elif budget > 0 and pos + block < n:
+                # Сдвиг окна на байт: out уходит слева, in приходит справа
+                out, inn = mm[pos], mm[pos + block]
+                a = (a - out + inn) % Delta.MOD
+                b = (b - block * out + a - 1) % Delta.MOD
+                pos    += 1
+                budget -= 1
+                rolling = True
+            else:
+                pos    += block
+                rolling = False
+
+        # Хвост: последний неполный блок копии совпадает только в самом конце
+        tail = sig["size"] - full * block
+        if tail and n - pos == tail and Delta.strong(mm[pos:n]) == strong[full]:
+            copy(full)
+            pos   = n
+            start = n
+        if start < n:
+            ops.append(("data", start, n))
+            literal += n - start
+        return ops, literal
+
+
+class BlobStore:
+    """
+    Хранилище EXPORT по содержимому (v8): агент присылает sha256 файлов,
+    сервер просит только те, которых нет в DIR_BLOBS/<ab>/<sha256>.
+    В папке клиента (DIR_FILES/<клиент>/<dest>) файлы остаются на своих
+    местах — это жёсткие ссылки на блобы, так что 500 одинаковых hosts
+    занимают место одного. Что у кого лежит — манифест клиента
+    DIR_MANIFESTS/<клиент>.json: {"<dest>/<rel_path>": [размер, sha256, время]},
+    по нему строится report().
+
+    Файл, связанный с блобом, нельзя переписывать на месте — изменились
+    бы все копии; приём перед записью отвязывает его (detach).
+    Всё, кроме detach, вызывается в потоке.
+    """
+
+    _SHA256 = re.compile(r"[0-9a-f]{64}")
+
+    @staticmethod
+    def blob(sha: str) -> Path:
+        return Path(Config.DIR_BLOBS) / sha[:2] / sha
+
+    @staticmethod
+    def check(manifest: Any):
+        """
+        Манифест от агента до любых обращений к диску: пути — внутри папки
+        приёма, sha256 — 64 строчных hex (из него строится путь блоба),
+        размер — целое ≥ 0. Иначе ValueError.
+        """
+        if not isinstance(manifest, dict):
+            raise ValueError("Манифест — не словарь")
+        for rel_path, entry in manifest.items():
+            rel = Path(rel_path)
+            if not rel.parts or rel.is_absolute() or ".." in rel.parts:
+                raise ValueError(f"Недопустимый путь в манифесте: {rel_path}")
+            if not (isinstance(entry, list) and len(entry) == 2
+                    and type(entry[0]) is int and entry[0] >= 0
+                    and isinstance(entry[1], str) and BlobStore._SHA256.fullmatch(entry[1])):
+                raise ValueError(f"Недопустимая запись манифеста: {rel_path}")
+
+    @staticmethod
+    def missing(manifest: Dict[str, list]) -> list:
+        """rel_path файлов, чьего содержимого нет в хранилище, — по одному на sha256."""
+        need, seen = [], set()
+        for rel_path, (_, sha) in manifest.items():
+            if sha not in seen:
+                seen.add(sha)
+                if not BlobStore.blob(sha).exists():
+                    need.append(rel_path)
+        return need
+
+    @staticmethod
+    def commit(client_id: str, dest_dir: str, save_dir: Path, manifest: Dict[str, list],
+               received: list) -> tuple[int, int, list]:
+        """
+        Принятые файлы (received) становятся блобами, остальные пути манифеста —
+        ссылками на уже имеющиеся. Принятое хешируется заново: sha256 манифеста
+        агент снял раньше, чем читал файл для отправки, и файл мог измениться.
+        Возвращает (байт новых блобов, байт по ссылкам, пути без содержимого).
+        """
+        manifest = dict(manifest)
+        stored, linked, bad = 0, 0, []
+        for rel_path in received:
+            path = save_dir / rel_path
+            if not path.is_file():
+                bad.append(rel_path)
+                continue
+            # Изменился между хешированием и отправкой — блоб под настоящим sha256
+            sha = BlobStore._sha256(path)
+            manifest[rel_path] = [path.stat().st_size, sha]
+            BlobStore._link(path, BlobStore.blob(sha))
+            stored += manifest[rel_path][0]
+
+        now     = get_local_time().strftime("%Y-%m-%d %H:%M:%S")
+        entries = {}
+        for rel_path, (size, sha) in manifest.items():
+            path = save_dir / rel_path
+            blob = BlobStore.blob(sha)
+            if rel_path in bad:
+                continue
+            if not blob.exists():
+                bad.append(rel_path)
+                continue
+            if not BlobStore._same(path, blob):
+                BlobStore._link(blob, path)
+                linked += size
+            entries[(Path(dest_dir) / rel_path).as_posix()] = [size, sha, now]
+        BlobStore._save(client_id, entries)
+        return stored, linked, bad
+
+    @staticmethod
+    def detach(path: Path):
+        """Перед записью поверх: файл с другими ссылками заменяется новым, блоб не трогается."""
+        try:
+            if os.stat(path).st_nlink > 1:
+                os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def report(pattern: str = "") -> dict:
+        """
+        Сводка по манифестам всех клиентов: {"blobs", "stored", "logical",
+        "clients", "files": {путь: {sha256: [клиенты]}}} — путь, если в нём есть pattern.
+        """
+        files   = {}
+        clients = 0
+        logical = 0
+        for manifest in sorted(Path(Config.DIR_MANIFESTS).glob("*.json")):
+            try:
+                entries = json.loads(manifest.read_text("utf-8"))
+            except (OSError, ValueError):
+                continue
+            clients += 1
+            for path, (size, sha, *_) in entries.items():
+                logical += size
+                if pattern in path:
+                    files.setdefault(path, {}).setdefault(sha, []).append(manifest.stem)
+
+        blobs, stored = 0, 0
+        for prefix in os.scandir(Config.DIR_BLOBS):
+            if prefix.is_dir() and len(prefix.name) == 2:
+                for entry in os.scandir(prefix.path):
+                    if len(entry.name) == 64:
+                        blobs  += 1
+                        stored += entry.stat().st_size
+        return {"blobs": blobs, "stored": stored, "logical": logical,
+                "clients": clients, "files": files}
+
+    # ── private ──────────────────────────────────────────────────────────
+
+    @staticmethod
+    def _link(src: Path, dst: Path):
+        """dst — ещё одна ссылка на src, подменяется атомарно; без жёстких ссылок — копия."""
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        tmp = dst.with_name(f"{dst.name}.{threading.get_ident()}.link")
+        tmp.unlink(missing_ok=True)
+        try:
+            os.link(src, tmp)
+        except OSError:
+            # ФС без жёстких ссылок или другой раздел
+            shutil.copyfile(src, tmp)
+        os.replace(tmp, dst)
+
+    @staticmethod
+    def _same(path: Path, blob: Path) -> bool:
+        try:
+            return os.path.samefile(path, blob)
+        except OSError:
+            return False
+
+    @staticmethod
+    def _sha256(path: Path) -> str:
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            while chunk := f.read(Config.DISK_BUFFER):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    @staticmethod
+    def _save(client_id: str, entries: dict):
+        """Манифест клиента дополняется и пишется целиком через временный файл."""
+        path = Path(Config.DIR_MANIFESTS) / f"{client_id}.json"
+        try:
+            manifest = json.loads(path.read_text("utf-8"))
+        except (OSError, ValueError):
+            manifest = {}
+        manifest.update(entries)
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(manifest, ensure_ascii=False), "utf-8")
+        os.replace(tmp, path)
+
+
+class SharedSource:
+    """
+    Источник IMPORT на несколько клиентов сразу: дерево обходится один раз,
+    каждый файл открывается и отображается в память (mmap) один раз,
+    и все клиенты пишут из одних и тех же страниц — каждый со своего смещения.
+    Отображение отпускается, когда файл прошли (или бросили) все readers.
+    """
+
+    def __init__(self, source: str, readers: int):
+        self.files = FileTransfer.list_files(Path(source))
+        self.total = sum(f["size"] for f in self.files)
+        self._left = [readers] * len(self.files)
+        self._maps: Dict[int, memoryview] = {}
+
+    def view(self, index: int) -> memoryview:
+        view = self._maps.get(index)
+        if view is None:
+            fi = self.files[index]
+            if fi["size"]:
+                with open(fi["path"], "rb") as f:
+                    view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            else:
+                view = memoryview(b"")
+            self._maps[index] = view
+        return view
+
+    def release(self, index: int):
+        """Клиент прошёл файл. mmap закроется сам, когда уйдут и записи в транспортах."""
+        self._left[index] -= 1
+        if self._left[index] <= 0:
+            self._maps.pop(index, None)
+
+    def leave(self, start: int):
+        """Клиент выбыл — файлы с start он уже не прочитает."""
+        for index in range(start, len(self.files)):
+            self.release(index)
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+# РАССЫЛКА
+# ═══════════════════════════════════════════════════════════════════════════
+
+class FanOut:
+    """
+    Параллельная отправка на несколько клиентов.
+    Не больше limit отправок одновременно, у каждого клиента свой таймаут —
+    медленный клиент не задерживает остальных.
+    """
+
+    OK      = "OK"
+    ERROR   = "ERROR"
+    TIMEOUT = "TIMEOUT"
+
+    def __init__(self, limit: int = Config.FANOUT_LIMIT,
+                 timeout: Optional[float] = Config.FANOUT_SEND_TIMEOUT):
+        self._limit   = limit
+        self._timeout = timeout
+
+    async def run(self, targets: list, send: Callable[[str], Awaitable],
+                  timeout: Optional[float] = None) -> Dict[str, str]:
+        """Вызывает send(cid) для каждого клиента. Возвращает {cid: OK|ERROR|TIMEOUT}."""
+        sem     = asyncio.Semaphore(self._limit)
+        timeout = self._timeout if timeout is None else timeout
+
+        async def one(cid: str) -> tuple[str, str]:
+            async with sem:
+                try:
+                    await asyncio.wait_for(send(cid), timeout)
+                    return cid, FanOut.OK
+                except asyncio.TimeoutError:
+                    Logger.log("WARNING", f"Таймаут отправки ({timeout}s)", cid, show_console=False)
+                    return cid, FanOut.TIMEOUT
+                except Exception as e:
+                    Logger.log("ERROR", f"Ошибка отправки: {e}", cid, show_console=False)
+                    return cid, FanOut.ERROR
+
+        return dict(await asyncio.gather(*(one(cid) for cid in targets)))
+
+    @staticmethod
+    def summary(results: Dict[str, str]) -> str:
+        """Строка итогов: "OK 10, ERROR 1 [pc3], TIMEOUT 0"."""
+        parts = []
+        for status in (FanOut.OK, FanOut.ERROR, FanOut.TIMEOUT):
+            cids = [cid for cid, st in results.items() if st == status]
+            part = f"{status} {len(cids)}"
+            if cids and status != FanOut.OK:
+                part += f" [{', '.join(cids)}]"
+            parts.append(part)
+        return ", ".join(parts)
+
 
 # ═══════════════════════════════════════════════════════════════════════════
 # КИК
@@ -920,8 +2981,7 @@ class BanManager:
         if not writer:
             return False
         try:
-            writer.write(f"KICK:{reason}\n".encode())
-            await writer.drain()
+            await self._state.send(username, f"KICK:{reason}\n".encode())
             await asyncio.sleep(0.5)
             writer.close()
             await writer.wait_closed()
@@ -937,12 +2997,45 @@ class BanManager:
 # ═══════════════════════════════════════════════════════════════════════════
 
 class CommandMonitor:
+    """
+    Лимиты времени команд. Таймеры ставит ServerState.register_command,
+    снимает unregister_command; монитор только реагирует на срабатывание.
+    """
 
     def __init__(self, state: ServerState, user_mgr: UserManager):
         self._state    = state
         self._user_mgr = user_mgr
+        self._tasks: set = set()
+        state.set_timeout_handlers(self._warn, self._expire)
+
+    def _warn(self, cid: str, cmd: ActiveCommand):
+        if self._state.get_command(cid, cmd.rid) is not cmd:
+            return
+        elapsed   = time.time() - cmd.start_time
+        remaining = cmd.timeout - elapsed
+        self.notify(cid, f"\n Команда {elapsed:.0f}s, осталось {remaining:.0f}s\n".encode())
+
+    def _expire(self, cid: str, cmd: ActiveCommand):
+        if self._state.get_command(cid, cmd.rid) is not cmd:
+            return
+        Logger.log("TIMEOUT", f"#{cmd.rid} превышен лимит {cmd.timeout:.0f}s: {cmd.command}", cid, False)
+        self._state.unregister_command(cid, cmd.rid)
+        # Агенту с пулом — отмена только этого запроса, остальные команды идут дальше
+        self.notify(cid, self._state.request(cid, "CMD:", cmd.rid, "CANCEL_TIMEOUT"))
+
+    def notify(self, cid: str, data: bytes):
+        """Отправка клиенту отдельной задачей — не ждёт, пока освободится его запись."""
+        task = asyncio.create_task(self._send(cid, data))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, cid: str, data: bytes):
+        try:
+            await self._state.send(cid, data)
+        except Exception:
+            pass
 
-    def save_output(self, client_id: str, command: str, output: str, cmd_type: str):
+    def save_output(self, client_id: str, command: str, output: "str | SpillBuffer", cmd_type: str):
         """Сохраняет вывод в ./trash/"""
         try:
             info     = self._user_mgr.get_user_info(client_id)
@@ -950,40 +3043,8 @@ class CommandMonitor:
             now      = get_local_time().strftime("%Y-%m-%d %H:%M:%S")
             filepath = Config.DIR_TRASH / f"output_{alias}.txt"
             with open(filepath, "a", encoding="utf-8") as f:
-                f.write(f"Время: {now}\nТип: {cmd_type}\nКоманда: {command}\n"
-                        f"{'=' * 80}\n{output}\n{'=' * 80}\n\n")
+                f.write(f"Время: {now}\nТип: {cmd_type}\nКоманда: {command}\n{'=' * 80}\n")
+                SpillBuffer.dump(output, f)
+                f.write(f"\n{'=' * 80}\n\n")
         except Exception as e:
             Logger.log("ERROR", f"Ошибка сохранения вывода: {e}", client_id)
-
-    async def monitor_loop(self):
-        """Проверяет продолжительность выполнения команды и отменяет после превышения лимита"""
-        warned: set = set()
-        while True:
-            await asyncio.sleep(5)
-            now = time.time()
-            for cid, info in list(self._state.get_all_commands().items()):
-                elapsed = now - info["start_time"]
-                if elapsed > Config.WARNING_TIMEOUT and cid not in warned:
-                    remaining = Config.COMMAND_TIMEOUT - elapsed
-                    writer = self._state.get_writer(cid)
-                    if writer:
-                        try:
-                            writer.write(
-                                f"\n Команда {elapsed:.0f}s, осталось {remaining:.0f}s\n".encode()
-                            )
-                            await writer.drain()
-                        except Exception:
-                            pass
-                    warned.add(cid)
-                if elapsed > Config.COMMAND_TIMEOUT:
-                    Logger.log("TIMEOUT", f"превышен лимит: {info['command']}", cid, False)
-                    writer = self._state.get_writer(cid)
-                    if writer:
-                        try:
-                            writer.write(b"CMD:CANCEL_TIMEOUT\n")
-                            await writer.drain()
-                        except Exception:
-                            pass
-                    self._state.unregister_command(cid)
-                    self._state.clear_buffer(cid)
-                    warned.discard(cid)
@@ -0,0 +1,186 @@
+"""
+Кодеки клиентского протокола:
+  LineCodec  — v3: одно сообщение = одна строка, вывод экранирован <<<NL>>>
+  FrameCodec — v4: заголовок (тип, канал, длина) + сырой payload
+
+Версия выбирается при handshake "username,os,path[,version[,workers]]".
+Старые клиенты присылают три поля и остаются на v3.
+workers — размер пула команд агента: сервер отвечает WORKERS:n (не больше
+AGENT_WORKERS_MAX), дальше команды идут с ID запроса (CMD:@7:ls), а агент
+помечает им ответы — START / CHUNK / END с payload "@7:...".
+Направление сервер → клиент в обеих версиях строковое:
+команды короткие, а байты файлов IMPORT и так идут сырыми после FILE:META.
+
+v5 — кадры v4 плюс архивный режим EXPORT/IMPORT каталогов: в meta
+"mode": "tar", дальше вместо FILE:META/FILE:END на каждый файл — один
+поток tar порциями "TAR:<n>" + n байт (gzip, если "compress" > 0),
+конец — "TAR:0", обрыв на стороне отправителя — "TAR:ABORT".
+
+v6 — контрольные суммы и докачка пофайловых передач. FILE:META несёт
+"tid" (имя, размер и mtime источника) и "offset" — с какого байта идут
+данные; FILE:END:<sha256 всего файла>. Приёмник пишет файлы от
+RESUME_BLOCK байт в .part с журналом sha256 блоков (.part.sum) и перед
+передачей сообщает уже принятые блоки: EXPORT — сервер в запросе
+"EXPORT;src;dst;{журналы}", IMPORT — агент ответом на IMPORT:START с
+"resume": true — "IMPORT:RESUME:{журналы}". Отправитель сверяет блоки
+со своим файлом и шлёт с первого несовпавшего.
+
+v7 — дельта-IMPORT. До IMPORT:START сервер шлёт "IMPORT:SIGN:{"dest_dir",
+"count", "files": [rel_path…]}" — файлы, копии которых агенту стоит
+подписать. Агент считает подписи в отдельном потоке (приём команд не
+стоит) и отвечает "IMPORT:SIGNATURE:{rel_path: {"size", "block", "weak",
+"strong"}}" (adler32 и blake2b каждого блока). Файл, для которого дельта
+выгодна, идёт как FILE:META с "delta": <блок>, дальше
+"DELTA:COPY:<блок>:<сколько>" (взять из копии) и "DELTA:DATA:<n>" + n
+байт, конец — FILE:END:<sha256>. Агент собирает файл рядом и подменяет
+копию атомарно.
+
+v8 — EXPORT с дедупликацией. Агент хеширует файлы заранее и шлёт
+"EXPORT:MANIFEST:{rel_path: [размер, sha256]}". Сервер отвечает
+"EXPORT:NEED:{"files": [rel_path…], "mode": "tar"|"files"}" — по одному
+файлу на каждое содержимое, которого нет в хранилище (или {"error"}), —
+и агент шлёт только их: EXPORT:START с "dedup": true, архивом или
+пофайлово. Остальное сервер берёт из хранилища. Ответа агент ждёт, не
+занимая соединение: выводы команд и ответы IMPORT идут своим чередом.
+"""
+
+import asyncio
+import struct
+from enum import IntEnum
+from typing import Optional
+
+from config import Config, ClientMsg, ClientMsgParser, UnknownMessage
+
+
+NL_ESCAPE = b"<<<NL>>>"
+
+
+class FrameType(IntEnum):
+    """Тип кадра v4"""
+    MSG     = 1   # управляющее сообщение — текст строки v3 без \n
+    OUTPUT  = 2   # сырые байты вывода CMD
+    FILETRU = 3   # сырые байты вывода SIMPL
+    FILE    = 4   # сырые байты файла
+
+
+# тип (1 байт), канал (2 байта), длина payload (4 байта)
+HEADER = struct.Struct("!BHI")
+
+_CHUNK_FRAMES = {
+    FrameType.OUTPUT:  ClientMsg.OUTPUT_CHUNK,
+    FrameType.FILETRU: ClientMsg.FILETRU_CHUNK,
+}
+
+
+def negotiate(requested: Optional[str]) -> int:
+    """Возвращает версию протокола для клиента: min(запрошенная, серверная)."""
+    if not requested or not requested.strip().isdigit():
+        return 3
+    return max(3, min(int(requested), Config.PROTOCOL_VERSION))
+
+
+def make_codec(version: int, reader: asyncio.StreamReader) -> "Codec":
+    return FrameCodec(reader) if version >= 4 else LineCodec(reader)
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+# КОДЕКИ
+# ═══════════════════════════════════════════════════════════════════════════
+
+class Codec:
+    """Общий интерфейс чтения сообщений клиента."""
+
+    version = 0
+
+    def __init__(self, reader: asyncio.StreamReader):
+        self._reader = reader
+        # Причина, по которой поток больше не разобрать (слишком длинный кадр)
+        self.broken: Optional[str] = None
+
+    async def read_message(self) -> Optional[tuple[ClientMsg, bytes | memoryview]]:
+        """Следующее сообщение (тип, сырой payload). None — пустая строка."""
+        raise NotImplementedError
+
+    async def read_line(self) -> str:
+        """Следующее управляющее сообщение целиком (FILE:META, EXPORT:COMPLETE…)."""
+        raise NotImplementedError
+
+    async def read_data(self, size: int) -> bytes:
+        """Очередная порция байт файла, не больше size."""
+        raise NotImplementedError
+
+
+class LineCodec(Codec):
+    """v3: строки, разделённые \\n; перевод строки в выводе — <<<NL>>>."""
+
+    version = 3
+
+    async def read_message(self) -> Optional[tuple[ClientMsg, bytes | memoryview]]:
+        data = await self._reader.readline()
+        if not data:
+            raise ConnectionError("Соединение закрыто")
+        if data.isspace():
+            return None
+        msg_type, payload = ClientMsgParser.parse(data)
+        if msg_type in (ClientMsg.OUTPUT_CHUNK, ClientMsg.FILETRU_CHUNK):
+            return msg_type, bytes(payload).replace(NL_ESCAPE, b"\n")
+        return msg_type, payload
+
+    async def read_line(self) -> str:
+        data = await self._reader.readline()
+        return data.decode("utf-8", errors="ignore").strip()
+
+    async def read_data(self, size: int) -> bytes:
+        return await self._reader.read(size)
+
+
+class FrameCodec(Codec):
+    """v4: каждый кадр — HEADER + payload, никакого экранирования."""
+
+    version = 4
+
+    def __init__(self, reader: asyncio.StreamReader):
+        super().__init__(reader)
+        # Заголовок, уже снятый с потока, если чтение payload прервал таймаут
+        self._pending: Optional[tuple[int, int, int]] = None
+
+    async def _read_frame(self) -> tuple[int, int, bytes]:
+        if self.broken:
+            raise ConnectionError(self.broken)
+        try:
+            if self._pending is None:
+                self._pending = HEADER.unpack(await self._reader.readexactly(HEADER.size))
+            ftype, channel, length = self._pending
+            if length > Config.FRAME_MAX:
+                # Дальше в потоке — payload, а не заголовок: читать нечего, только рвать
+                self.broken = f"Кадр {length} байт больше FRAME_MAX ({Config.FRAME_MAX})"
+                raise ConnectionError(self.broken)
+            payload = await self._reader.readexactly(length) if length else b""
+        except asyncio.IncompleteReadError:
+            raise ConnectionError("Соединение закрыто")
+        self._pending = None
+        return ftype, channel, payload
+
+    async def read_message(self) -> Optional[tuple[ClientMsg, bytes | memoryview]]:
+        ftype, _, payload = await self._read_frame()
+        if ftype in _CHUNK_FRAMES:
+            return _CHUNK_FRAMES[ftype], payload
+        if ftype != FrameType.MSG:
+            raise UnknownMessage(f"Неожиданный кадр: {ftype}")
+        if not payload or payload.isspace():
+            return None
+        return ClientMsgParser.parse(payload)
+
+    async def read_line(self) -> str:
+        ftype, _, payload = await self._read_frame()
+        if ftype != FrameType.MSG:
+            raise ValueError(f"Ожидался кадр MSG, получен {ftype}")
+        return payload.decode("utf-8", errors="ignore").strip()
+
+    async def read_data(self, size: int) -> bytes:
+        ftype, _, payload = await self._read_frame()
+        if ftype != FrameType.FILE:
+            raise ValueError(f"Ожидался кадр FILE, получен {ftype}")
+        if len(payload) > size:
+            raise ValueError(f"Кадр FILE больше ожидаемого ({len(payload)} > {size})")
+        return payload
@@ -9,15 +9,18 @@ import sys
 import socket
 import traceback
 
-from config import Config, ServerCmd, ClientMsgParser, ServerCmdParser, ensure_dirs, print_help
+from config import Config, ServerCmd, ServerCmdParser, UnknownMessage, ensure_dirs, print_help
 from managers import (
     Logger, ServerState, UserManager, GroupManager,
-    ScheduledManager, CommandMonitor, BanManager, FileTransfer,TemplateManager
+    ScheduledManager, CommandMonitor, BanManager, FileTransfer, TemplateManager,
+    SimplSender,
 )
 from handlers import (
     CommandHandler, ServerDispatcher,
     ProtocolHandler, ProtocolDispatcher,
 )
+from protocol import negotiate, make_codec
+from storage import flush_all
 
 
 # ═══════════════════════════════════════════════════════════════════════════
@@ -33,8 +36,17 @@ def _cleanup(state: ServerState, user_mgr: UserManager):
             users[uname].update({"status": "OFF", "last_logout": now})
             user_mgr._log_session(uname, "logout")
     user_mgr.save_user_data(users)
+    flush_stores(state)
     state.save()
     Logger.log("INFO", "Сервер остановлен")
+    Logger.close()
+
+
+def flush_stores(state: ServerState):
+    """Пишет накопленные изменения JSON-хранилищ и состояния сервера."""
+    for error in flush_all():
+        Logger.log("ERROR", f"Ошибка отложенной записи: {error}")
+    state.flush()
 
 
 def setup_signal_handlers(state: ServerState, user_mgr: UserManager):
@@ -52,6 +64,25 @@ async def periodic_save(state: ServerState):
         state.save()
 
 
+async def periodic_compact(user_mgr: UserManager):
+    """Раз в HISTORY_COMPACT_INTERVAL срезает журналы сессий по сроку хранения."""
+    while True:
+        await asyncio.sleep(Config.HISTORY_COMPACT_INTERVAL)
+        freed = user_mgr.compact_history()
+        if freed:
+            Logger.log("INFO", f"История сессий: освобождено {freed} байт", show_console=False)
+
+
+async def periodic_flush(state: ServerState):
+    """
+    Отложенная запись: при массовом переподключении каждый вход только
+    помечает данные изменёнными, а на диск они уходят раз в интервал.
+    """
+    while True:
+        await asyncio.sleep(Config.WRITE_BEHIND_INTERVAL)
+        flush_stores(state)
+
+
 async def _aiter(lst: list):
     for item in lst:
         yield item
@@ -61,7 +92,7 @@ async def _aiter(lst: list):
 # ОТЛОЖЕННЫЕ КОМАНДЫ ПРИ ПОДКЛЮЧЕНИИ
 # ═══════════════════════════════════════════════════════════════════════════
 
-async def _run_scheduled(client_id: str, writer: asyncio.StreamWriter,
+async def _run_scheduled(client_id: str,
                          state: ServerState, template_mgr: TemplateManager,
                          sched_mgr: ScheduledManager ):
     """Выполняет накопленные отложенные команды при подключении клиента."""
@@ -78,10 +109,8 @@ async def _run_scheduled(client_id: str, writer: asyncio.StreamWriter,
 
             if cmd_type == ServerCmd.CMD:
                 command = sub(cmd_data["command"])
-                state.register_command(client_id, command, "CMD", 1)
-                writer.write(f"CMD:{command}\n".encode())
-                await writer.drain()
-                state.push_scheduled(client_id, idx)
+                info    = state.register_command(client_id, command, "CMD", 1, scheduled=idx)
+                await state.send(client_id, state.request(client_id, "CMD:", info.rid, command))
 
             elif cmd_type == ServerCmd.SIMPL:
                 tmpl_type = cmd_data["template_type"]
@@ -94,30 +123,27 @@ async def _run_scheduled(client_id: str, writer: asyncio.StreamWriter,
                 else:
                     commands=template_mgr.get_comd_template_name(tmpl_type)
                 if commands:
-                    state.register_command(client_id, f"simpl ({len(commands)} команд) - шаблон {tmpl_type}",
-                                           "FILETRU", len(commands))
-                    for cmd in commands:
-                        writer.write(f"FILETRU:{sub(cmd)}\n".encode())
-                        await writer.drain()
-                        await asyncio.sleep(0.2)
-                    state.push_scheduled(client_id, idx)
+                    opts = template_mgr.get_options(tmpl_type)
+                    info = state.register_command(client_id, f"simpl ({len(commands)} команд) - шаблон {tmpl_type}",
+                                                  "FILETRU", len(commands), opts["timeout"], scheduled=idx)
+                    await SimplSender.send(state, client_id, info.rid, [sub(cmd) for cmd in commands],
+                                           opts["window"], opts["batch"])
 
 
             elif cmd_type == ServerCmd.IMPORT:
                 src = sub(cmd_data["source_path"])
                 dst = sub(cmd_data["dest_path"])
-                state.register_command(client_id, f"import {src}", "IMPORT", 1)
-                await FileTransfer.send_to_client(client_id, src, dst, state)
-                state.unregister_command(client_id)
-                sched_mgr.mark_done(idx, client_id, f"IMPORT: {src} → {dst} [OK]")
+                # Отмечается выполненной по IMPORT:COMPLETE с тем же ID
+                info = state.register_command(client_id, f"import {src}", "IMPORT", 1, scheduled=idx)
+                if not await FileTransfer.send_to_client(client_id, src, dst, state, info.rid):
+                    state.unregister_command(client_id, info.rid)
 
             elif cmd_type == ServerCmd.EXPORT:
                 src = sub(cmd_data["source_path"])
                 dst = sub(cmd_data["dest_path"])
-                state.register_command(client_id, f"export {src}", "EXPORT", 1)
-                writer.write(f"EXPORT;{src};{dst}\n".encode())
-                await writer.drain()
-                state.push_scheduled(client_id, idx)
+                info = state.register_command(client_id, f"export {src}", "EXPORT", 1, scheduled=idx)
+                body = await FileTransfer.export_body(state, client_id, src, dst)
+                await state.send(client_id, state.request(client_id, "EXPORT;", info.rid, body))
 
             await asyncio.sleep(0.3)
 
@@ -134,6 +160,7 @@ async def handle_client(reader: asyncio.StreamReader, writer: asyncio.StreamWrit
                         sched_mgr: ScheduledManager, monitor: CommandMonitor, template_mgr : TemplateManager):
     addr      = writer.get_extra_info("peername")
     client_id = None
+    scheduled = None
     ip = socket.gethostbyname(socket.gethostname())
     try:
         raw       = await asyncio.wait_for(reader.readline(), timeout=10)
@@ -145,42 +172,56 @@ async def handle_client(reader: asyncio.StreamReader, writer: asyncio.StreamWrit
             await writer.wait_closed()
             return
 
+        version = negotiate(parts[3] if len(parts) > 3 else None)
+        # Пятое поле — сколько команд агент готов выполнять одновременно
+        offered = parts[4].strip() if len(parts) > 4 else ""
+        workers = min(int(offered), Config.AGENT_WORKERS_MAX) if offered.isdigit() else 0
         user_mgr.register(client_id, parts[1], parts[2])
-        state.add_client(client_id, writer)
-        Logger.log("CONNECT", f"подключился ({addr})", client_id)
-        state.save()
+        state.add_client(client_id, writer, version, workers)
+        pool = f", пул {workers}" if workers else ""
+        Logger.log("CONNECT", f"подключился ({addr}), протокол v{version}{pool}", client_id)
+        state.touch()
+
+        if version >= 4:
+            writer.write(f"PROTO:{version}\n".encode())
+        if workers:
+            writer.write(f"WORKERS:{workers}\n".encode())
+        await writer.drain()
+        codec = make_codec(version, reader)
 
         proto_handler    = ProtocolHandler(client_id, state, user_mgr, sched_mgr, monitor)
         proto_dispatcher = ProtocolDispatcher(proto_handler)
 
-        await _run_scheduled(client_id, writer, state, template_mgr, sched_mgr)
+        # В фоне: конвейер SIMPL ждёт подтверждений, которые читает цикл ниже
+        scheduled = asyncio.create_task(
+            _run_scheduled(client_id, state, template_mgr, sched_mgr)
+        )
 
         consecutive_errors = 0
         MAX_ERRORS         = 5
 
         while True:
             try:
-                data = await asyncio.wait_for(reader.readline(), timeout=Config.READ_TIMEOUT)
-                if not data:
-                    break
-
-                msg = data.decode("utf-8", errors="ignore").strip()
-                if not msg:
+                try:
+                    message = await asyncio.wait_for(codec.read_message(),
+                                                     timeout=Config.READ_TIMEOUT)
+                except UnknownMessage as e:
+                    Logger.log("WARNING", str(e), client_id, show_console=False)
                     continue
 
                 consecutive_errors = 0
+                if message is None:
+                    continue
 
-                try:
-                    msg_type, payload = ClientMsgParser.parse(msg)
-                    await proto_dispatcher.dispatch(msg_type, payload, reader)
-                except ValueError:
-                    Logger.log("WARNING", f"Неизвестное сообщение: {msg[:60]}",
-                               client_id, show_console=False)
+                msg_type, payload = message
+                await proto_dispatcher.dispatch(msg_type, payload, codec)
 
             except asyncio.TimeoutError:
                 Logger.log("WARNING", "Таймаут 5 мин", client_id, show_console=False)
                 continue
             except ConnectionError:
+                if codec.broken:
+                    Logger.log("WARNING", f"Отключение: {codec.broken}", client_id)
                 break
             except Exception as e:
                 Logger.log("ERROR", f"Ошибка цикла: {e}", client_id)
@@ -194,12 +235,14 @@ async def handle_client(reader: asyncio.StreamReader, writer: asyncio.StreamWrit
         Logger.crash(e, traceback.format_exc(), state)
 
     finally:
+        if scheduled:
+            scheduled.cancel()
         if client_id:
             state.remove_client(client_id)
             state.unregister_command(client_id)
             user_mgr.logout(client_id)
             Logger.log("DISCONNECT", "отключился", client_id)
-            state.save()
+            state.touch()
         try:
             writer.close()
             await writer.wait_closed()
@@ -253,11 +296,10 @@ async def TCPServer():
     sched_mgr = ScheduledManager(user_mgr, group_mgr)
     monitor   = CommandMonitor(state, user_mgr)
     ban_mgr   = BanManager(state)
-    template  = TemplateManager()
+    template_mgr = TemplateManager()
 
-    handler    = CommandHandler(state, user_mgr, group_mgr, sched_mgr, ban_mgr, monitor, template)
+    handler    = CommandHandler(state, user_mgr, group_mgr, sched_mgr, ban_mgr, monitor, template_mgr)
     dispatcher = ServerDispatcher(handler)
-    template_mgr = TemplateManager()
 
     setup_signal_handlers(state, user_mgr)
     Logger.log("INFO", "Запуск сервера...")
@@ -278,8 +320,9 @@ async def TCPServer():
             await asyncio.gather(
                 server.serve_forever(),
                 server_input(server, dispatcher, state, user_mgr),
-                monitor.monitor_loop(),
                 periodic_save(state),
+                periodic_flush(state),
+                periodic_compact(user_mgr),
             )
     except Exception as e:
         Logger.log("CRITICAL", f"Критическая ошибка: {e}")
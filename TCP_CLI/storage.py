@@ -0,0 +1,221 @@
+"""
+Хранилища данных менеджеров (пользователи, группы, шаблоны, отложенные команды):
+  JsonStore   — весь документ в одном JSON-файле, как раньше
+  SqliteStore — строка на ключ в общей БД SQLite (WAL), изменения построчно
+  open_store  — выбор хранилища по Config.STORAGE_BACKEND
+  flush_all   — запись накопленных изменений JSON (режим WRITE_BEHIND)
+
+Однократный перенос существующих JSON в SQLite:
+  python storage.py migrate
+"""
+
+import atexit
+import json
+import sqlite3
+import sys
+from pathlib import Path
+from typing import Dict, Optional, Any
+
+from config import Config
+
+
+def collections() -> Dict[str, tuple[Path, Optional[str]]]:
+    """Коллекция → (JSON-файл, корневой ключ документа или None)."""
+    return {
+        "users":     (Config.FILE_USERS,     "users"),
+        "groups":    (Config.FILE_GROUPS,    None),
+        "scheduled": (Config.FILE_SCHEDULED, None),
+        "templates": (Config.FILE_TEMPLATE,  None),
+    }
+
+
+def open_store(collection: str) -> "JsonStore | SqliteStore":
+    path, root = collections()[collection]
+    if Config.STORAGE_BACKEND == "sqlite":
+        if not Config.FILE_DB.exists():
+            migrate_json_to_sqlite()
+        return SqliteStore(Config.FILE_DB, collection)
+    return JsonStore(path, root)
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+# JSON
+# ═══════════════════════════════════════════════════════════════════════════
+
+class JsonStore:
+    """
+    Документ целиком в памяти и на диске. put/delete меняют ключ
+    и переписывают файл через .tmp — поведение прежних _save().
+    С write_behind файл только помечается изменённым, а переписывает
+    его flush_all() — один раз за интервал, сколько бы изменений ни было.
+    """
+
+    _pending: set = set()
+
+    def __init__(self, path: Path, root: Optional[str] = None,
+                 write_behind: Optional[bool] = None):
+        self._path  = path
+        self._root  = root
+        self._data: Dict[str, Any] = {}
+        self._write_behind = Config.WRITE_BEHIND if write_behind is None else write_behind
+
+    def load(self) -> Dict[str, Any]:
+        try:
+            with open(self._path, "r", encoding="utf-8") as f:
+                doc = json.load(f)
+            self._data = doc.get(self._root, {}) if self._root else doc
+        except Exception:
+            self._data = {}
+        return self._data
+
+    def put(self, key: str, value: Any):
+        self._data[key] = value
+        self._changed()
+
+    def delete(self, key: str):
+        self._data.pop(key, None)
+        self._changed()
+
+    def replace(self, data: Dict[str, Any]):
+        self._data = data
+        self._changed()
+
+    def flush(self):
+        JsonStore._pending.discard(self)
+        self._write()
+
+    def _changed(self):
+        if self._write_behind:
+            JsonStore._pending.add(self)
+        else:
+            self._write()
+
+    def _write(self):
+        doc = {self._root: self._data} if self._root else self._data
+        tmp = self._path.with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(doc, f, ensure_ascii=False, indent=2)
+        tmp.replace(self._path)
+
+
+def flush_all() -> list[str]:
+    """Пишет все JSON с отложенными изменениями. Возвращает тексты ошибок."""
+    errors = []
+    for store in list(JsonStore._pending):
+        try:
+            store.flush()
+        except Exception as e:
+            JsonStore._pending.add(store)
+            errors.append(f"{store._path}: {e}")
+    return errors
+
+
+# Страховка на случай выхода мимо _cleanup
+atexit.register(flush_all)
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+# SQLITE
+# ═══════════════════════════════════════════════════════════════════════════
+
+class SqliteStore:
+    """
+    Коллекция — строки (collection, key, value JSON) одной таблицы.
+    Журнал WAL: запись одной строки не переписывает остальные,
+    чтение не блокируется записью. Порядок ключей — порядок вставки.
+    """
+
+    _connections: Dict[str, sqlite3.Connection] = {}
+
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS kv (
+            id         INTEGER PRIMARY KEY,
+            collection TEXT NOT NULL,
+            key        TEXT NOT NULL,
+            value      TEXT NOT NULL,
+            UNIQUE (collection, key)
+        )
+    """
+
+    _UPSERT = """
+        INSERT INTO kv (collection, key, value) VALUES (?, ?, ?)
+        ON CONFLICT (collection, key) DO UPDATE SET value = excluded.value
+    """
+
+    def __init__(self, path: Path, collection: str):
+        self._db         = SqliteStore.connect(path)
+        self._collection = collection
+
+    @staticmethod
+    def connect(path: Path) -> sqlite3.Connection:
+        key = str(Path(path).resolve())
+        conn = SqliteStore._connections.get(key)
+        if conn is None:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(key, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(SqliteStore._SCHEMA)
+            conn.commit()
+            SqliteStore._connections[key] = conn
+        return conn
+
+    @staticmethod
+    def close_all():
+        for conn in SqliteStore._connections.values():
+            conn.close()
+        SqliteStore._connections.clear()
+
+    def load(self) -> Dict[str, Any]:
+        rows = self._db.execute(
+            "SELECT key, value FROM kv WHERE collection = ? ORDER BY id", (self._collection,)
+        )
+        return {key: json.loads(value) for key, value in rows}
+
+    def put(self, key: str, value: Any):
+        with self._db:
+            self._db.execute(self._UPSERT, (self._collection, key, self._dump(value)))
+
+    def delete(self, key: str):
+        with self._db:
+            self._db.execute("DELETE FROM kv WHERE collection = ? AND key = ?",
+                             (self._collection, key))
+
+    def replace(self, data: Dict[str, Any]):
+        with self._db:
+            stale = [
+                (self._collection, key) for (key,) in self._db.execute(
+                    "SELECT key FROM kv WHERE collection = ?", (self._collection,))
+                if key not in data
+            ]
+            self._db.executemany("DELETE FROM kv WHERE collection = ? AND key = ?", stale)
+            self._db.executemany(self._UPSERT, [
+                (self._collection, key, self._dump(value)) for key, value in data.items()
+            ])
+
+    @staticmethod
+    def _dump(value: Any) -> str:
+        return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+# МИГРАЦИЯ
+# ═══════════════════════════════════════════════════════════════════════════
+
+def migrate_json_to_sqlite(db_path: Optional[Path] = None) -> Dict[str, int]:
+    """Переносит все JSON-коллекции в SQLite. Возвращает число ключей по коллекциям."""
+    db_path = db_path or Config.FILE_DB
+    counts  = {}
+    for name, (path, root) in collections().items():
+        data = JsonStore(path, root, write_behind=False).load()
+        SqliteStore(db_path, name).replace(data)
+        counts[name] = len(data)
+    return counts
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["migrate"]:
+        print("Использование: python storage.py migrate")
+        sys.exit(1)
+    for name, n in migrate_json_to_sqlite().items():
+        print(f" {name}: {n} записей → {Config.FILE_DB}")
@@ -8,9 +8,9 @@
 -Добавленые классы
     -RawBuffer  безопасная работа с сокетом
     -Connection > управление подключением и переподключением
-    -CommandExecutor > выполнение команд с таймаутом
+    -CommandExecutor > пул потоков для команд, отмена всего дерева процессов
     -FileTransfer > отправка/приём файлов
-    -OutputSender > отправка вывода чанками
+    -OutputSender > отправка вывода чанками по мере появления (OutputStream)
     -MessageHandler > обработка всех сообщений от сервера
     -ServerMsg > Enum для описания стека сообщений от сервера
 """
@@ -20,13 +20,24 @@
 import socket
 import threading
 import subprocess
+import signal
+import queue
+import codecs
 import os
 import json
+import hashlib
+import math
 import time
 import sys
+import struct
+import shutil
+import itertools
+import tarfile
+import zlib
+from collections import deque
 from pathlib import Path
 from typing import Optional
-from enum import StrEnum
+from enum import StrEnum, IntEnum
 
 
 # ═══════════════════════════════════════════════════════════════════════════
@@ -41,7 +52,19 @@ class Config:
     MAX_RECONNECT      = 0        # 0 = бесконечно
     CONNECT_TIMEOUT    = 10
     HANDSHAKE_TIMEOUT  = 3
-    CMD_TIMEOUT        = 30
+    CMD_TIMEOUT        = None     # лимит команды ставит сервер (CANCEL_TIMEOUT); число — свой предел, сек
+    KILL_GRACE         = 2        # ждать вывод убитой команды, сек
+    STREAM_CHUNK_BYTES = 16384    # чанк вывода уходит, как только набралось столько...
+    STREAM_INTERVAL    = 0.5      # ...или прошло столько секунд с первого байта в нём
+    PROTOCOL_VERSION   = 8        # предлагается серверу в handshake
+    TAR_MIN_FILES      = 64       # EXPORT каталога от стольких файлов — одним архивом (сервер v5)
+    TAR_COMPRESS       = 1        # уровень gzip архива 1..9, 0 — без сжатия
+    TAR_CHUNK          = 1 << 20  # байт архива в одной порции TAR:<n>
+    RESUME_BLOCK       = 4 << 20  # блок контрольной суммы (v6); файлы от этого размера докачиваются
+    DELTA_BLOCK_MIN    = 2048     # блок подписи копии для дельта-IMPORT (v7): √размера в этих границах
+    DELTA_BLOCK_MAX    = 1 << 17
+    DEDUP_TIMEOUT      = 60       # EXPORT (v8): ждать от сервера список нужных файлов, сек
+    WORKERS            = 4        # команд одновременно — предлагается в handshake, сервер может урезать
 
 
 
@@ -50,10 +73,25 @@ class ServerMsg(StrEnum):
     """Сообщения которые приходят от сервера"""
     CMD          = "cmd"
     FILETRU      = "filetru"
+    FILEBATCH    = "filebatch"
     IMPORT_START = "import:start"
     EXPORT       = "export"
     KICK         = "kick"
     SHUTDOWN     = "server_shutdown"
+    PROTO        = "proto"
+    WORKERS      = "workers"
+
+
+class FrameType(IntEnum):
+    """Тип кадра протокола v4 (клиент → сервер)"""
+    MSG     = 1   # управляющее сообщение — текст строки v3 без \n
+    OUTPUT  = 2   # сырые байты вывода CMD
+    FILETRU = 3   # сырые байты вывода SIMPL
+    FILE    = 4   # сырые байты файла
+
+
+# тип (1 байт), канал (2 байта), длина payload (4 байта)
+FRAME_HEADER = struct.Struct("!BHI")
 
 
 # ═══════════════════════════════════════════════════════════════════════════
@@ -85,8 +123,9 @@ class ClientIdentity:
         self.home_path = os.path.expanduser("~")
 
     def handshake_str(self) -> str:
-        """Строка регистрации которую ждёт сервер"""
-        return f"{self.username},{self.os_name},{self.home_path}\n"
+        """Строка регистрации которую ждёт сервер (+ версия протокола и размер пула)"""
+        return (f"{self.username},{self.os_name},{self.home_path},"
+                f"{Config.PROTOCOL_VERSION},{Config.WORKERS}\n")
 
     def get_encoding(self) -> str:
         """Кодировка вывода команд — зависит от ОС"""
@@ -103,10 +142,18 @@ class RawBuffer:
     Сокет — один, но читают из него два места:
     текстовые строки (receive) и бинарные файлы (import).
     Буфер гарантирует что байты не теряются и не перемешиваются.
+
+    Прочитанное не вырезается из bytearray — сдвигается смещение _pos,
+    место освобождается разом, когда прочитано больше половины буфера.
+    Поиск \\n продолжается с _scan, а не с начала после каждого recv.
     """
 
+    RECV_SIZE = 65536
+
     def __init__(self):
-        self._buf  = b""
+        self._buf  = bytearray()
+        self._pos  = 0          # начало непрочитанного
+        self._scan = 0          # до сюда \\n уже искали
         self._lock = threading.Lock()
 
     def feed(self, data: bytes):
@@ -114,43 +161,98 @@ class RawBuffer:
         with self._lock:
             self._buf += data
 
+    def clear(self):
+        """Сбросить остаток прежнего соединения"""
+        with self._lock:
+            self._buf.clear()
+            self._pos = self._scan = 0
+
     def read_line(self, sock: socket.socket) -> str:
         """Блокирующее чтение строки до \\n"""
         with self._lock:
-            while b"\n" not in self._buf:
-                self._lock.release()
-                try:
-                    chunk = sock.recv(4096)
-                    if not chunk:
-                        raise ConnectionError("Соединение закрыто")
-                finally:
-                    self._lock.acquire()
-                self._buf += chunk
-
-            line, self._buf = self._buf.split(b"\n", 1)
+            while (end := self._buf.find(b"\n", self._scan)) < 0:
+                self._scan = len(self._buf)
+                self._fill(sock)
+
+            line = self._buf[self._pos:end]
+            self._pos = self._scan = end + 1
+            if self._pos * 2 > len(self._buf):
+                self._compact()
             return line.decode("utf-8", errors="ignore").strip()
 
-    def read_exact(self, sock: socket.socket, size: int) -> bytes:
+    def read_exact(self, sock: socket.socket, size: int) -> bytearray:
         """Блокирующее чтение ровно size байт"""
+        data = bytearray(size)
+        self.read_into(sock, memoryview(data))
+        return data
+
+    def read_into(self, sock: socket.socket, target: memoryview):
+        """
+        Заполняет target целиком: сначала тем, что уже в буфере,
+        остальное — recv_into прямо в target, минуя буфер.
+        """
         with self._lock:
-            while len(self._buf) < size:
+            done = min(len(target), len(self._buf) - self._pos)
+            if done:
+                with memoryview(self._buf) as view:
+                    target[:done] = view[self._pos:self._pos + done]
+                self._consume(done)
+
+            while done < len(target):
                 self._lock.release()
                 try:
-                    chunk = sock.recv(min(Config.CHUNK_SIZE, size - len(self._buf)))
-                    if not chunk:
-                        raise ConnectionError("Соединение закрыто")
+                    n = sock.recv_into(target[done:])
                 finally:
                     self._lock.acquire()
-                self._buf += chunk
+                if not n:
+                    raise ConnectionError("Соединение закрыто")
+                done += n
+
+    def read_to_file(self, sock: socket.socket, f, size: int, progress=None):
+        """Пишет size байт из сокета в файл через один заранее выделенный блок"""
+        block    = memoryview(bytearray(min(Config.CHUNK_SIZE, size)))
+        received = 0
+        while received < size:
+            part = block[:min(len(block), size - received)]
+            self.read_into(sock, part)
+            f.write(part)
+            received += len(part)
+            if progress:
+                progress(received)
+
+    # ── private (под self._lock) ─────────────────────────────────────────
+
+    def _fill(self, sock: socket.socket):
+        """Дочитывает из сокета; на время recv замок отпускается"""
+        self._lock.release()
+        try:
+            chunk = sock.recv(self.RECV_SIZE)
+        finally:
+            self._lock.acquire()
+        if not chunk:
+            raise ConnectionError("Соединение закрыто")
+        self._buf += chunk
+
+    def _consume(self, n: int):
+        self._pos += n
+        self._scan = max(self._scan, self._pos)
+        if self._pos * 2 > len(self._buf):
+            self._compact()
 
-            data, self._buf = self._buf[:size], self._buf[size:]
-            return data
+    def _compact(self):
+        """Отбрасывает прочитанное — когда его больше половины буфера"""
+        del self._buf[:self._pos]
+        self._scan -= self._pos
+        self._pos   = 0
 
 
 
 
 class Connection:
-    """Управляет сокетом и переподключением"""
+    """
+    Управляет сокетом и переподключением.
+    protocol — версия, подтверждённая сервером (PROTO:4); до ответа — 3.
+    """
 
     def __init__(self, identity: ClientIdentity, buf: RawBuffer):
         self._identity      = identity
@@ -158,7 +260,8 @@ class Connection:
         self._sock: Optional[socket.socket] = None
         self._connected     = False
         self._reconnect_cnt = 0
-        self._lock          = threading.Lock()
+        self._lock          = threading.RLock()
+        self.protocol       = 3
 
     @property
     def connected(self) -> bool:
@@ -176,11 +279,13 @@ class Connection:
                 sock.settimeout(Config.CONNECT_TIMEOUT)
                 sock.connect((Config.HOST, Config.PORT))
                 sock.settimeout(None)
+                self.protocol = 3
 
                 # Handshake
                 sock.sendall(self._identity.handshake_str().encode("utf-8"))
 
                 # Читаем возможное начальное сообщение (KICK или молчание)
+                self._buf.clear()
                 sock.settimeout(Config.HANDSHAKE_TIMEOUT)
                 try:
                     initial = sock.recv(4096)
@@ -214,9 +319,32 @@ class Connection:
         except Exception:
             pass
 
+    def exclusive(self) -> threading.RLock:
+        """Держать, пока уходит многочастное сообщение (вывод, EXPORT) — чтобы не перемешалось"""
+        return self._lock
+
     def send(self, data: bytes):
         if self._sock:
-            self._sock.sendall(data)
+            with self._lock:
+                self._sock.sendall(data)
+
+    def send_msg(self, text: str):
+        """Управляющее сообщение: строка в v3, кадр MSG в v4"""
+        data = text.encode("utf-8", errors="replace")
+        if self.protocol >= 4:
+            self._send_frame(FrameType.MSG, data)
+        else:
+            self.send(data + b"\n")
+
+    def send_data(self, data: bytes, ftype: FrameType = FrameType.FILE):
+        """Сырые байты: как есть в v3, кадр ftype в v4"""
+        if self.protocol >= 4:
+            self._send_frame(ftype, data)
+        else:
+            self.send(data)
+
+    def _send_frame(self, ftype: FrameType, payload: bytes, channel: int = 0):
+        self.send(FRAME_HEADER.pack(ftype, channel, len(payload)) + payload)
 
     def get_sock(self) -> Optional[socket.socket]:
         return self._sock
@@ -224,157 +352,874 @@ class Connection:
 
 
 
+def request_tag(rid: Optional[int]) -> str:
+    """Метка ID запроса в ответе: "@7:"; без ID (старый сервер) — пусто"""
+    return f"@{rid}:" if rid is not None else ""
+
+
+class Job:
+    """Команда в пуле. cancelled — причина отмены, proc — запущенный процесс"""
+
+    __slots__ = ("rid", "prefix", "cmd", "cancelled", "proc")
+
+    def __init__(self, rid: Optional[int], prefix: str, cmd: str):
+        self.rid       = rid
+        self.prefix    = prefix
+        self.cmd       = cmd
+        self.cancelled = ""
+        self.proc: Optional[subprocess.Popen] = None
+
+
 class CommandExecutor:
-    """Выполняет shell-команды и возвращает результат строкой"""
+    """
+    Выполняет shell-команды в пуле потоков; размер пула разрешает сервер
+    (WORKERS:n), до ответа — один поток. Команды одного запроса (rid)
+    идут по очереди, в порядке прихода — выводы SIMPL не перемешиваются;
+    разные запросы выполняются параллельно, и медленная команда не держит
+    быструю. Без rid (старый сервер) все команды — один запрос, как раньше.
+    Вывод (stdout и stderr вперемешку, как в терминале) уходит на сервер
+    по мере появления: чанк по целым строкам — как только набралось
+    STREAM_CHUNK_BYTES или прошло STREAM_INTERVAL. Поток приёма не
+    блокируется, поэтому CANCEL_* доходит сразу: cancel() убивает дерево
+    процессов команд запроса (или всех), и вывод закрывается причиной отмены.
+    """
 
-    def __init__(self, identity: ClientIdentity):
-        self._encoding = identity.get_encoding()
+    CANCEL_REASONS = {
+        "CANCEL_TIMEOUT": "КОМАНДА ОТМЕНЕНА ПО ТАЙМАУТУ",
+        "CANCEL_MANUAL":  "КОМАНДА ОТМЕНЕНА ВРУЧНУЮ",
+    }
 
-    def run(self, cmd: str) -> str:
-        if cmd == "CANCEL_TIMEOUT":
-            return "КОМАНДА ОТМЕНЕНА ПО ТАЙМАУТУ"
-        if cmd == "CANCEL_MANUAL":
-            return "КОМАНДА ОТМЕНЕНА ВРУЧНУЮ"
+    def __init__(self, identity: ClientIdentity, sender: "OutputSender"):
+        self._encoding = identity.get_encoding()
+        self._sender   = sender
+        self._queue: queue.Queue = queue.Queue()      # головы очередей запросов
+        self._lock     = threading.Lock()
+        self._lanes: dict[Optional[int], deque[Job]] = {}   # rid → его команды по порядку
+        self._workers  = 0
+        self.set_workers(1)
+
+    def set_workers(self, n: int):
+        """Размер пула. Лишние потоки завершаются, доделав текущую команду."""
+        n = max(1, n)
+        with self._lock:
+            for _ in range(n - self._workers):
+                threading.Thread(target=self._worker, daemon=True).start()
+            for _ in range(self._workers - n):
+                self._queue.put(None)
+            self._workers = n
+
+    def submit(self, prefix: str, cmd: str, rid: Optional[int] = None):
+        """Ставит команду в очередь запроса rid; вывод уйдёт как prefix (OUTPUT / FILETRU)"""
+        job = Job(rid, prefix, cmd)
+        with self._lock:
+            lane = self._lanes.setdefault(rid, deque())
+            lane.append(job)
+            if len(lane) == 1:
+                self._queue.put(job)
+
+    def cancel(self, reason: str, rid: Optional[int] = None) -> int:
+        """
+        Отменяет команды запроса rid (None — все): очередь отбрасывается,
+        запущенные убиваются. Возвращает число убитых процессов.
+        """
+        with self._lock:
+            lanes = self._lanes.values() if rid is None else [self._lanes.get(rid, ())]
+            jobs  = [job for lane in lanes for job in lane]
+            for job in jobs:
+                job.cancelled = job.cancelled or reason
+            procs = [job.proc for job in jobs if job.proc]
+        for proc in procs:
+            self._kill_tree(proc)
+        Logger.log("CANCEL", f"{reason}: остановлено процессов {len(procs)}")
+        return len(procs)
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            try:
+                if not job.cancelled:
+                    self.run(job)
+            except Exception as e:
+                Logger.log("ERROR", f"Вывод не отправлен: {e}")
+            finally:
+                with self._lock:
+                    lane = self._lanes[job.rid]
+                    lane.popleft()
+                    if lane:
+                        self._queue.put(lane[0])
+                    else:
+                        del self._lanes[job.rid]
+
+    def run(self, job: Job):
+        stream = self._sender.stream(job.prefix, job.rid)
         try:
-            proc = subprocess.run(
-                cmd, shell=True, capture_output=True,
-                encoding=self._encoding, errors="replace",
-                timeout=Config.CMD_TIMEOUT
+            proc = subprocess.Popen(
+                job.cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                **self._group_kwargs()
             )
-            result = proc.stdout or ""
-            if proc.stderr:
-                result += f"\n[STDERR]:\n{proc.stderr}"
-            return result.strip() or f"Выполнено. Code: {proc.returncode}"
-        except subprocess.TimeoutExpired:
-            return "ОШИБКА: Таймаут команды"
         except Exception as e:
-            return f"ОШИБКА: {type(e).__name__}: {e}"
+            stream.write(f"ОШИБКА: {type(e).__name__}: {e}")
+            stream.close()
+            return
+
+        with self._lock:
+            job.proc = proc
+            # cancel() пришёл между очередью и запуском
+            late = bool(job.cancelled)
+        if late:
+            self._kill_tree(proc)
+
+        try:
+            note = self._stream_output(proc, stream)
+            try:
+                proc.wait(timeout=Config.KILL_GRACE)
+            except subprocess.TimeoutExpired:
+                pass
+        finally:
+            with self._lock:
+                job.proc = None
+                note = job.cancelled or note
+
+        if note:
+            stream.write(f"\n{note}")
+        elif not stream.written:
+            stream.write(f"Выполнено. Code: {proc.returncode}")
+        stream.close()
+
+    def _stream_output(self, proc: subprocess.Popen, stream: "OutputStream") -> Optional[str]:
+        """Перекачивает вывод процесса в stream. Возвращает примечание (таймаут) или None."""
+        blocks: queue.Queue = queue.Queue()
+        threading.Thread(target=self._pump, args=(proc.stdout, blocks), daemon=True).start()
+        decoder  = codecs.getincrementaldecoder(self._encoding)(errors="replace")
+        pending  = ""
+        flush_at = None
+        deadline = time.monotonic() + Config.CMD_TIMEOUT if Config.CMD_TIMEOUT else None
+        note     = None
+
+        while True:
+            now = time.monotonic()
+            if deadline is not None and now >= deadline:
+                if note:
+                    break      # каналы держит потомок, ушедший из группы
+                note = "ОШИБКА: Таймаут команды"
+                self._kill_tree(proc)
+                deadline = now + Config.KILL_GRACE
+            wake = [t for t in (deadline, flush_at) if t is not None]
+            try:
+                block = blocks.get(timeout=max(min(wake) - now, 0) if wake else None)
+            except queue.Empty:
+                block = None
+            if block == b"":
+                break
+            if block:
+                pending += decoder.decode(block)
+                if flush_at is None:
+                    flush_at = time.monotonic() + Config.STREAM_INTERVAL
+            if pending and (len(pending) >= Config.STREAM_CHUNK_BYTES
+                            or time.monotonic() >= flush_at):
+                # По целым строкам; строка без \n (прогресс) уходит целиком по таймеру
+                cut = pending.rfind("\n") + 1 or len(pending)
+                stream.write(pending[:cut])
+                pending  = pending[cut:]
+                flush_at = time.monotonic() + Config.STREAM_INTERVAL if pending else None
+
+        pending += decoder.decode(b"", final=True)
+        if pending:
+            stream.write(pending)
+        return note
+
+    @staticmethod
+    def _pump(pipe, out: queue.Queue):
+        """Читает канал процесса в очередь; b"" — конец вывода."""
+        try:
+            while block := pipe.read1(Config.CHUNK_SIZE):
+                out.put(block)
+        except (OSError, ValueError):
+            pass
+        finally:
+            out.put(b"")
+
+    @staticmethod
+    def _group_kwargs() -> dict:
+        """Команда — лидер своей группы процессов: убивается вместе с потомками"""
+        if os.name == "nt":
+            return {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP}
+        return {"start_new_session": True}
+
+    @staticmethod
+    def _kill_tree(proc: subprocess.Popen):
+        try:
+            if os.name == "nt":
+                subprocess.run(["taskkill", "/T", "/F", "/PID", str(proc.pid)],
+                               capture_output=True)
+            else:
+                os.killpg(proc.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError, OSError):
+            pass
 
 
 
 
+class ArchiveWriter:
+    """
+    Сюда пишет tarfile при EXPORT архивом: набранное уходит серверу
+    порциями TAR:<n> + n байт, конец — TAR:0. Сжатие gzip — здесь же.
+    """
+
+    def __init__(self, conn: Connection, compress: int):
+        self._conn = conn
+        self._buf  = bytearray()
+        self._zip  = zlib.compressobj(compress, wbits=31) if compress else None
+        self.sent  = 0
+
+    def write(self, data: bytes) -> int:
+        self._buf += self._zip.compress(data) if self._zip else data
+        if len(self._buf) >= Config.TAR_CHUNK:
+            self._flush()
+        return len(data)
+
+    def finish(self):
+        if self._zip:
+            self._buf += self._zip.flush()
+        self._flush()
+        self._conn.send_msg("TAR:0")
+
+    def _flush(self):
+        if self._buf:
+            self._conn.send_msg(f"TAR:{len(self._buf)}")
+            self._conn.send_data(bytes(self._buf))
+            self.sent += len(self._buf)
+            self._buf.clear()
+
+
+class ArchiveReader:
+    """Отсюда читает tarfile при IMPORT архивом: порции TAR:<n> из сокета до TAR:0"""
+
+    def __init__(self, conn: Connection, buf: RawBuffer, compress: int):
+        self._conn  = conn
+        self._buf   = buf
+        self._data  = bytearray()
+        self._eof   = False
+        self._unzip = zlib.decompressobj(wbits=31) if compress else None
+        self.received = 0
+
+    def read(self, size: int = -1) -> bytes:
+        while not self._data and not self._eof:
+            self._next()
+        size = len(self._data) if size < 0 else size
+        data = bytes(self._data[:size])
+        del self._data[:size]
+        return data
+
+    def drain(self):
+        """Дочитать поток до TAR:0 — после ошибки распаковки или хвоста записи tar"""
+        while not self._eof:
+            self._next()
+            self._data.clear()
+
+    def _next(self):
+        sock = self._conn.get_sock()
+        head = self._buf.read_line(sock)
+        if head == "TAR:ABORT" or not head.startswith("TAR:") or not head[4:].isdigit():
+            self._eof = True
+            raise ConnectionAbortedError(f"Архив оборван: {head[:60]}")
+        size = int(head[4:])
+        if not size:
+            self._eof = True
+            if self._unzip:
+                self._data += self._unzip.flush()
+            return
+        chunk = self._buf.read_exact(sock, size)
+        self.received += size
+        self._data += self._unzip.decompress(chunk) if self._unzip else chunk
+
+
+class ReceivedFile:
+    """
+    Принимаемый при IMPORT файл: запись, sha256 всего файла и, если это
+    файл v6 от RESUME_BLOCK байт, журнал докачки — см. TransferJournal
+    """
+
+    def __init__(self, path: Path, size: int, tid: Optional[str] = None,
+                 rel_path: str = "", offset: int = 0):
+        self.path     = path
+        self.size     = size
+        self.tid      = tid if tid and size >= Config.RESUME_BLOCK else None
+        self.rel_path = rel_path
+        self.offset   = offset if self.tid else 0
+        self.sha      = hashlib.sha256()
+        self._block   = hashlib.sha256()
+        self._fill    = 0
+        self._f       = None
+        self._journal = None
+
+    @property
+    def target(self) -> Path:
+        return TransferJournal.part(self.path) if self.tid else self.path
+
+    def open(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        if not self.tid:
+            self._f = open(self.path, "wb")
+            return
+        if self.offset:
+            # offset — граница блока, сверенная обеими сторонами; начало
+            # перечитывается только ради sha256 всего файла
+            self._f = open(self.target, "r+b")
+            self._f.truncate(self.offset)
+            while chunk := self._f.read(1 << 20):
+                self.sha.update(chunk)
+        else:
+            self._f = open(self.target, "wb")
+        self._journal = TransferJournal.start(self.path, self.tid, self.rel_path, self.size,
+                                              self.offset // Config.RESUME_BLOCK)
+
+    def write(self, data):
+        self._f.write(data)
+        self.sha.update(data)
+        if self._journal:
+            self._track(memoryview(data))
+
+    def close(self, digest: Optional[str] = None) -> bool:
+        """digest — sha256 отправителя; не совпал — файл и журнал удаляются"""
+        self._f.close()
+        if self._journal:
+            self._journal.close()
+        if digest and digest != self.sha.hexdigest():
+            self.target.unlink(missing_ok=True)
+            TransferJournal.remove(self.path)
+            return False
+        if self.tid:
+            os.replace(self.target, self.path)
+            TransferJournal.remove(self.path)
+        return True
+
+    def abort(self):
+        """Обрыв: .part и журнал остаются для докачки"""
+        self._f.close()
+        if self._journal:
+            self._journal.close()
+
+    def _track(self, view: memoryview):
+        while view:
+            n = min(len(view), Config.RESUME_BLOCK - self._fill)
+            self._block.update(view[:n])
+            self._fill += n
+            view = view[n:]
+            if self._fill == Config.RESUME_BLOCK:
+                self._f.flush()
+                self._journal.write(self._block.hexdigest() + "\n")
+                self._journal.flush()
+                self._block = hashlib.sha256()
+                self._fill  = 0
+
+
+class TransferJournal:
+    """
+    Журнал докачки (v6) — тот же формат, что у сервера: рядом с "<имя>.part"
+    лежит "<имя>.part.sum" — заголовок {"tid", "rel_path", "size", "block"}
+    и по строке sha256 на каждый принятый блок
+    """
+
+    @staticmethod
+    def part(path: Path) -> Path:
+        return path.with_name(path.name + ".part")
+
+    @staticmethod
+    def sums(path: Path) -> Path:
+        return path.with_name(path.name + ".part.sum")
+
+    @staticmethod
+    def tid(file_path: str, rel_path: str) -> str:
+        st = os.stat(file_path)
+        return hashlib.sha1(f"{rel_path}\0{st.st_size}\0{st.st_mtime_ns}".encode()).hexdigest()[:16]
+
+    @staticmethod
+    def start(path: Path, tid: str, rel_path: str, size: int, kept: int):
+        old    = TransferJournal._read(TransferJournal.sums(path))
+        head   = {"tid": tid, "rel_path": rel_path, "size": size, "block": Config.RESUME_BLOCK}
+        blocks = old[1][:kept] if old and old[0].get("tid") == tid else []
+        f = open(TransferJournal.sums(path), "w", encoding="utf-8")
+        f.write(json.dumps(head) + "\n" + "".join(b + "\n" for b in blocks))
+        f.flush()
+        return f
+
+    @staticmethod
+    def remove(path: Path):
+        TransferJournal.sums(path).unlink(missing_ok=True)
+
+    @staticmethod
+    def table(dest: Path) -> dict:
+        """Принятые блоки журналов в dest, сверенные с .part: {rel_path: {"tid", "block", "blocks"}}"""
+        journals = list(dest.rglob("*.part.sum")) if dest.is_dir() else []
+        single   = TransferJournal.sums(dest)
+        if single.exists():
+            journals.append(single)
+        table = {}
+        for sums in journals:
+            journal = TransferJournal._read(sums)
+            if not journal or journal[0].get("block") != Config.RESUME_BLOCK:
+                continue
+            head, blocks = journal
+            good = TransferJournal._verify(sums.with_suffix(""), blocks, Config.RESUME_BLOCK)
+            if good:
+                table[head["rel_path"]] = {"tid": head["tid"], "block": head["block"],
+                                           "blocks": blocks[:good]}
+        return table
+
+    @staticmethod
+    def resume_offset(file_path: str, entry: dict):
+        """Блоки приёмника сверяются с нашим файлом: (смещение, sha256 совпавшего начала)"""
+        block  = entry.get("block", Config.RESUME_BLOCK)
+        sha    = hashlib.sha256()
+        offset = 0
+        with open(file_path, "rb") as f:
+            for digest in entry.get("blocks", []):
+                data = f.read(block)
+                if len(data) < block or hashlib.sha256(data).hexdigest() != digest:
+                    break
+                sha.update(data)
+                offset += block
+        return offset, sha
+
+    @staticmethod
+    def _read(sums: Path):
+        try:
+            lines = sums.read_text("utf-8").split("\n")
+            head  = json.loads(lines[0])
+        except (OSError, ValueError):
+            return None
+        # Последняя строка без \n — блок, не дописанный до обрыва
+        return head, [l for l in lines[1:-1] if len(l) == 64]
+
+    @staticmethod
+    def _verify(part: Path, blocks: list, block: int) -> int:
+        good = 0
+        try:
+            with open(part, "rb") as f:
+                for digest in blocks:
+                    data = f.read(block)
+                    if len(data) < block or hashlib.sha256(data).hexdigest() != digest:
+                        break
+                    good += 1
+        except OSError:
+            return 0
+        return good
+
+
 class FileTransfer:
     """Отправка (EXPORT) и приём (IMPORT) файлов"""
 
     def __init__(self, conn: Connection, buf: RawBuffer):
-        self._conn = conn
-        self._buf  = buf
-
-    def export(self, source_path: str, dest_dir: str):
-        """Клиент отправляет файлы на сервер"""
+        self._conn  = conn
+        self._buf   = buf
+        self._needs: dict[Optional[int], queue.Queue] = {}
+
+    def export(self, source_path: str, dest_dir: str, rid: Optional[int] = None,
+               table: Optional[dict] = None):
+        """Клиент отправляет файлы на сервер. table (v6) — журналы докачки сервера"""
+        tag   = request_tag(rid)
         path  = Path(source_path)
         if not path.exists():
-            self._conn.send(f"EXPORT:ERROR:Путь не найден: {source_path}\n".encode())
+            self._conn.send_msg(f"EXPORT:ERROR:{tag}Путь не найден: {source_path}")
             return
 
-        files = self._list_files(path)
+        # Обход идёт по мере отправки: первых TAR_MIN_FILES хватает, чтобы выбрать режим
+        scan  = self._scan(path)
+        files = list(itertools.islice(scan, Config.TAR_MIN_FILES))
         if not files:
-            self._conn.send(f"EXPORT:ERROR:Нет файлов в {source_path}\n".encode())
+            self._conn.send_msg(f"EXPORT:ERROR:{tag}Нет файлов в {source_path}")
             return
 
-        meta = json.dumps({"count": len(files), "dest_dir": dest_dir, "source": path.name})
-        self._conn.send(f"EXPORT:START:{meta}\n".encode())
-        Logger.log("EXPORT", f"{len(files)} файлов → сервер")
-
-        for fi in files:
-            if not self._send_file(fi["path"], fi["rel_path"], fi["size"]):
-                self._conn.send(b"EXPORT:ABORT\n")
+        # v8: сначала sha256 всех файлов — сервер попросит только то, чего у него нет
+        dedup   = self._conn.protocol >= 8
+        # Много мелких файлов — одним потоком tar вместо FILE:META/FILE:END на каждый;
+        # число файлов заранее неизвестно — count -1
+        archive = (not dedup and self._conn.protocol >= 5 and path.is_dir()
+                   and len(files) >= Config.TAR_MIN_FILES)
+        if dedup:
+            files += scan
+            reply = self._need(files, rid)
+            if "error" in reply:
+                Logger.log("ERROR", f"EXPORT: {reply['error']}")
+                self._conn.send_msg(f"EXPORT:ERROR:{tag}{reply['error']}")
                 return
+            wanted  = set(reply["files"])
+            files   = [fi for fi in files if fi["rel_path"] in wanted]
+            archive = reply["mode"] == "tar"
+            meta    = {"count": len(files), "dest_dir": dest_dir, "source": path.name,
+                       "mode": reply["mode"], "compress": Config.TAR_COMPRESS, "dedup": True}
+        elif archive:
+            files = itertools.chain(files, scan)
+            meta  = {"count": -1, "dest_dir": dest_dir, "source": path.name,
+                     "mode": "tar", "compress": Config.TAR_COMPRESS}
+        else:
+            files += scan
+            meta  = {"count": len(files), "dest_dir": dest_dir, "source": path.name}
+        with self._conn.exclusive():
+            self._conn.send_msg(f"EXPORT:START:{tag}{json.dumps(meta)}")
+            Logger.log("EXPORT", "архив → сервер" if archive else f"{len(files)} файлов → сервер")
+
+            if archive:
+                if not self._send_archive(files):
+                    self._conn.send_msg(f"EXPORT:ERROR:{tag}Архив не отправлен")
+                    return
+            else:
+                for fi in files:
+                    if not self._send_file(fi["path"], fi["rel_path"], fi["size"], table):
+                        self._conn.send_msg("EXPORT:ABORT")
+                        return
 
-        self._conn.send(b"EXPORT:COMPLETE\n")
+            self._conn.send_msg("EXPORT:COMPLETE")
         Logger.log("EXPORT", "Завершён")
 
-    def import_files(self, meta_payload: str):
+    def _need(self, files: list, rid: Optional[int]) -> dict:
+        """
+        v8: EXPORT:MANIFEST с sha256 файлов и ожидание EXPORT:NEED — без exclusive:
+        пока сервер отвечает, выводы команд и ответы IMPORT уходят как обычно
+        """
+        manifest = {fi["rel_path"]: [fi["size"], self._sha256(fi["path"])] for fi in files}
+        self._needs[rid] = queue.Queue(maxsize=1)
+        try:
+            self._conn.send_msg(f"EXPORT:MANIFEST:{request_tag(rid)}{json.dumps(manifest)}")
+            return self._needs[rid].get(timeout=Config.DEDUP_TIMEOUT)
+        except queue.Empty:
+            return {"error": "сервер не ответил списком нужных файлов"}
+        finally:
+            self._needs.pop(rid, None)
+
+    def on_need(self, payload: str, rid: Optional[int] = None):
+        """EXPORT:NEED (v8) — из потока приёма в поток export, который его ждёт"""
+        waiter = self._needs.get(rid)
+        if waiter:
+            waiter.put(json.loads(payload))
+
+    def sign(self, payload: str, rid: Optional[int] = None):
+        """
+        IMPORT:SIGN (v7) — подписи имеющихся копий, чтобы сервер прислал только
+        изменившиеся блоки. Отдельный поток: копии бывают в гигабайты, а приём
+        команд (и CANCEL) в это время не стоит
+        """
+        sigs = {}
+        try:
+            req = json.loads(payload)
+            for rel_path in req["files"]:
+                copy = self._save_path(req["dest_dir"], rel_path, req["count"])
+                if copy.is_file():
+                    sigs[rel_path] = self._signature(copy)
+        except Exception as e:
+            Logger.log("ERROR", f"Подписи копий: {e}")
+        self._conn.send_msg(f"IMPORT:SIGNATURE:{request_tag(rid)}{json.dumps(sigs)}")
+
+    def import_files(self, meta_payload: str, rid: Optional[int] = None):
         """Клиент получает файлы от сервера"""
+        tag = request_tag(rid)
         try:
             meta         = json.loads(meta_payload)
             count        = meta["count"]
             dest_dir     = meta.get("dest_dir", "received")
-            Logger.log("IMPORT", f"{count} файлов из '{meta.get('source')}' → {dest_dir}")
-
-            for _ in range(count):
-                sock     = self._conn.get_sock()
-                meta_line = self._buf.read_line(sock)
-                if not meta_line.startswith("FILE:META:"):
-                    Logger.log("ERROR", f"Ожидался FILE:META, получено: {meta_line}")
-                    break
-                file_meta = json.loads(meta_line[10:])
-                self._receive_file(file_meta, dest_dir, count)
+            Logger.log("IMPORT", f"{'архив' if count < 0 else f'{count} файлов'} "
+                                 f"из '{meta.get('source')}' → {dest_dir}")
 
-            self._conn.send(b"IMPORT:COMPLETE\n")
+            if meta.get("mode") == "tar":
+                self._receive_archive(dest_dir, meta.get("compress", 0))
+            else:
+                if meta.get("resume"):
+                    # v6: сервер ждёт, что уже принято, и шлёт с первого несовпавшего блока
+                    table = TransferJournal.table(Path(dest_dir))
+                    self._conn.send_msg(f"IMPORT:RESUME:{tag}{json.dumps(table)}")
+                corrupt = []
+                for _ in range(count):
+                    sock     = self._conn.get_sock()
+                    meta_line = self._buf.read_line(sock)
+                    if not meta_line.startswith("FILE:META:"):
+                        Logger.log("ERROR", f"Ожидался FILE:META, получено: {meta_line}")
+                        break
+                    file_meta = json.loads(meta_line[10:])
+                    receive   = self._receive_delta if "delta" in file_meta else self._receive_file
+                    if not receive(file_meta, dest_dir, count):
+                        corrupt.append(file_meta["rel_path"])
+                if corrupt:
+                    raise ValueError(f"Контрольная сумма не совпала: {', '.join(corrupt)}")
+
+            self._conn.send_msg(f"IMPORT:COMPLETE:{tag[:-1]}" if tag else "IMPORT:COMPLETE")
             Logger.log("IMPORT", "Завершён")
 
         except Exception as e:
             Logger.log("ERROR", f"Ошибка импорта: {e}")
-            self._conn.send(f"IMPORT:ERROR:{e}\n".encode())
+            self._conn.send_msg(f"IMPORT:ERROR:{tag}{e}")
 
     # ── private ──────────────────────────────────────────────────────────
 
-    def _send_file(self, path: str, rel_path: str, size: int) -> bool:
+    def _send_archive(self, files) -> bool:
+        """files — итератор: архив начинает уходить, пока каталог ещё обходится"""
+        writer = ArchiveWriter(self._conn, Config.TAR_COMPRESS)
+        count  = 0
+        try:
+            with tarfile.open(fileobj=writer, mode="w|") as tar:
+                for fi in files:
+                    with open(fi["path"], "rb") as f:
+                        tar.addfile(self._tar_info(fi["rel_path"], os.fstat(f.fileno())), f)
+                    count += 1
+            writer.finish()
+            print(f"  ✓ архив: {count} файлов, {writer.sent / 1024 / 1024:.2f} MB")
+            return True
+        except Exception as e:
+            Logger.log("ERROR", f"Ошибка отправки архива: {e}")
+            try:
+                self._conn.send_msg("TAR:ABORT")
+            except OSError:
+                pass
+            return False
+
+    def _receive_archive(self, dest_dir: str, compress: int):
+        """Только обычные файлы, внутри dest_dir — как и в пофайловом режиме"""
+        reader = ArchiveReader(self._conn, self._buf, compress)
+        dest   = Path(dest_dir)
+        count  = 0
+        made   = set()
         try:
-            meta = json.dumps({"rel_path": rel_path, "size": size})
-            self._conn.send(f"FILE:META:{meta}\n".encode())
-            sent = 0
+            with tarfile.open(fileobj=reader, mode="r|") as tar:
+                for member in tar:
+                    if not member.isfile():
+                        continue
+                    rel = Path(member.name)
+                    if rel.is_absolute() or ".." in rel.parts:
+                        raise ValueError(f"Недопустимый путь в архиве: {member.name}")
+                    path = dest / rel
+                    if path.parent not in made:
+                        path.parent.mkdir(parents=True, exist_ok=True)
+                        made.add(path.parent)
+                    with open(path, "wb") as f:
+                        shutil.copyfileobj(tar.extractfile(member), f)
+                    count += 1
+        finally:
+            # Остаток потока до TAR:0 — иначе его прочли бы как команды
+            reader.drain()
+        print(f"  ✓ архив: {count} файлов, {reader.received / 1024 / 1024:.2f} MB")
+
+    @staticmethod
+    def _tar_info(rel_path: str, st: os.stat_result) -> tarfile.TarInfo:
+        """Без владельца и дробного mtime — иначе tar.add ищет имена и пишет PAX-заголовок на каждый файл"""
+        info       = tarfile.TarInfo(Path(rel_path).as_posix())
+        info.size  = st.st_size
+        info.mtime = int(st.st_mtime)
+        info.mode  = st.st_mode & 0o777
+        return info
+
+    def _send_file(self, path: str, rel_path: str, size: int, table: Optional[dict] = None) -> bool:
+        """table (v6) — META с tid и offset (докачка), FILE:END с sha256 всего файла"""
+        try:
+            meta   = {"rel_path": rel_path, "size": size}
+            offset = 0
+            sha    = None
+            if table is not None:
+                tid   = TransferJournal.tid(path, rel_path)
+                entry = table.get(rel_path)
+                offset, sha = (TransferJournal.resume_offset(path, entry)
+                               if entry and entry.get("tid") == tid else (0, hashlib.sha256()))
+                meta.update(tid=tid, offset=offset)
+            self._conn.send_msg(f"FILE:META:{json.dumps(meta)}")
+            sent = offset
             with open(path, "rb") as f:
+                f.seek(offset)
                 while chunk := f.read(Config.CHUNK_SIZE):
-                    self._conn.send(chunk)
+                    self._conn.send_data(chunk)
+                    if sha:
+                        sha.update(chunk)
                     sent += len(chunk)
                     print(f"\r  {rel_path}: {sent * 100 // size if size else 100}%",
                           end="", flush=True)
-            print(f"\r  ✓ {rel_path} ({size / 1024:.1f} KB)")
-            self._conn.send(b"FILE:END\n")
+            print(f"\r  ✓ {rel_path} ({size / 1024:.1f} KB)" +
+                  (f", с {offset / 1024 / 1024:.0f} MB" if offset else ""))
+            self._conn.send_msg(f"FILE:END:{sha.hexdigest()}" if sha else "FILE:END")
             return True
         except Exception as e:
             Logger.log("ERROR", f"Ошибка отправки {rel_path}: {e}")
             return False
 
-    def _receive_file(self, file_meta: dict, dest_dir: str, total_count: int):
+    def _receive_file(self, file_meta: dict, dest_dir: str, total_count: int) -> bool:
+        """False — файл дошёл, но sha256 не совпал (удалён); поток при этом цел"""
         rel_path  = file_meta["rel_path"]
         size      = file_meta["size"]
-        dest      = Path(dest_dir)
-        save_path = dest if (total_count == 1 and dest.suffix) else dest / rel_path
-        save_path.parent.mkdir(parents=True, exist_ok=True)
+        offset    = file_meta.get("offset", 0)
+        save_path = self._save_path(dest_dir, rel_path, total_count)
 
-        received = 0
-        sock     = self._conn.get_sock()
-        with open(save_path, "wb") as f:
-            while received < size:
-                chunk = self._buf.read_exact(sock, min(Config.CHUNK_SIZE, size - received))
-                f.write(chunk)
-                received += len(chunk)
-                print(f"\r  {save_path.name}: {received * 100 // size if size else 100}%",
-                      end="", flush=True)
-        print(f"\r  ✓ {save_path.name} ({size / 1024:.1f} KB)")
+        received = ReceivedFile(save_path, size, file_meta.get("tid"), rel_path, offset)
+        received.open()
+        sock = self._conn.get_sock()
+        try:
+            self._buf.read_to_file(sock, received, size - offset, lambda n: print(
+                f"\r  {save_path.name}: {(offset + n) * 100 // size}%", end="", flush=True))
+        except BaseException:
+            received.abort()
+            raise
 
         end_marker = self._buf.read_line(sock)
         if not end_marker.startswith("FILE:END"):
             Logger.log("WARNING", f"Неожиданный маркер: {end_marker}")
+        if not received.close(end_marker[9:] or None):
+            Logger.log("ERROR", f"{save_path.name}: контрольная сумма не совпала, файл удалён")
+            return False
+        print(f"\r  ✓ {save_path.name} ({size / 1024:.1f} KB)" +
+              (f", с {offset / 1024 / 1024:.0f} MB" if offset else ""))
+        return True
+
+    def _receive_delta(self, file_meta: dict, dest_dir: str, total_count: int) -> bool:
+        """
+        Файл дельтой к имеющейся копии: собирается рядом, в "<имя>.delta",
+        и подменяет копию одним os.replace — только если sha256 совпал
+        """
+        block     = file_meta["delta"]
+        save_path = self._save_path(dest_dir, file_meta["rel_path"], total_count)
+        tmp_path  = save_path.with_name(save_path.name + ".delta")
+        sock      = self._conn.get_sock()
+        sha       = hashlib.sha256()
+        new_bytes = 0
+        try:
+            with open(save_path, "rb") as old, open(tmp_path, "wb") as out:
+                while (line := self._buf.read_line(sock)).startswith("DELTA:"):
+                    if line.startswith("DELTA:COPY:"):
+                        first, count = map(int, line[11:].split(":"))
+                        old.seek(first * block)
+                        left = count * block
+                        while left > 0 and (chunk := old.read(min(left, 1 << 20))):
+                            out.write(chunk)
+                            sha.update(chunk)
+                            left -= len(chunk)
+                    else:
+                        data = self._buf.read_exact(sock, int(line[11:]))
+                        out.write(data)
+                        sha.update(data)
+                        new_bytes += len(data)
+            if not line.startswith("FILE:END") or line[9:] != sha.hexdigest():
+                tmp_path.unlink(missing_ok=True)
+                Logger.log("ERROR", f"{save_path.name}: дельта не сошлась, копия не тронута")
+                return False
+            shutil.copymode(save_path, tmp_path)
+            os.replace(tmp_path, save_path)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+        print(f"\r  ✓ {save_path.name} ({file_meta['size'] / 1024:.1f} KB), "
+              f"дельта: {new_bytes / 1024:.1f} KB новых данных")
+        return True
 
     @staticmethod
-    def _list_files(path: Path) -> list:
+    def _sha256(path: str) -> str:
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            while chunk := f.read(1 << 20):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    @staticmethod
+    def _signature(path: Path) -> dict:
+        """adler32 и blake2b каждого блока копии — по ним сервер ищет совпадения"""
+        size  = path.stat().st_size
+        block = min(max(math.isqrt(size) // 1024 * 1024, Config.DELTA_BLOCK_MIN), Config.DELTA_BLOCK_MAX)
+        weak, strong = [], []
+        with open(path, "rb") as f:
+            while chunk := f.read(block):
+                weak.append(zlib.adler32(chunk))
+                strong.append(hashlib.blake2b(chunk, digest_size=16).hexdigest())
+        return {"size": size, "block": block, "weak": weak, "strong": strong}
+
+    @staticmethod
+    def _save_path(dest_dir: str, rel_path: str, total_count: int) -> Path:
+        """Один файл в путь с расширением — это и есть имя файла, иначе — папка"""
+        dest = Path(dest_dir)
+        return dest if (total_count == 1 and dest.suffix) else dest / rel_path
+
+    @staticmethod
+    def _scan(path: Path):
+        """
+        Файлы по одному через os.scandir: тип — из DirEntry без stat,
+        размер — один stat на файл. В ссылки на каталоги не заходит, как rglob.
+        """
         if path.is_file():
-            return [{"path": str(path), "rel_path": path.name, "size": path.stat().st_size}]
-        return [
-            {"path": str(f), "rel_path": str(f.relative_to(path)), "size": f.stat().st_size}
-            for f in path.rglob("*") if f.is_file()
-        ]
+            yield {"path": str(path), "rel_path": path.name, "size": path.stat().st_size}
+            return
+        stack = [(str(path), "")]
+        while stack:
+            top, prefix = stack.pop()
+            try:
+                entries = os.scandir(top)
+            except OSError as e:
+                Logger.log("WARNING", f"Каталог пропущен: {e}")
+                continue
+            with entries:
+                for entry in entries:
+                    rel = os.path.join(prefix, entry.name)
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append((entry.path, rel))
+                        elif entry.is_file():
+                            yield {"path": entry.path, "rel_path": rel, "size": entry.stat().st_size}
+                    except OSError:
+                        continue
 
 
 
 
 class OutputSender:
-    """Отправляет текстовый вывод команды чанками"""
+    """
+    Отправляет текстовый вывод команды чанками.
+    v3: CHUNK-строки с <<<NL>>> вместо переводов строк.
+    v4: кадры OUTPUT/FILETRU с сырым текстом, без экранирования.
+    """
+
+    _FRAMES = {"OUTPUT": FrameType.OUTPUT, "FILETRU": FrameType.FILETRU}
 
     def __init__(self, conn: Connection):
         self._conn = conn
 
-    def send(self, prefix: str, text: str, chunk_size: int = 100):
-        lines = text.split("\n")
-        self._conn.send(f"{prefix}:START:{len(lines)}\n".encode())
-        for i in range(0, len(lines), chunk_size):
-            chunk = "\n".join(lines[i:i + chunk_size]).replace("\n", "<<<NL>>>")
-            self._conn.send(f"{prefix}:CHUNK:{chunk}\n".encode("utf-8", errors="replace"))
-        self._conn.send(f"{prefix}:END\n".encode())
+    def stream(self, prefix: str, rid: Optional[int] = None) -> "OutputStream":
+        """Открывает вывод: START уходит сразу, чанки — по мере write()"""
+        return OutputStream(self._conn, prefix, self._FRAMES[prefix], rid)
+
+
+class OutputStream:
+    """
+    Вывод одной команды: START, чанки, END. Соединение занимается
+    на одно сообщение, а не на весь вывод — EXPORT и выводы других
+    команд пула идут между чанками. Поэтому с rid каждое сообщение
+    помечено "@rid:" — по метке сервер разбирает, чей это вывод.
+    Сервер склеивает чанки через \n, поэтому завершающий \n чанка снимается.
+    """
+
+    V3_LINES = 100
+
+    def __init__(self, conn: Connection, prefix: str, frame: FrameType,
+                 rid: Optional[int] = None):
+        self._conn   = conn
+        self._prefix = prefix
+        self._frame  = frame
+        self._tag    = request_tag(rid)
+        self.written = False
+        # Число строк заранее неизвестно — 0
+        self._conn.send_msg(f"{prefix}:START:{self._tag}0")
+
+    def write(self, text: str):
+        if text.endswith("\n"):
+            text = text[:-1]
+        self.written = True
+        if self._conn.protocol >= 4:
+            self._conn.send_data((self._tag + text).encode("utf-8", errors="replace"), self._frame)
+        else:
+            # В v3 чанк — одна строка, она не должна упереться в лимит readline сервера
+            lines = text.split("\n")
+            for i in range(0, len(lines), self.V3_LINES):
+                escaped = "<<<NL>>>".join(lines[i:i + self.V3_LINES])
+                self._conn.send_msg(f"{self._prefix}:CHUNK:{self._tag}{escaped}")
+
+    def close(self):
+        if self._tag:
+            self._conn.send_msg(f"{self._prefix}:END:{self._tag[:-1]}")
+        else:
+            self._conn.send_msg(f"{self._prefix}:END")
 
 
 # ═══════════════════════════════════════════════════════════════════════════
@@ -388,38 +1233,73 @@ class MessageHandler:
     """
 
     def __init__(self, conn: Connection, buf: RawBuffer,
-                 executor: CommandExecutor, transfer: FileTransfer,
-                 sender: OutputSender):
+                 executor: CommandExecutor, transfer: FileTransfer):
         self._conn     = conn
         self._buf      = buf
         self._executor = executor
         self._transfer = transfer
-        self._sender   = sender
 
     def handle(self, msg: str) -> bool:
         """Возвращает False если нужно завершить работу"""
 
         if msg.startswith("CMD:"):
-            cmd    = msg[4:].strip()
-            Logger.log("CMD", cmd)
-            result = self._executor.run(cmd)
-            self._sender.send("OUTPUT", result)
+            rid, cmd = self._request(msg[4:].strip())
+            if cmd in CommandExecutor.CANCEL_REASONS:
+                self._executor.cancel(CommandExecutor.CANCEL_REASONS[cmd], rid)
+            else:
+                Logger.log("CMD", cmd)
+                self._executor.submit("OUTPUT", cmd, rid)
 
         elif msg.startswith("FILETRU:"):
-            cmd    = msg[8:].strip()
+            rid, cmd = self._request(msg[8:].strip())
             Logger.log("FILETRU", cmd)
-            result = self._executor.run(cmd)
-            self._sender.send("FILETRU", result)
+            self._executor.submit("FILETRU", cmd, rid)
+
+        elif msg.startswith("FILEBATCH:"):
+            # Весь шаблон одним сообщением: ответ — по FILETRU на каждую команду
+            rid, payload = self._request(msg[10:])
+            commands = json.loads(payload)
+            Logger.log("FILEBATCH", f"{len(commands)} команд")
+            for cmd in commands:
+                Logger.log("FILETRU", cmd)
+                self._executor.submit("FILETRU", cmd, rid)
+
+        elif msg.startswith("IMPORT:SIGN:"):
+            rid, payload = self._request(msg[12:])
+            threading.Thread(target=self._transfer.sign, args=(payload, rid), daemon=True).start()
 
         elif msg.startswith("IMPORT:START:"):
-            self._transfer.import_files(msg[13:])
+            # Файлы идут следом в том же сокете — принимаются здесь, в потоке приёма
+            rid, meta = self._request(msg[13:])
+            self._transfer.import_files(meta, rid)
 
         elif msg.startswith("EXPORT;"):
-            parts = msg[7:].split(";", 1)
-            if len(parts) == 2:
-                self._transfer.export(parts[0].strip(), parts[1].strip())
+            rid, body = self._request(msg[7:])
+            # v6: третье поле — журналы докачки сервера (JSON)
+            parts = body.split(";", 2)
+            if len(parts) >= 2:
+                table = json.loads(parts[2]) if len(parts) == 3 else None
+                # Отдельный поток: пока файлы уходят, приём команд не стоит
+                threading.Thread(target=self._transfer.export,
+                                 args=(parts[0].strip(), parts[1].strip(), rid, table),
+                                 daemon=True).start()
             else:
-                self._conn.send("EXPORT:ERROR:Неверный формат\n")
+                self._conn.send_msg(f"EXPORT:ERROR:{request_tag(rid)}Неверный формат")
+
+        elif msg.startswith("EXPORT:NEED:"):
+            rid, payload = self._request(msg[12:])
+            self._transfer.on_need(payload, rid)
+
+        elif msg.startswith("PROTO:"):
+            version = msg[6:].strip()
+            self._conn.protocol = int(version) if version.isdigit() else 3
+            Logger.log("INFO", f"Протокол v{self._conn.protocol}")
+
+        elif msg.startswith("WORKERS:"):
+            workers = msg[8:].strip()
+            if workers.isdigit():
+                self._executor.set_workers(int(workers))
+                Logger.log("INFO", f"Пул команд: {workers}")
 
         elif msg.startswith("KICK:"):
             Logger.log("KICK", msg[5:].strip())
@@ -434,6 +1314,15 @@ class MessageHandler:
 
         return True
 
+    @staticmethod
+    def _request(body: str) -> tuple[Optional[int], str]:
+        """"@7:ls" → (7, "ls"); без ID (старый сервер) — (None, body)"""
+        if body.startswith("@"):
+            rid, sep, rest = body[1:].partition(":")
+            if sep and rid.isdigit():
+                return int(rid), rest
+        return None, body
+
 
 
 
@@ -444,12 +1333,12 @@ class TCPClient:
         self._identity = ClientIdentity()
         self._buf      = RawBuffer()
         self._conn     = Connection(self._identity, self._buf)
-        self._executor = CommandExecutor(self._identity)
-        self._transfer = FileTransfer(self._conn, self._buf)
         self._sender   = OutputSender(self._conn)
+        self._executor = CommandExecutor(self._identity, self._sender)
+        self._transfer = FileTransfer(self._conn, self._buf)
         self._handler  = MessageHandler(
             self._conn, self._buf,
-            self._executor, self._transfer, self._sender
+            self._executor, self._transfer
         )
 
     def run(self):
@@ -473,15 +1362,20 @@ class TCPClient:
                     break   # KICK или SHUTDOWN
             except ConnectionError:
                 Logger.log("ERROR", "Соединение разорвано")
-                self._conn.disconnect()
-                if not self._conn.connect():
+                self._executor.cancel("СОЕДИНЕНИЕ РАЗОРВАНО")
+                if not self._reconnect():
                     break
             except Exception as e:
                 Logger.log("ERROR", f"Ошибка: {e}")
-                self._conn.disconnect()
-                if not self._conn.connect():
+                if not self._reconnect():
                     break
 
+    def _reconnect(self) -> bool:
+        self._conn.disconnect()
+        # Пул заново разрешит сервер (WORKERS:n); старый сервер — по одной команде
+        self._executor.set_workers(1)
+        return self._conn.connect()
+
 
 
 